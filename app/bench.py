@@ -0,0 +1,582 @@
+"""Micro-benchmarks for the request-path hot spots in sw.py.
+
+Run from anywhere:  python app/bench.py [name ...]   (no names runs them all)
+
+sw is imported the way the tests import it: network stubbed out, data dir
+pointed at a scratch directory, scheduler stopped and the shutdown save
+unregistered, so a run never touches data/.
+Corpora are synthetic and seeded, so numbers compare between runs and
+branches rather than standing for production latency.
+"""
+import atexit
+import gc
+import logging
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import requests
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _no_network(*args, **kwargs):
+    raise requests.RequestException("network disabled in benchmarks")
+
+
+os.chdir(APP_DIR)
+sys.path.insert(0, APP_DIR)
+requests.get = _no_network
+# Likes, notes and flags written at import or by a benchmark land here.
+DATA_DIR = tempfile.mkdtemp(prefix="sw-bench-")
+os.environ["SW_DATA_DIR"] = DATA_DIR
+os.environ["SW_SQLITE_DIR"] = DATA_DIR
+# The import-time feed fetches all fail by design; keep them out of the report.
+logging.disable(logging.ERROR)
+
+import sw  # noqa: E402
+
+logging.disable(logging.NOTSET)
+logging.getLogger("sw").setLevel(logging.WARNING)
+# Paused rather than shut down, so sw's own atexit shutdown still succeeds.
+sw.scheduler.pause()
+atexit.unregister(sw.save_all_data)
+atexit.register(shutil.rmtree, DATA_DIR, ignore_errors=True)
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__.removeprefix("bench_")] = fn
+    return fn
+
+
+def timed(fn, repeat=200):
+    """Median wall time of fn() in microseconds."""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return statistics.median(runs) * 1e6
+
+
+def report(label, value, unit="us"):
+    print(f"  {label:<48} {value:>12.2f} {unit}")
+
+
+def corpus(n, dim=64, topics=40, seed=1):
+    """`n` blog posts spread over `topics` embedding clusters.
+
+    Each topic gets a home category, but one post in four carries a random
+    one instead, the way real category tags are only loosely topical.
+    Returns (entries, embeddings, topic per link).
+    """
+    rng = np.random.default_rng(seed)
+    cats = [c for c in sw.CATEGORIES if c not in ("spam", "uncategorized")]
+    centers = rng.normal(size=(topics, dim))
+    entries, embeddings, topic_of = [], {}, {}
+    now = datetime.now()
+    for i in range(n):
+        topic = int(rng.integers(topics))
+        link = f"https://blog{i % 5000}.example/post/{i}"
+        cat = cats[topic % len(cats)] if rng.random() > 0.25 else rng.choice(cats)
+        entries.append(
+            sw.FeedEntry(
+                link=link,
+                title=f"Post {i}",
+                author="A",
+                description="<p>Body</p>",
+                updated=now - timedelta(minutes=i),
+                categories=[cat],
+            )
+        )
+        embeddings[link] = (centers[topic] + rng.normal(0, 0.6, dim)).tolist()
+        topic_of[link] = topic
+    return entries, embeddings, topic_of
+
+
+def load(entries, embeddings):
+    sw.urls_cache = entries
+    sw.embeddings_cache = embeddings
+    sw._build_embedding_matrix(embeddings)
+
+
+@benchmark
+def bench_same_topic(n=30000):
+    """Next-post pick: category heuristic vs embedding-cluster draw."""
+    entries, embeddings, topic_of = corpus(n)
+    load(entries, embeddings)
+    start = time.perf_counter()
+    sw._cluster_embeddings()
+    report("k-means at load", (time.perf_counter() - start) * 1e3, "ms")
+
+    vectors = {link: np.asarray(v) for link, v in embeddings.items()}
+    currents = random.Random(7).sample(entries, 200)
+    original_random = random.random
+    # Force the same-topic branch every time so both modes are measured on it.
+    random.random = lambda: 0.5
+    try:
+        for mode in ("category", "cluster"):
+            sw.SAME_TOPIC_MODE = mode
+            picks = [
+                (cur, sw._pick_next_entry(entries, cur.link, set(), cur.categories, "", 0))
+                for cur in currents
+            ]
+            it = iter(currents * 2)
+
+            def pick():
+                cur = next(it)
+                sw._pick_next_entry(entries, cur.link, set(), cur.categories, "", 0)
+
+            report(f"{mode}: pick", timed(pick, repeat=len(currents)))
+            cos = [
+                float(
+                    vectors[a.link] @ vectors[b.link]
+                    / np.linalg.norm(vectors[a.link])
+                    / np.linalg.norm(vectors[b.link])
+                )
+                for a, b in picks
+            ]
+            same = sum(topic_of[a.link] == topic_of[b.link] for a, b in picks)
+            report(f"{mode}: mean cosine to current post", statistics.mean(cos), "")
+            report(f"{mode}: same ground-truth topic", 100 * same / len(picks), "%")
+    finally:
+        random.random = original_random
+        sw.SAME_TOPIC_MODE = "category"
+
+
+@benchmark
+def bench_deck_fill(n=30000):
+    """/api/deck refill of 10 posts: chained random picks vs MMR batch."""
+    entries, embeddings, _ = corpus(n)
+    load(entries, embeddings)
+    client = sw.app.test_client()
+    url = entries[0].link
+    try:
+        for mode in ("random", "mmr"):
+            sw.DECK_FILL_MODE = mode
+            report(
+                f"{mode}: GET /api/deck?count=10",
+                timed(lambda: client.get(f"/api/deck?count=10&url={url}"), repeat=20),
+            )
+    finally:
+        sw.DECK_FILL_MODE = "random"
+
+
+@benchmark
+def bench_store_writes(n=20000, writes=2000):
+    """Like, note and flag write throughput per storage backend."""
+    # The real paths are pointed into a scratch dir; sw is restored afterwards.
+    names = (
+        "PATH_LIKES", "PATH_FAVORITES_LEGACY", "PATH_LIKES_SNAPSHOT",
+        "PATH_LIKES_JOURNAL_LEGACY", "DIR_LIKES", "PATH_LIKES_BASE",
+        "PATH_LIKES_SHARD", "PATH_LIKES_JOURNAL", "PATH_NOTES", "PATH_FLAGGED",
+        "DIR_SQLITE_LOCAL", "STORE_BACKEND", "_store", "likes_dict",
+        "notes_dict", "flagged_content_dict",
+    )
+    saved = {name: getattr(sw, name) for name in names}
+    links = [f"https://blog{i}.example/post" for i in range(n)]
+    try:
+        for kind in ("json", "sqlite"):
+            with tempfile.TemporaryDirectory() as tmp:
+                for name, filename in (
+                    ("PATH_LIKES", "likes.json"),
+                    ("PATH_FAVORITES_LEGACY", "favorites.json"),
+                    ("PATH_LIKES_SNAPSHOT", "likes.snapshot.json"),
+                    ("PATH_LIKES_JOURNAL_LEGACY", "likes.journal"),
+                    ("DIR_LIKES", "likes.d"),
+                    ("PATH_LIKES_BASE", "likes.d/base.json"),
+                    ("PATH_LIKES_SHARD", f"likes.d/{sw.INSTANCE_ID}.json"),
+                    ("PATH_LIKES_JOURNAL", f"likes.d/{sw.INSTANCE_ID}.journal"),
+                    ("PATH_NOTES", "notes.json"),
+                    ("PATH_FLAGGED", "flagged_content.json"),
+                ):
+                    setattr(sw, name, os.path.join(tmp, filename))
+                # A populated site: the JSON store rewrites all of this per save.
+                now = datetime.now()
+                with open(sw.PATH_NOTES, "w", encoding="utf-8") as file:
+                    sw.json.dump({u: [["note", now.isoformat()]] for u in links}, file)
+                with open(sw.PATH_FLAGGED, "w", encoding="utf-8") as file:
+                    sw.json.dump({u: 1 for u in links}, file)
+                sw.DIR_SQLITE_LOCAL = tmp
+                sw._store = sw._open_store(kind)
+                sw.likes_dict = sw.load_likes()
+                sw.notes_dict = sw._store.load_notes()
+                sw.flagged_content_dict = sw._store.load_flags()
+                targets = iter(links * 2)
+
+                def like():
+                    sw._apply_like(next(targets), "👍")
+
+                def note():
+                    url = next(targets)
+                    sw.notes_dict.setdefault(url, []).append(("more", now))
+                    sw._store.save_notes(sw.notes_dict, [url])
+
+                def flag():
+                    url = next(targets)
+                    sw.flagged_content_dict[url] = sw.flagged_content_dict.get(url, 0) + 1
+                    sw._store.save_flags(sw.flagged_content_dict, [url])
+
+                for label, fn, count in (
+                    ("like", like, writes),
+                    # Whole-file JSON saves are slow enough that fewer runs do.
+                    ("note", note, writes if kind == "sqlite" else 20),
+                    ("flag", flag, writes if kind == "sqlite" else 20),
+                ):
+                    report(f"{kind}: {label} writes", 1e6 / timed(fn, repeat=count), "/s")
+                start = time.perf_counter()
+                sw._store.checkpoint()
+                report(f"{kind}: checkpoint", (time.perf_counter() - start) * 1e3, "ms")
+                sw._store.close()
+    finally:
+        for name, value in saved.items():
+            setattr(sw, name, value)
+
+
+@benchmark
+def bench_feed_export(n=30000):
+    """/feed: full export built whole vs streamed, and the polled first page."""
+    entries, embeddings, _ = corpus(n)
+    # Feed descriptions are full post HTML, not the one-liner corpus() gives.
+    body = "<p>" + "A paragraph of a small web post. " * 60 + "</p>"
+    entries = [e._replace(description=body) for e in entries]
+    load(entries, embeddings)
+    sw._update_corpus_version()
+    client = sw.app.test_client()
+    stream_min = sw.FEED_STREAM_MIN
+    try:
+        for label, threshold in (("built whole", n + 1), ("streamed", stream_min)):
+            sw.FEED_STREAM_MIN = threshold
+            tracemalloc.start()
+            start = time.perf_counter()
+            res = client.get("/feed?limit=all", buffered=False)
+            chunks = iter(res.response)
+            size = len(next(chunks))
+            ttfb = time.perf_counter() - start
+            size += sum(len(chunk) for chunk in chunks)
+            total = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            res.close()
+            report(f"{label}: time to first byte", ttfb * 1e3, "ms")
+            report(f"{label}: full body ({size >> 20} MiB)", total * 1e3, "ms")
+            report(f"{label}: peak traced memory", peak / 2**20, "MiB")
+    finally:
+        sw.FEED_STREAM_MIN = stream_min
+
+    sw._feed_cache.clear()
+    start = time.perf_counter()
+    etag = client.get("/feed").headers["ETag"]
+    report("first page, cold", (time.perf_counter() - start) * 1e3, "ms")
+    report("first page, cached", timed(lambda: client.get("/feed"), repeat=50))
+    report(
+        "first page, If-None-Match (304)",
+        timed(lambda: client.get("/feed", headers={"If-None-Match": etag}), repeat=50),
+    )
+
+
+def _legacy_registered_domain(url, suffixes):
+    """The pre-trie lookup: one joined candidate string per label."""
+    parsed_url = sw.urlparse(url)
+    netloc_parts = parsed_url.netloc.split(".")
+    for i in range(len(netloc_parts)):
+        possible_suffix = ".".join(netloc_parts[i:])
+        if possible_suffix in suffixes:
+            return ".".join(netloc_parts[:i]) + "." + possible_suffix
+    return parsed_url.netloc
+
+
+@benchmark
+def bench_domains(n=5000):
+    """Domain lookups: legacy flat set vs PSL trie, cold and memoized."""
+    with open("public_suffix_list.dat", encoding="utf-8") as f:
+        suffixes = {
+            line.strip() for line in f if line.strip() and not line.startswith("//")
+        }
+    rng = random.Random(3)
+    tails = ["com", "co.uk", "github.io", "blogspot.com", "kobe.jp", "substack.com", "dev"]
+    urls = [
+        f"https://{'www.' if rng.random() < 0.3 else ''}blog{i}.{rng.choice(tails)}/post/{i}"
+        for i in range(n)
+    ]
+    hosts = [sw.urlparse(u).hostname for u in urls]
+
+    def per_call(fn, items):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        return (time.perf_counter() - start) / len(items) * 1e6
+
+    report("legacy get_registered_domain + www strip", per_call(
+        lambda u: re.sub(r"^(www\.)?", "", _legacy_registered_domain(u, suffixes)), urls
+    ))
+    sw.display_domain.cache_clear()
+    report("display_domain, cold", per_call(sw.display_domain, urls))
+    report("display_domain, memoized", per_call(sw.display_domain, urls))
+    sw.registrable_domain.cache_clear()
+    report("registrable_domain (trie), cold", per_call(sw.registrable_domain, hosts))
+    report("registrable_domain (trie), memoized", per_call(sw.registrable_domain, hosts))
+
+
+@benchmark
+def bench_psl_startup():
+    """Import-time public suffix list load: text parse vs precompiled trie."""
+    import psl
+
+    source = "public_suffix_list.dat"
+    with open(source, encoding="utf-8") as f:
+        text = f.read()
+    report("legacy flat-set parse", timed(lambda: load_legacy_set(source), repeat=20) / 1e3, "ms")
+    report("psl.parse (text to trie)", timed(lambda: psl.parse(text), repeat=20) / 1e3, "ms")
+    psl.compile_artifact(source)
+    report("psl.load (artifact, hash checked)", timed(lambda: psl.load(source), repeat=20) / 1e3, "ms")
+
+    # Fresh interpreters, so nothing is warm: what a new worker pays.
+    script = "import time; t = time.perf_counter(); import psl; psl.load({!r}); print(time.perf_counter() - t)"
+    for label, setup in (("with artifact", None), ("without artifact", psl.artifact_path(source))):
+        runs = []
+        for _ in range(5):
+            if setup and os.path.exists(setup):
+                os.remove(setup)
+            out = subprocess.run(
+                [sys.executable, "-c", script.format(source)],
+                capture_output=True, text=True, check=True,
+            )
+            runs.append(float(out.stdout))
+        report(f"new process, {label}", statistics.median(runs) * 1e3, "ms")
+    psl.compile_artifact(source)
+
+
+@benchmark
+def bench_source_filter(n=30000):
+    """?source= / ?domain=: group-by index vs scanning the pool."""
+    entries, embeddings, _ = corpus(n)
+    # update_entries() fills in the card fields at ingest.
+    entries = [
+        e._replace(
+            feed_url=f"https://blog{i % 5000}.example/feed",
+            display_domain=sw.urlparse(e.link).netloc,
+        )
+        for i, e in enumerate(entries)
+    ]
+    entries = [sw._with_source_fields(e) for e in entries]
+    load(entries, embeddings)
+    start = time.perf_counter()
+    sw._rebuild_group_indexes()
+    report("build indexes at ingest", (time.perf_counter() - start) * 1e3, "ms")
+    scanned = list(entries)  # not indexed, so the filter scans it
+    for label, args in (("source", ("https://blog7.example/feed", "")), ("domain", ("", "blog7.example"))):
+        report(f"{label}: scan", timed(lambda: sw._apply_source_filter(scanned, *args), repeat=20))
+        report(f"{label}: index", timed(lambda: sw._apply_source_filter(entries, *args)))
+    client = sw.app.test_client()
+    sw._update_corpus_version()
+    report(
+        "/api/river?source=",
+        timed(lambda: client.get("/api/river?source=https://blog7.example/feed"), repeat=50),
+    )
+
+
+@benchmark
+def bench_fair_sampling(n=30000):
+    """_pick_unseen(): uniform vs source-fair (alias table) over the blog pool."""
+    entries, embeddings, _ = corpus(n)
+    # A long tail: feed k has about n / (k + 1) posts' worth of weight.
+    rng = random.Random(5)
+    entries = [
+        e._replace(feed_url=f"https://blog{int(rng.paretovariate(1.0))}.example/feed")
+        for e in entries
+    ]
+    load(entries, embeddings)
+    seen = {sw._hash_url(e.link) for e in entries[:50]}
+    saved = sw.SAMPLING_MODE
+    try:
+        for mode in ("uniform", "source"):
+            sw.SAMPLING_MODE = mode
+            start = time.perf_counter()
+            sw._rebuild_group_indexes()
+            report(f"{mode}: build at ingest", (time.perf_counter() - start) * 1e3, "ms")
+            report(f"{mode}: pick unseen", timed(lambda: sw._pick_unseen(entries, seen), repeat=50))
+    finally:
+        sw.SAMPLING_MODE = saved
+        sw._rebuild_group_indexes()
+
+
+@benchmark
+def bench_popular_sampling(n=300000):
+    """Popularity-weighted draws vs uniform, with likes landing between draws."""
+    now = datetime.now()
+    entries = [
+        sw.FeedEntry(f"https://blog{i}.example/", f"Post {i}", "A", "", now, [])
+        for i in range(n)
+    ]
+    rng = random.Random(11)
+    likes = {
+        e.link: {"👍": int(rng.paretovariate(1.2))} for e in rng.sample(entries, n // 20)
+    }
+    saved = {name: getattr(sw, name) for name in ("urls_cache", "likes_dict", "SAMPLING_MODE")}
+    try:
+        sw.urls_cache, sw.likes_dict, sw.SAMPLING_MODE = entries, likes, "popular"
+        start = time.perf_counter()
+        sw._rebuild_popularity()
+        report("build tree (once per refresh)", (time.perf_counter() - start) * 1e3, "ms")
+        _, tree, _ = sw._popularity_trees[id(entries)]
+        seen = {sw._hash_url(e.link) for e in entries[:50]}
+        report("uniform: random.choice", timed(lambda: random.choice(entries), repeat=2000))
+        sw.SAMPLING_MODE = "uniform"
+        report("uniform: _pick_unseen", timed(lambda: sw._pick_unseen(entries, seen), repeat=3) / 1e3, "ms")
+        sw.SAMPLING_MODE = "popular"
+        report("popular: Fenwick draw", timed(lambda: sw._popular_choice(entries), repeat=2000))
+        report("popular: _pick_unseen", timed(lambda: sw._pick_unseen(entries, seen), repeat=2000))
+        report(
+            "popular: reweight one post (a like)",
+            timed(lambda: tree.set(rng.randrange(n), rng.uniform(1, 5)), repeat=2000),
+        )
+        # What a pass over the pool would cost if weights were built per request.
+        report(
+            "popular: weighted pass over the pool",
+            timed(lambda: sw._popular_choice(list(entries)), repeat=5) / 1e3,
+            "ms",
+        )
+    finally:
+        for name, value in saved.items():
+            setattr(sw, name, value)
+        sw._popularity_trees = {}
+
+
+def _uss_kib(pid):
+    """Unique set size: the pages only this process maps."""
+    total = 0
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                total += int(line.split()[1])
+    return total
+
+
+def _serve(entries):
+    """A worker's first minutes: draw posts, then a full collection."""
+    for _ in range(200):
+        sw._pick_unseen(entries, set())
+    gc.collect()
+
+
+def _fork_worker(entries, reload):
+    ready_r, ready_w = os.pipe()
+    stop_r, stop_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        if reload:
+            # What a follower does when the fetcher publishes a new corpus:
+            # every pool is unpickled into pages of its own.
+            sw._snapshot_stat = None
+            sw.load_snapshot()
+            entries = sw.urls_cache
+        _serve(entries)
+        os.write(ready_w, b"1")
+        os.read(stop_r, 1)
+        os._exit(0)
+    os.read(ready_r, 1)
+    return pid, stop_w
+
+
+def _fork_workers(entries, workers, reload=False):
+    """USS of each forked worker, measured while all of them are alive."""
+    forked = [_fork_worker(entries, reload) for _ in range(workers)]
+    sizes = [_uss_kib(pid) for pid, _ in forked]
+    for pid, stop in forked:
+        os.write(stop, b"1")
+        os.waitpid(pid, 0)
+    return sizes
+
+
+@benchmark
+def bench_preload_uss(n=30000, workers=4):
+    """Per-worker unique memory at four workers: import per worker vs SW_PRELOAD."""
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        print("  needs /proc/<pid>/smaps_rollup (Linux)")
+        return
+    # Without preload every worker imports sw and loads its own corpus.
+    script = (
+        "import sys, bench\n"
+        f"entries, embeddings, _ = bench.corpus({n})\n"
+        "bench.load(entries, embeddings)\n"
+        "bench.sw._rebuild_group_indexes()\n"
+        "bench._serve(entries)\n"
+        "print(flush=True)\n"
+        "sys.stdin.read()\n"
+    )
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "-c", script],
+            cwd=APP_DIR, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        )
+        for _ in range(workers)
+    ]
+    for proc in procs:
+        proc.stdout.readline()
+    sizes = [_uss_kib(proc.pid) for proc in procs]
+    for proc in procs:
+        proc.stdin.close()
+        proc.wait()
+    report("import per worker: USS per worker", statistics.median(sizes) / 1024, "MiB")
+    report(f"import per worker: USS, {workers} workers", sum(sizes) / 1024, "MiB")
+
+    # Preloaded: the master loads once, publishes the snapshot and forks.
+    # Followers keep the master's pages until the fetcher publishes a
+    # changed corpus, so both sides of a reload are measured.
+    entries, embeddings, _ = corpus(n)
+    saved = sw.urls_cache, sw.SHARED_DIR
+    sw.SHARED_DIR = tempfile.mkdtemp(prefix="sw-bench-shared-")
+    try:
+        load(entries, embeddings)
+        sw._install_corpus()
+        sw.write_snapshot()
+        gc.collect()
+        sizes = _fork_workers(entries, workers)
+        report("preload: USS per worker", statistics.median(sizes) / 1024, "MiB")
+        gc.freeze()
+        try:
+            sizes = _fork_workers(entries, workers)
+            reloaded = _fork_workers(entries, workers, reload=True)
+        finally:
+            gc.unfreeze()
+        report("preload + gc.freeze: USS per worker", statistics.median(sizes) / 1024, "MiB")
+        report(f"preload + gc.freeze: USS, {workers} workers", sum(sizes) / 1024, "MiB")
+        report("preload, snapshot reloaded: USS per worker", statistics.median(reloaded) / 1024, "MiB")
+    finally:
+        shutil.rmtree(sw.SHARED_DIR, ignore_errors=True)
+        sw.urls_cache, sw.SHARED_DIR = saved
+        sw._install_corpus()
+
+
+def load_legacy_set(path):
+    suffixes = set()
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("//"):
+                suffixes.add(line)
+    return suffixes
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            sys.exit(f"unknown benchmark {name!r}; have {', '.join(BENCHMARKS)}")
+        print(f"{name}: {BENCHMARKS[name].__doc__.strip()}")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
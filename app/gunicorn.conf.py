@@ -0,0 +1,27 @@
+"""gunicorn settings read from the working directory.
+
+With SW_PRELOAD=1 the master imports sw once, loading the corpus, the
+embedding matrix and the public suffix trie before it forks, and each worker
+then starts its own user data, threads and scheduler in post_worker_init.
+Use SW_PRELOAD rather than --preload so sw knows which of the two it is in.
+"""
+import itertools
+import os
+
+preload_app = os.environ.get("SW_PRELOAD") == "1"
+
+
+def pre_fork(server, worker):
+    # worker.age counts spawns, so a respawned worker never gets its
+    # predecessor's. Take the lowest slot no live worker holds instead: 1..N
+    # on every start, and a replacement inherits the slot of the one it
+    # replaces. The master reaps dead workers before it forks new ones.
+    taken = {getattr(w, "sw_slot", None) for w in server.WORKERS.values()}
+    worker.sw_slot = next(n for n in itertools.count(1) if n not in taken)
+
+
+def post_worker_init(worker):
+    if preload_app:
+        import sw
+
+        sw.start_worker(worker.sw_slot)
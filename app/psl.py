@@ -0,0 +1,117 @@
+"""Public suffix list, compiled into a reversed-label trie.
+
+Lives outside sw.py so the image build can precompile the list without
+importing the app, which fetches every feed at import:
+
+    python psl.py public_suffix_list.dat
+
+That writes `public_suffix_list.dat.trie` next to the source, tagged with the
+source's SHA-256. load() uses the artifact while the hash matches and falls
+back to parsing the text (and rewriting the artifact) when it does not.
+"""
+import hashlib
+import logging
+import marshal
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Trie shape: {"uk": {"co": {"": PSL_RULE}}}. The "" key marks the end of a
+# rule. PSL wildcards only ever appear as the leftmost label, so a "*" child
+# is always a leaf.
+PSL_RULE = 1
+PSL_EXCEPTION = 2
+# Bump when the trie shape changes, so stale artifacts are rebuilt.
+ARTIFACT_FORMAT = 1
+
+
+def artifact_path(path):
+    return path + ".trie"
+
+
+def parse(text):
+    """Compile the text of public_suffix_list.dat into a trie."""
+    trie = {}
+    for line in text.splitlines():
+        rule = line.split(None, 1)[0] if line.strip() else ""
+        if not rule or rule.startswith("//"):
+            continue
+        exception = rule.startswith("!")
+        node = trie
+        for label in reversed(rule.lstrip("!").lower().split(".")):
+            node = node.setdefault(label, {})
+        node[""] = PSL_EXCEPTION if exception else PSL_RULE
+    return trie
+
+
+def _write_artifact(path, digest, trie):
+    target = artifact_path(path)
+    tmp = f"{target}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(marshal.dumps((ARTIFACT_FORMAT, digest, trie)))
+    os.replace(tmp, target)
+
+
+def compile_artifact(path):
+    """Parse `path` and write its artifact. Returns the trie."""
+    with open(path, "rb") as f:
+        source = f.read()
+    trie = parse(source.decode("utf-8"))
+    _write_artifact(path, hashlib.sha256(source).hexdigest(), trie)
+    return trie
+
+
+def load(path):
+    """The trie for `path`, from its artifact when that is current."""
+    with open(path, "rb") as f:
+        source = f.read()
+    digest = hashlib.sha256(source).hexdigest()
+    try:
+        # loads() on the whole file: marshal.load() reads a file object in
+        # tiny chunks and is several times slower.
+        with open(artifact_path(path), "rb") as f:
+            fmt, artifact_digest, trie = marshal.loads(f.read())
+        if fmt == ARTIFACT_FORMAT and artifact_digest == digest:
+            return trie
+        logger.info("Public suffix artifact is stale, recompiling")
+    except FileNotFoundError:
+        pass
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        logger.warning("Cannot read public suffix artifact: %s", e)
+
+    trie = parse(source.decode("utf-8"))
+    try:
+        _write_artifact(path, digest, trie)
+    except OSError as e:
+        # A read-only image still works; it just parses on every start.
+        logger.warning("Cannot write public suffix artifact: %s", e)
+    return trie
+
+
+def public_suffix_length(trie, labels):
+    """Number of trailing labels of `labels` that form the public suffix.
+
+    The PSL algorithm: the longest matching rule wins, a wildcard matches any
+    one label, an exception rule overrides everything and makes its parent
+    the suffix, and an unlisted TLD is a suffix by the implicit "*" rule.
+    """
+    node, match = trie, 1
+    for depth, label in enumerate(reversed(labels), 1):
+        if "*" in node:
+            match = depth
+        node = node.get(label)
+        if node is None:
+            break
+        kind = node.get("")
+        if kind == PSL_EXCEPTION:
+            return depth - 1
+        if kind == PSL_RULE:
+            match = depth
+    return match
+
+
+if __name__ == "__main__":
+    for source_path in sys.argv[1:] or ["public_suffix_list.dat"]:
+        compile_artifact(source_path)
+        print(f"wrote {artifact_path(source_path)}")
@@ -20,7 +20,7 @@
   const parsedSeenMax = parseInt(
     document.querySelector('meta[name="sw-seen-max"]')?.content || '', 10
   );
-  const SEEN_MAX = Number.isFinite(parsedSeenMax) ? parsedSeenMax : 100;
+  const SEEN_MAX = Number.isFinite(parsedSeenMax) ? parsedSeenMax : 300;
   const HISTORY_MAX = 50;      // cached posts kept for Back; older ones reload
   const QUEUE_TARGET = 3;      // posts to keep queued ahead of the current one
   const QUEUE_REFILL_AT = 2;   // refill once the queue drops to this
@@ -301,6 +301,27 @@
 
   }
 
+  const SEEN_ALPHABET =
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_';
+
+  // Same formats as seen-cookie.js and sw.py _parse_seen().
+  function parseSeen(raw) {
+    if (raw.startsWith('1.')) {
+      return (raw.slice(2).match(/.{3}/g) || []).filter((t) => /^[\w-]{3}$/.test(t));
+    }
+    return raw.split(',').flatMap((item) => {
+      if (/^[0-9a-f]{8}$/.test(item)) {
+        const code = parseInt(item.slice(0, 5), 16) >> 2;
+        return [
+          SEEN_ALPHABET[code >> 12] +
+            SEEN_ALPHABET[(code >> 6) & 63] +
+            SEEN_ALPHABET[code & 63],
+        ];
+      }
+      return /^[\w-]{3}$/.test(item) ? [item] : [];
+    });
+  }
+
   function markSeen(hash) {
     if (!hash) return;
     const raw = document.cookie
@@ -312,11 +333,10 @@
     } catch {
       value = '';
     }
-    const list = value.split(',').filter(Boolean);
-    const next = list.filter((h) => h !== hash);
+    const next = parseSeen(value).filter((h) => h !== hash);
     next.push(hash);
     const trimmed = next.slice(-SEEN_MAX);
-    document.cookie = `seen=${trimmed.join(',')};path=/;max-age=86400;SameSite=Lax`;
+    document.cookie = `seen=1.${trimmed.join('')};path=/;max-age=86400;SameSite=Lax`;
   }
 
   function swapPanel(panel) {
@@ -11,15 +11,37 @@
   if (!meta || !meta.content) return;
   const hash = meta.content;
   const maxRaw = document.querySelector('meta[name="sw-seen-max"]');
-  const max = Math.max(1, parseInt(maxRaw && maxRaw.content, 10) || 100);
+  const max = Math.max(1, parseInt(maxRaw && maxRaw.content, 10) || 300);
+
+  const ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_';
+
+  // Mirrors sw.py _parse_seen(): "1." + 3-char tokens, or the legacy
+  // comma-joined 8-hex hashes, whose first five digits hold the same 18 bits.
+  function parseSeen(raw) {
+    if (raw.startsWith('1.')) {
+      return (raw.slice(2).match(/.{3}/g) || []).filter((t) => /^[\w-]{3}$/.test(t));
+    }
+    return raw.split(',').flatMap((item) => {
+      if (/^[0-9a-f]{8}$/.test(item)) {
+        const code = parseInt(item.slice(0, 5), 16) >> 2;
+        return [ALPHABET[code >> 12] + ALPHABET[(code >> 6) & 63] + ALPHABET[code & 63]];
+      }
+      return /^[\w-]{3}$/.test(item) ? [item] : [];
+    });
+  }
 
   function update() {
     const m = document.cookie.match(/(?:^|;\s*)seen=([^;]*)/);
-    const raw = m ? decodeURIComponent(m[1]) : '';
-    const list = raw ? raw.split(',').filter(x => x && x !== hash) : [];
+    let raw = '';
+    try {
+      raw = m ? decodeURIComponent(m[1]) : '';
+    } catch {
+      raw = '';
+    }
+    const list = parseSeen(raw).filter(x => x !== hash);
     list.push(hash);
     while (list.length > max) list.shift();
-    document.cookie = 'seen=' + list.join(',') + ';path=/;max-age=86400;SameSite=Lax';
+    document.cookie = 'seen=1.' + list.join('') + ';path=/;max-age=86400;SameSite=Lax';
   }
 
   if (document.prerendering) {
@@ -1,12 +1,27 @@
 import atexit
+import base64
+import bisect
+import fcntl
+import gc
 import hashlib
+import gzip
 import json
 import logging
 import os
+import pickle
+import queue
 import random
 import re
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
 import unicodedata
+import uuid
 from collections import OrderedDict
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
 from html import escape
 from typing import NamedTuple
@@ -17,6 +32,7 @@ import numpy as np
 import requests
 from apscheduler.schedulers.background import BackgroundScheduler
 from feedwerk.atom import AtomFeed
+from feedwerk.atom import FeedEntry as AtomEntry
 from flask import (
     Flask,
     Response,
@@ -28,6 +44,8 @@ from flask import (
 )
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+import psl
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -47,6 +65,15 @@ class FeedEntry(NamedTuple):
     search_title_tokens: frozenset = frozenset()
     search_rest_tokens: frozenset = frozenset()
     search_link: str = ""
+    # Precomputed river card fields, built in update_entries() alongside the
+    # search fields; only the relative date is left for river() to format.
+    display_domain: str = ""
+    excerpt: str = ""
+    badge: tuple = None  # (slug, label, emoji) of the first non-spam category
+    river_query: str = ""  # "url=<link>", the card's link into the main view
+    # From the feed registry, so re-derived when the feed lists change.
+    source_name: str = ""  # the registry's name for the post's feed, if any
+    more_query: str = ""  # "source=…" or "domain=…" for "More from this blog"
 
 
 API_BASE = "https://kagi.com/api/v1/smallweb/feed"
@@ -285,8 +312,43 @@ CATEGORY_GROUPS = OrderedDict(
 # Remap legacy category slugs from the feed API
 CATEGORY_REMAP = {"sysadmin": "infra", "security": "infra"}
 
-liked_feed = None  # Initialize the variable to store the liked Atom feed
-opml_cache = None  # will hold generated OPML xml
+# Serialized liked Atom feed as (_liked_version it was built from, xml).
+_liked_feed_cache = None
+_liked_version = 0  # bumped whenever the set of liked posts changes
+_liked_modified = datetime.now(timezone.utc).replace(microsecond=0)
+# Content fingerprint of every feed pool, recomputed by update_all(). Equal
+# pools give equal versions, so ETags agree across instances and restarts.
+_corpus_version = ""
+_corpus_modified = datetime.now(timezone.utc).replace(microsecond=0)
+# (kind, cat) -> (version, xml, gzipped xml) for the first page of each
+# /feed variant, which is what pollers fetch.
+_feed_cache = {}
+# (kind, cat, river) -> (version, entries newest first, negated timestamps).
+_feed_orders = {}
+# Group-by indexes over the feed pools, rebuilt at ingest so ?source= and
+# ?domain= cost O(matches): id(pool) -> (pool, {normalize_feed_url(via link):
+# rows}, {registrable domain of the post: rows}). Holding the pool keeps its
+# id from being reused.
+_group_indexes = {}
+# Source-fair sampling (SAMPLING_MODE=source), also rebuilt at ingest: id(pool)
+# -> (pool, Vose alias table probabilities, aliases) with post i weighted
+# 1 / (posts from its source), and link -> that weight for every indexed post.
+_alias_tables = {}
+_source_weights = {}
+# id(pool) -> (pool, uint32 array of each post's _seen_code()), for
+# _seen_mask().
+_pool_seen_codes = {}
+# id(pool) -> (pool, link -> row), for membership checks on single posts.
+_pool_rows = {}
+# Curated feed lists, reloaded by refresh_feed_lists() only when the files
+# change: kind -> [FeedSource] in file order, normalize_feed_url() -> FeedSource,
+# host -> its first FeedSource, and the /opml variants keyed by mode ("" for
+# all) as (etag, xml, gzipped xml).
+feed_lists = {}
+feed_registry = {}
+feed_hosts = {}
+_feed_lists_digest = ""
+_opml_cache = {}
 
 # NOTE(z64): List of emotes that can be used for likes.
 # Used to build the list in the template, and perform validation on the server.
@@ -309,7 +371,14 @@ like_emoji_list = [
 
 # --- Backend seen-cookie dedup ------------------------------------------------
 SEEN_COOKIE = "seen"
-SEEN_MAX = 100
+# Each seen post is an 18-bit URL hash written as 3 base64url characters after
+# a version prefix, so 300 posts fit in the ~900 bytes the old comma-joined
+# 8-hex format spent on 100. At 300 hashes in a 2**18 space, about 0.1% of
+# unseen posts look seen, which only makes them a little less likely.
+SEEN_MAX = 300
+SEEN_COOKIE_VERSION = "1."
+_SEEN_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+_SEEN_CODES = {c: i for i, c in enumerate(_SEEN_ALPHABET)}
 
 
 def _https_url(link):
@@ -326,23 +395,81 @@ def _urls_match(left, right):
     return _url_key(left) == _url_key(right)
 
 
+def _seen_code(url):
+    """18-bit hash of a post URL: the top bits of its MD5."""
+    return int.from_bytes(hashlib.md5(_url_key(url).encode()).digest()[:3], "big") >> 6
+
+
+def _seen_token(code):
+    return (
+        _SEEN_ALPHABET[code >> 12]
+        + _SEEN_ALPHABET[(code >> 6) & 63]
+        + _SEEN_ALPHABET[code & 63]
+    )
+
+
+def _token_code(token):
+    return (_SEEN_CODES[token[0]] << 12) | (_SEEN_CODES[token[1]] << 6) | _SEEN_CODES[token[2]]
+
+
 def _hash_url(url):
-    """8-char hex hash for compact cookie storage."""
-    return hashlib.md5(_url_key(url).encode()).hexdigest()[:8]
+    """3-char seen-cookie token for a post URL."""
+    return _seen_token(_seen_code(url))
+
+
+def _parse_seen(raw):
+    """Seen tokens from a cookie value, oldest first.
+
+    Reads the versioned format and the legacy comma-joined one, whose 8-hex
+    MD5 prefixes carry the same 18 bits in their first five digits.
+    """
+    if raw.startswith(SEEN_COOKIE_VERSION):
+        packed = raw[len(SEEN_COOKIE_VERSION):]
+        tokens = [packed[i:i + 3] for i in range(0, len(packed) - 2, 3)]
+        return [t for t in tokens if all(c in _SEEN_CODES for c in t)]
+    tokens = []
+    for item in raw.split(","):
+        if len(item) == 8:
+            try:
+                tokens.append(_seen_token(int(item[:5], 16) >> 2))
+            except ValueError:
+                pass
+        elif len(item) == 3 and all(c in _SEEN_CODES for c in item):
+            tokens.append(item)
+    return tokens
 
 
 def _get_seen(req):
-    """Read seen hashes from cookie as a set."""
-    raw = req.cookies.get(SEEN_COOKIE, "")
-    return set(raw.split(",")) if raw else set()
+    """Read seen tokens from cookie as a set."""
+    return set(_parse_seen(req.cookies.get(SEEN_COOKIE, "")))
+
+
+def _seen_mask(cache, seen):
+    """Boolean array: which posts of `cache` have their token in `seen`.
+
+    An indexed pool, or a _Subset of one, uses its precomputed hash array,
+    so the check is one vectorized lookup instead of hashing every URL per
+    request.
+    """
+    base, rows, _ = _origin(cache)
+    indexed = _pool_seen_codes.get(id(base))
+    if indexed is not None and indexed[0] is base:
+        codes = indexed[1] if rows is None else indexed[1][rows]
+    else:
+        codes = np.fromiter((_seen_code(e.link) for e in cache), np.uint32, len(cache))
+    wanted = np.fromiter((_token_code(t) for t in seen), np.uint32, len(seen))
+    return np.isin(codes, wanted)
 
 
 def _pick_unseen(cache, seen):
-    """Pick random entry not in seen set. Falls back to random.choice if all seen."""
-    candidates = [e for e in cache if _hash_url(e.link) not in seen]
-    if not candidates:
-        candidates = cache
-    return random.choice(candidates)
+    """Pick random entry not in seen set. Falls back to any entry if all seen."""
+    if SAMPLING_MODE in ("source", "popular"):
+        entry = _weighted_choice(cache, lambda e: _hash_url(e.link) not in seen)
+        return entry if entry is not None else _weighted_choice(cache)
+    unseen = np.flatnonzero(~_seen_mask(cache, seen))
+    if not len(unseen):
+        return random.choice(cache)
+    return cache[unseen[random.randrange(len(unseen))]]
 
 
 def _is_prefetch():
@@ -360,16 +487,25 @@ def _set_seen_cookie(response, seen, new_url):
     if _is_prefetch():
         return response
     h = _hash_url(new_url)
-    seen_list = [x for x in seen if x and x != h]
+    # The request cookie gives the order, so the oldest are the ones dropped.
+    ordered = _parse_seen(request.cookies.get(SEEN_COOKIE, ""))
+    seen_list = [x for x in ordered if x in seen and x != h]
+    seen_list += sorted(set(seen) - set(seen_list) - {h})
     seen_list.append(h)
     if len(seen_list) > SEEN_MAX:
         seen_list = seen_list[-SEEN_MAX:]
-    response.set_cookie(SEEN_COOKIE, ",".join(seen_list), max_age=86400, samesite="Lax")
+    response.set_cookie(
+        SEEN_COOKIE,
+        SEEN_COOKIE_VERSION + "".join(seen_list),
+        max_age=86400,
+        samesite="Lax",
+    )
     return response
 
 
 # --- Embeddings for "Show similar" ------------------------------------------
 embeddings_cache = {}  # url → set (for membership checks only)
+_emb_digest = ""  # of the /embeddings body behind _emb_matrix
 _emb_matrix = None     # normalized numpy matrix (N x dim), float32
 _emb_urls = []         # url list aligned with matrix rows
 _emb_url_to_idx = {}   # url → row index
@@ -390,51 +526,183 @@ def _build_embedding_matrix(emb):
 
 def update_embeddings():
     """Fetch pre-computed embeddings from the API."""
-    global embeddings_cache
+    global embeddings_cache, _emb_digest
     try:
         resp = requests.get(
             API_BASE + "/embeddings", timeout=30
         )
         resp.raise_for_status()
+        digest = hashlib.blake2b(resp.content, digest_size=16).hexdigest()
+        if digest == _emb_digest and _emb_matrix is not None:
+            return
         data = resp.json()
         emb = data.get("embeddings", {})
         if emb:
             embeddings_cache = emb
             _build_embedding_matrix(emb)
+            _emb_digest = digest
             logger.info("Loaded %d embeddings", len(emb))
+            _start_clustering()
     except Exception as e:
         logger.error("Failed to fetch embeddings: %s", e)
 
 
-def find_similar(url, seen, cache):
-    """Find the most similar unseen entry to `url` using cached embeddings."""
-    idx = _emb_url_to_idx.get(url)
-    if idx is None or _emb_matrix is None:
+# --- Embedding clusters for the same-topic next-post bias -------------------
+# "category" filters the pool by shared category tags; "cluster" draws from the
+# current post's k-means cluster over _emb_matrix and falls back to categories
+# when that draw comes up empty.
+SAME_TOPIC_MODE = os.environ.get("SAME_TOPIC_MODE", "category")
+EMB_CLUSTER_MAX = 256
+EMB_CLUSTER_ITERS = 8
+# Random cluster members tried before giving up on the cluster for this pick.
+EMB_CLUSTER_DRAWS = 8
+
+# (url → row, row → url, row → cluster id, cluster id → member rows). Published
+# as one tuple so a pick never mixes rows from two embedding loads.
+_emb_clusters = None
+_emb_cluster_lock = threading.Lock()
+
+
+def _kmeans(mat, k, iters=EMB_CLUSTER_ITERS, seed=0, chunk=8192):
+    """Spherical k-means over unit-norm rows. Returns the row labels."""
+    rng = np.random.default_rng(seed)
+    centroids = mat[rng.choice(len(mat), k, replace=False)].copy()
+    labels = np.empty(len(mat), dtype=np.int32)
+    for _ in range(iters):
+        # Chunked so the (rows x k) score block stays small at 300k rows.
+        for start in range(0, len(mat), chunk):
+            block = mat[start : start + chunk] @ centroids.T
+            labels[start : start + chunk] = np.argmax(block, axis=1)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=k)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.add.reduceat(mat[order], starts[filled], axis=0)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        # Empty clusters keep their previous centroid.
+        centroids[filled] = sums / norms
+    return labels
+
+
+def _cluster_embeddings():
+    """Cluster the current embedding matrix and publish it to _emb_clusters.
+
+    Runs on a background thread after each embedding load. A load that lands
+    while a clustering is still running is skipped; the next one catches up.
+    """
+    global _emb_clusters
+    if not _emb_cluster_lock.acquire(blocking=False):
+        return
+    try:
+        mat, urls, url_to_idx = _emb_matrix, _emb_urls, _emb_url_to_idx
+        if mat is None or not len(mat):
+            return
+        k = max(1, min(EMB_CLUSTER_MAX, int((len(mat) / 2) ** 0.5)))
+        labels = _kmeans(mat, k)
+        order = np.argsort(labels, kind="stable")
+        members = np.split(order, np.cumsum(np.bincount(labels, minlength=k))[:-1])
+        _emb_clusters = (url_to_idx, urls, labels, members)
+        logger.info("Clustered %d embeddings into %d clusters", len(mat), k)
+    except Exception as e:
+        logger.error("Failed to cluster embeddings: %s", e)
+    finally:
+        _emb_cluster_lock.release()
+
+
+def _start_clustering():
+    """Cluster the embeddings just loaded, on a background thread.
+
+    Not in a preloading gunicorn master: a worker forked while the thread
+    held _emb_cluster_lock would never see it released. start_worker()
+    clusters after the fork instead.
+    """
+    if SAME_TOPIC_MODE == "cluster" and not _preload_master:
+        threading.Thread(target=_cluster_embeddings, name="emb-kmeans", daemon=True).start()
+
+
+def _pick_same_cluster(url, candidates):
+    """Random entry of `candidates` from `url`'s embedding cluster, or None.
+
+    Draws cluster members directly and checks only the drawn ones against
+    `candidates`, so the cost per pick does not grow with the pool.
+    """
+    clusters = _emb_clusters
+    if clusters is None:
+        return None
+    url_to_idx, urls, labels, members = clusters
+    idx = url_to_idx.get(url)
+    if idx is None:
+        return None
+    rows = members[labels[idx]]
+    if len(rows) < 2:
         return None
+    eligible = _member_lookup(candidates)
+    for _ in range(EMB_CLUSTER_DRAWS):
+        entry = eligible(urls[rows[random.randrange(len(rows))]])
+        if entry is not None:
+            return entry
+    return None
+
 
-    scores = _emb_matrix @ _emb_matrix[idx]
-    scores[idx] = -1.0  # exclude self
+def find_similar_batch(urls, seen, cache, limit=1):
+    """Rank the nearest unseen entries in `cache` for each URL in `urls`.
 
+    All query rows are scored with one matrix product. Returns a list aligned
+    with `urls`; each item holds up to `limit` (entry, score) pairs, best first,
+    and is empty for a URL without an embedding. A row never returns its own
+    URL, so the result for one URL is the same whether it is asked alone or in
+    a batch.
+    """
+    results = [[] for _ in urls]
+    if _emb_matrix is None:
+        return results
+    rows = [
+        (pos, _emb_url_to_idx[u]) for pos, u in enumerate(urls) if u in _emb_url_to_idx
+    ]
+    if not rows:
+        return results
+
+    scores = _emb_matrix[[idx for _, idx in rows]] @ _emb_matrix.T
     entry_map = {e.link: e for e in cache}
-    order = np.argsort(scores)[::-1]
-    for i in order:
-        candidate_url = _emb_urls[i]
-        if candidate_url not in entry_map:
-            continue
-        if _hash_url(candidate_url) not in seen:
-            return entry_map[candidate_url]
+    for (pos, idx), row in zip(rows, scores):
+        row[idx] = -1.0  # exclude self
+        ranked = results[pos]
+        for i in np.argsort(row)[::-1]:
+            if i == idx:
+                continue
+            candidate_url = _emb_urls[i]
+            if candidate_url not in entry_map:
+                continue
+            if _hash_url(candidate_url) not in seen:
+                ranked.append((entry_map[candidate_url], float(row[i])))
+                if len(ranked) >= limit:
+                    break
+    return results
 
-    return None
+
+def find_similar(url, seen, cache):
+    """Find the most similar unseen entry to `url` using cached embeddings."""
+    ranked = find_similar_batch([url], seen, cache)[0]
+    return ranked[0][0] if ranked else None
 
 
 def generate_liked_feed():
-    """Generate Atom feed for liked posts."""
-    global liked_feed
-    liked_feed = AtomFeed(
+    """Serialized Atom feed for liked posts.
+
+    Built on first request and reused until the liked set changes, so a
+    reaction never pays for serializing the feed.
+    """
+    global _liked_feed_cache
+    version = _liked_version
+    cached = _liked_feed_cache
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    feed = AtomFeed(
         "Kagi Small Web Liked", feed_url="https://kagi.com/smallweb/liked"
     )
-    for entry in urls_liked_cache:
-        liked_feed.add(
+    for entry in list(urls_liked_cache):
+        feed.add(
             title=entry.title,
             content=entry.description,
             content_type="html",
@@ -442,6 +710,9 @@ def generate_liked_feed():
             updated=entry.updated,
             author=entry.author,
         )
+    xml = feed.to_string()
+    _liked_feed_cache = (version, xml)
+    return xml
 
 
 def _find_feed_file(name):
@@ -452,84 +723,173 @@ def _find_feed_file(name):
     return None
 
 
-def _build_opml_outline(feed_url):
-    """Build an OPML outline element from a simple feed URL."""
-    parsed = urlparse(feed_url)
-    domain = parsed.hostname or ""
-    domain = domain.removeprefix("www.")
-    html_url = f"{parsed.scheme}://{parsed.hostname}"
-    safe = escape(domain, quote=True)
+class FeedSource(NamedTuple):
+    """One row of the curated feed lists."""
+
+    feed_url: str
+    kind: str  # "blogs", "yt" or "comic", the FEED_LISTS key it came from
+    name: str  # channel name from smallyt.txt comments, "" for other lists
+    html_url: str
+    host: str  # lowercase, without "www."
+
+
+@lru_cache(maxsize=65536)
+def normalize_feed_url(url):
+    """Registry key for a feed URL: scheme, "www.", default port, case of the
+    host and a trailing slash don't tell two feeds apart."""
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or "").removeprefix("www.")
+    if parsed.port and parsed.port not in (80, 443):
+        host += f":{parsed.port}"
+    key = host + parsed.path.rstrip("/")
+    return key + "?" + parsed.query if parsed.query else key
+
+
+def _blog_list_rows(kind, text):
+    """Rows of a one-URL-per-line feed list (smallweb.txt, smallcomic.txt)."""
+    for line in text.splitlines():
+        feed_url = line.split("#")[0].strip()
+        if feed_url:
+            parsed = urlparse(feed_url)
+            yield FeedSource(
+                feed_url,
+                kind,
+                "",
+                f"{parsed.scheme}://{parsed.hostname}",
+                (parsed.hostname or "").removeprefix("www."),
+            )
+
+
+def _yt_list_rows(kind, text):
+    """Rows of smallyt.txt — format: URL # Channel Name https://..."""
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split("#", 1)
+        feed_url = parts[0].strip()
+        if not feed_url:
+            continue
+        # Extract channel name and URL from comment
+        title = "YouTube"
+        html_url = "https://www.youtube.com"
+        if len(parts) > 1:
+            comment = parts[1].strip()
+            # "Channel Name https://www.youtube.com/channel/XXX"
+            idx = comment.find("https://")
+            if idx > 0:
+                title = comment[:idx].strip()
+                html_url = comment[idx:].strip()
+            elif comment:
+                title = comment.strip()
+        host = (urlparse(feed_url).hostname or "").removeprefix("www.")
+        yield FeedSource(feed_url, kind, title, html_url, host)
+
+
+# Curated feed lists: kind -> (file, row parser, OPML title suffix). Also the
+# /opml?mode= values; no mode means all of them, in this order.
+FEED_LISTS = {
+    "blogs": ("smallweb.txt", _blog_list_rows, ""),
+    "yt": ("smallyt.txt", _yt_list_rows, " (YouTube)"),
+    "comic": ("smallcomic.txt", _blog_list_rows, " (Comics)"),
+}
+
+
+def _read_feed_lists():
+    """{kind: file bytes} for every FEED_LISTS file that exists."""
+    sources = {}
+    for kind, (name, _, _) in FEED_LISTS.items():
+        path = _find_feed_file(name)
+        if path:
+            with open(path, "rb") as f:
+                sources[kind] = f.read()
+    return sources
+
+
+def parse_feed_lists(sources):
+    """{kind: [FeedSource]} for the file contents from _read_feed_lists()."""
+    return {
+        kind: list(FEED_LISTS[kind][1](kind, data.decode("utf-8")))
+        for kind, data in sources.items()
+    }
+
+
+def feed_source(entry):
+    """Registry row for the feed a post came from (its rel="via" link), or None."""
+    if not entry.feed_url:
+        return None
+    return feed_registry.get(normalize_feed_url(entry.feed_url))
+
+
+def _build_opml_outline(source):
+    """Build an OPML outline element from a registry row."""
+    safe = escape(source.name or source.host, quote=True)
     return (
         f'    <outline text="{safe}" title="{safe}" '
-        f'type="rss" xmlUrl="{escape(feed_url, quote=True)}" '
-        f'htmlUrl="{escape(html_url, quote=True)}"/>'
+        f'type="rss" xmlUrl="{escape(source.feed_url, quote=True)}" '
+        f'htmlUrl="{escape(source.html_url, quote=True)}"/>'
     )
 
 
-def generate_opml_feed() -> str:
-    """Return OPML subscription list built from the curated feed URL files."""
-    outlines = []
-
-    # Blog feeds — one URL per line
-    path = _find_feed_file("smallweb.txt")
-    if path:
-        with open(path) as f:
-            for line in f:
-                feed_url = line.split("#")[0].strip()
-                if feed_url:
-                    outlines.append(_build_opml_outline(feed_url))
-
-    # YouTube feeds — format: URL # Channel Name https://...
-    path = _find_feed_file("smallyt.txt")
-    if path:
-        with open(path) as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                parts = line.split("#", 1)
-                feed_url = parts[0].strip()
-                if not feed_url:
-                    continue
-                # Extract channel name and URL from comment
-                title = "YouTube"
-                html_url = "https://www.youtube.com"
-                if len(parts) > 1:
-                    comment = parts[1].strip()
-                    # "Channel Name https://www.youtube.com/channel/XXX"
-                    idx = comment.find("https://")
-                    if idx > 0:
-                        title = comment[:idx].strip()
-                        html_url = comment[idx:].strip()
-                    elif comment:
-                        title = comment.strip()
-                safe = escape(title, quote=True)
-                outlines.append(
-                    f'    <outline text="{safe}" title="{safe}" '
-                    f'type="rss" xmlUrl="{escape(feed_url, quote=True)}" '
-                    f'htmlUrl="{escape(html_url, quote=True)}"/>'
-                )
-
-    # Comic feeds — one URL per line
-    path = _find_feed_file("smallcomic.txt")
-    if path:
-        with open(path) as f:
-            for line in f:
-                feed_url = line.split("#")[0].strip()
-                if feed_url:
-                    outlines.append(_build_opml_outline(feed_url))
+def generate_opml_feed(mode="", lists=None) -> str:
+    """Return OPML subscription list built from the curated feed lists.
 
+    `mode` picks one list from FEED_LISTS; empty means all of them. `lists` is
+    parse_feed_lists() output and defaults to the loaded registry.
+    """
+    if lists is None:
+        lists = feed_lists
+    outlines = [
+        _build_opml_outline(source)
+        for kind in FEED_LISTS
+        if mode in ("", kind)
+        for source in lists.get(kind, ())
+    ]
+    title = "Kagi Small Web OPML" + (FEED_LISTS[mode][2] if mode else "")
     return (
         '<?xml version="1.0" encoding="UTF-8"?>\n'
         '<opml version="1.0">\n'
         "  <head>\n"
-        "    <title>Kagi Small Web OPML</title>\n"
+        f"    <title>{title}</title>\n"
         "  </head>\n"
         "  <body>\n" + "\n".join(outlines) + "\n  </body>\n</opml>"
     )
 
 
-DIR_DATA = "data"
+def refresh_feed_lists():
+    """Reload the feed registry and OPML variants if the list files changed.
+
+    The lists only change with a deploy, so this is normally one read and hash
+    of the files per update_all(). Returns True if anything was rebuilt.
+    """
+    global feed_lists, feed_registry, feed_hosts, _feed_lists_digest, _opml_cache
+    sources = _read_feed_lists()
+    digest = hashlib.blake2b(digest_size=16)
+    for kind in FEED_LISTS:
+        digest.update(f"{kind}\0{len(sources.get(kind, b''))}\0".encode())
+        digest.update(sources.get(kind, b""))
+    digest = digest.hexdigest()
+    if digest == _feed_lists_digest:
+        return False
+
+    lists = parse_feed_lists(sources)
+    registry, hosts = {}, {}
+    for rows in lists.values():
+        for source in rows:
+            # A feed listed twice keeps its first (blogs, yt, comic) row.
+            registry.setdefault(normalize_feed_url(source.feed_url), source)
+            hosts.setdefault(source.host, source)
+    opml = {}
+    for mode in ("", *FEED_LISTS):
+        xml = generate_opml_feed(mode, lists).encode()
+        opml[mode] = (f"{mode or 'all'}-{digest}", xml, gzip.compress(xml, compresslevel=9))
+    feed_lists, feed_registry, feed_hosts, _opml_cache = lists, registry, hosts, opml
+    _feed_lists_digest = digest
+    logger.info("Feed registry: %d feeds", len(registry))
+    return True
+
+
+DIR_DATA = os.environ.get("SW_DATA_DIR", "data")
 if not os.path.isdir(DIR_DATA):
     os.makedirs(DIR_DATA)
 PATH_LIKES = os.path.join(DIR_DATA, "likes.json")
@@ -537,7 +897,9 @@ PATH_LIKES = os.path.join(DIR_DATA, "likes.json")
 # expect favorites.json on disk.
 PATH_FAVORITES_LEGACY = os.path.join(DIR_DATA, "favorites.json")
 PATH_NOTES = os.path.join(DIR_DATA, "notes.json")
+# Flag counts from before they were kept per instance; read as a base.
 PATH_FLAGGED = os.path.join(DIR_DATA, "flagged_content.json")
+DIR_FLAGS = os.path.join(DIR_DATA, "flags.d")
 
 
 def serialize_notes(notes: dict) -> dict:
@@ -572,47 +934,1302 @@ def _load_json(path, deserializer=None):
         return None
 
 
-def save_likes():
+# Likes are grow-only counters sharded per instance. Every instance shares
+# data/ over gcsfuse but writes only its own journal and shard under
+# likes.d/; the counts shown are the merge of all shards on top of base.json,
+# the pre-shard likes frozen once at migration. likes.json and favorites.json
+# are exports of the merged view for rollbacks and are never read back.
+#
+# A like is acknowledged once it is in a journal on local disk (SW_SQLITE_DIR)
+# and shipped to likes.d/ right after, so a slow mount never holds up the
+# request. The next process to start on the machine ships whatever a dead
+# one left behind.
+#
+# An unpinned instance gets a fresh id, and so a fresh shard, on every start;
+# pin SW_INSTANCE_ID to reuse one across restarts. An instance that shuts
+# down cleanly leaves a <id>.closed marker next to its shard, and so does the
+# process that ships a crashed worker's local journal. Marked shards nobody
+# has touched for LIKES_SHARD_IDLE_SECONDS are folded into base.json and
+# deleted, so the ones left behind by restarts and redeploys do not pile up.
+# A live instance is never folded, however long it sits idle: it would write
+# its whole shard again on its next compaction.
+INSTANCE_ID = os.environ.get("SW_INSTANCE_ID") or uuid.uuid4().hex[:12]
+DIR_LIKES = os.path.join(DIR_DATA, "likes.d")
+PATH_LIKES_BASE = os.path.join(DIR_LIKES, "base.json")
+PATH_LIKES_FOLD_LOCK = os.path.join(DIR_LIKES, "fold.lock")
+PATH_LIKES_SHARD = os.path.join(DIR_LIKES, f"{INSTANCE_ID}.json")
+PATH_LIKES_JOURNAL = os.path.join(DIR_LIKES, f"{INSTANCE_ID}.journal")
+# Single-instance journal layout, read once when migrating to shards.
+PATH_LIKES_SNAPSHOT = os.path.join(DIR_DATA, "likes.snapshot.json")
+PATH_LIKES_JOURNAL_LEGACY = os.path.join(DIR_DATA, "likes.journal")
+LIKES_COMPACT_SECONDS = 60
+LIKES_MERGE_SECONDS = 30
+LIKES_FOLD_SECONDS = 3600
+# How long a closed shard stays untouched before it is folded; a restart
+# under a pinned id picks it up again in the meantime.
+LIKES_SHARD_IDLE_SECONDS = 6 * 3600
+# A fold lock older than this was left by an instance that died mid-fold.
+LIKES_FOLD_LOCK_STALE_SECONDS = 600
+# How long a like request waits for its journal batch to be written. Both
+# stores journal to local disk, so this only runs out when that disk does;
+# the request then gets a 503 rather than a success that may not be true.
+LIKES_COMMIT_TIMEOUT = 2
+# How often, at the latest, the JSON store ships its local journal to the
+# mount for peers to merge.
+LIKES_SHIP_SECONDS = 1
+LIKES_MAX_EMOJI = 3
+
+# Counters are {url: {emoji: [count, added]}}, where `added` is when the emoji
+# last joined the post's visible set; the newest LIKES_MAX_EMOJI are shown.
+_own_likes = {}  # this instance's shard
+_peer_likes = {}  # base plus every other shard, summed
+_peer_stats = None  # (name, mtime_ns, size) of the files _peer_likes came from
+# Blog and video posts by link, in feed order; empty until the first update_all.
+_likeable_entries = {}
+_last_added = 0.0
+
+# Guards the counters, likes_dict, the liked pool and the sequence numbers
+# handed out with them, so the order of events in the journal is the order
+# they were applied.
+#
+# All user-generated state (likes here, notes and flags under
+# _user_data_cond) follows the same rules so gunicorn can run any number of
+# threads: writers hold the lock; a published value -- a post's reactions or
+# notes list -- is never changed in place, only replaced; and request
+# threads read without locking, using only get() and `in` on the dicts, so
+# they see either the old value or the new one.
+_likes_lock = threading.Lock()
+_journal_cond = threading.Condition()
+_journal_pending = []  # (seq, event) waiting for the committer
+_journal_seq = 0  # last sequence number handed out
+_journal_durable = 0  # last sequence number written and flushed
+_snapshot_seq = 0  # last sequence number folded into the shard file
+# Serializes journal appends against compaction trimming the file.
+_journal_io_lock = threading.Lock()
+_compact_lock = threading.Lock()
+_store = None  # JsonStore or SqliteStore, opened at startup by _open_store()
+
+
+def _write_json_atomic(path, data):
+    """Write JSON next to `path` and swap it in, so readers never see half."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+
+def save_likes(payload):
     """Persist likes to the canonical file and the legacy favorites file."""
-    payload = {u: dict(emojis) for u, emojis in likes_dict.items()}
     for path in [PATH_LIKES, PATH_FAVORITES_LEGACY]:
         try:
-            with open(path, "w", encoding="utf-8") as file:
-                json.dump(payload, file)
+            _write_json_atomic(path, payload)
         except OSError as e:
             logger.error("Cannot write likes file %s: %s", path, e)
 
 
-def _rebuild_liked_cache():
-    """Refresh the cached liked entries and Atom feed."""
-    global urls_liked_cache
-    urls_liked_cache = [e for e in (urls_cache + urls_yt_cache) if e.link in likes_dict]
-    generate_liked_feed()
+def _add_reaction(entry, emoji, count):
+    """Copy of `entry` with `count` more `emoji`, keeping at most 3 emoji.
 
+    A new emoji on a post that already has three evicts the oldest one. This
+    is the single-instance rule, used to replay the pre-shard journal.
+    """
+    entry = OrderedDict(entry or ())
+    if emoji not in entry and len(entry) >= LIKES_MAX_EMOJI:
+        entry.popitem(last=False)
+    entry[emoji] = entry.get(emoji, 0) + count
+    return entry
 
-def _apply_like(url, emoji="👍", count=1):
-    """Apply one or more reactions to a URL and persist the result."""
-    global likes_dict, time_saved_likes
 
-    entry = likes_dict.get(url)
-    if not isinstance(entry, OrderedDict):
-        entry = OrderedDict()
+def _merge_counters(into, counters):
+    """Add one shard's counters into `into`: counts sum, `added` takes the max."""
+    for url, emojis in counters.items():
+        target = into.setdefault(url, {})
+        for emoji, (count, added) in emojis.items():
+            have = target.get(emoji)
+            if have is None:
+                target[emoji] = [count, added]
+            else:
+                target[emoji] = [have[0] + count, max(have[1], added)]
+    return into
 
-    if emoji not in entry and len(entry) >= 3:
-        entry.popitem(last=False)
 
-    entry[emoji] = entry.get(emoji, 0) + count
-    likes_dict[url] = entry
+def _visible(counters):
+    """The reactions shown for one post: the newest LIKES_MAX_EMOJI emoji.
+
+    Keeps the single-instance cap of three per URL. The difference from it is
+    that an evicted emoji that comes back resumes its count instead of
+    restarting at one, because a grow-only counter cannot be reset.
+    """
+    ranked = sorted(counters.items(), key=lambda item: item[1][1])
+    return OrderedDict(
+        (emoji, count) for emoji, (count, _) in ranked[-LIKES_MAX_EMOJI:]
+    )
+
+
+def _url_counters(url):
+    own, peer = _own_likes.get(url), _peer_likes.get(url)
+    if not own or not peer:
+        return own or peer or {}
+    return _merge_counters({url: dict(peer)}, {url: own})[url]
+
+
+def _publish_likes():
+    """Rebuild likes_dict from the counters. Call with _likes_lock held.
+
+    Posts that have left the feeds are dropped from the view but keep their
+    counters, in case they come back.
+    """
+    global likes_dict
+    merged = _merge_counters(_merge_counters({}, _peer_likes), _own_likes)
+    likes_dict = {
+        url: _visible(counters)
+        for url, counters in merged.items()
+        if not _likeable_entries or url in _likeable_entries
+    }
+
+
+def _counters_from_likes(likes):
+    """Seed counters from a plain {url: {emoji: count}} dict, keeping order."""
+    return {
+        url: {emoji: [count, i * 1e-6] for i, (emoji, count) in enumerate(emojis.items())}
+        for url, emojis in likes.items()
+    }
+
+
+def _journal_committer():
+    """Append queued like events to the journal, one write per batch.
+
+    Every event queued while the previous batch was being written goes out
+    in the next one, so a burst of likes costs a handful of appends rather
+    than one whole-file upload per click.
+    """
+    global _journal_durable
+    while True:
+        with _journal_cond:
+            while not _journal_pending:
+                _journal_cond.wait()
+            batch = list(_journal_pending)
+            del _journal_pending[:]
+        try:
+            with _journal_io_lock:
+                _store.append_likes([event for _, event in batch])
+        except (OSError, sqlite3.Error) as e:
+            logger.error("Cannot append to likes journal: %s", e)
+            with _journal_cond:
+                _journal_pending[:0] = batch
+            # Back off before retrying so a dead mount is not hammered.
+            threading.Event().wait(1)
+            continue
+        with _journal_cond:
+            _journal_durable = max(_journal_durable, batch[-1][0])
+            _journal_cond.notify_all()
+
+
+def _journal_shipper():
+    """Copy journaled like events to the mount as soon as they are acknowledged.
+
+    Woken by each committed batch and at least every LIKES_SHIP_SECONDS, so
+    a mount that stalls delays only what peers see, never a like request.
+    """
+    while True:
+        with _journal_cond:
+            _journal_cond.wait(LIKES_SHIP_SECONDS)
+        try:
+            _store.ship_likes()
+        except OSError as e:
+            logger.error("Cannot ship likes journal to the mount: %s", e)
+            threading.Event().wait(1)
+
+
+def _wait_journal(seq, timeout=LIKES_COMMIT_TIMEOUT):
+    """Block until event `seq` is in the journal. False on timeout."""
+    with _journal_cond:
+        return _journal_cond.wait_for(lambda: _journal_durable >= seq, timeout)
+
 
-    _rebuild_liked_cache()
+def _rebuild_liked_cache(changed=None):
+    """Rebuild the liked pool from scratch, after many likes changed at once.
 
-    # Save to disk immediately (multi-instance deployment requires immediate persistence)
-    time_saved_likes = datetime.now()
-    save_likes()
+    `changed` names the URLs whose reactions changed, when the feed pools
+    did not; see _rebuild_popularity(). Hold _likes_lock, or a first like
+    landing mid-rebuild is appended to the list this is about to replace.
+    """
+    global urls_liked_cache, _liked_version, _liked_modified
+    urls_liked_cache = [e for e in _likeable_entries.values() if e.link in likes_dict]
+    _liked_version += 1
+    _liked_modified = datetime.now(timezone.utc).replace(microsecond=0)
+    _rebuild_popularity(changed)
+
+
+def _add_to_liked_cache(url):
+    """Insert a post's first reaction into the liked pool. Hold _likes_lock."""
+    global _liked_version, _liked_modified
+    entry = _likeable_entries.get(url)
+    if entry is not None:
+        urls_liked_cache.append(entry)
+        _liked_version += 1
+        _liked_modified = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def _apply_like(url, emoji="👍", count=1):
+    """Apply one or more reactions to a URL and journal the event.
+
+    Only this instance's shard changes. Returns the post's merged reactions
+    once the event is in the journal, or None if it is not there within
+    LIKES_COMMIT_TIMEOUT; compact_likes() folds it into the shard file later.
+    """
+    global _journal_seq, _last_added
+
+    with _likes_lock:
+        first_reaction = url not in likes_dict
+        counters = _url_counters(url)
+        if emoji in _visible(counters):
+            added = counters[emoji][1]
+        else:
+            # Joining (or rejoining) the visible set makes it the newest.
+            added = _last_added = max(time.time(), _last_added + 1e-6)
+        own = _own_likes.setdefault(url, {})
+        have_count, have_added = own.get(emoji, (0, 0.0))
+        own[emoji] = [have_count + count, max(have_added, added)]
+
+        entry = _visible(_url_counters(url))
+        likes_dict[url] = entry
+        if first_reaction:
+            _add_to_liked_cache(url)
+        _update_popularity(url)
+        _journal_seq += 1
+        seq = _journal_seq
+        event = {"seq": seq, "url": url, "emoji": emoji, "count": count, "added": added}
+        with _journal_cond:
+            _journal_pending.append((seq, event))
+            _journal_cond.notify_all()
+
+    if not _wait_journal(seq):
+        # Still queued; the committer keeps retrying and save_all_data()
+        # flushes it on shutdown, but nothing can promise that yet.
+        logger.error("Like on %s not journaled after %ss", url, LIKES_COMMIT_TIMEOUT)
+        return None
 
     return entry
 
 
+def _read_journal(path, after_seq):
+    """Journal events in `path` with a sequence number above `after_seq`."""
+    events = []
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-append was never acknowledged.
+                    logger.warning("Skipping unreadable line in %s", path)
+                    continue
+                if event.get("seq", 0) > after_seq:
+                    events.append(event)
+    except FileNotFoundError:
+        pass
+    events.sort(key=lambda ev: ev["seq"])
+    return events
+
+
+def _load_shard(shard_path, journal_path):
+    """One instance's counters: its shard file plus its journal since then.
+
+    Returns (counters, last sequence number).
+    """
+    shard = None
+    if os.path.exists(shard_path):
+        shard = _load_json(shard_path)
+    counters = shard["likes"] if shard else {}
+    seq = shard["seq"] if shard else 0
+    return _replay_journal(counters, journal_path, seq)
+
+
+def _replay_journal(counters, journal_path, seq):
+    """Fold a journal's events after `seq` into `counters`.
+
+    Returns (counters, last sequence number). An event can be in a journal
+    twice, once shipped and once adopted, so each sequence number counts once.
+    """
+    for event in _read_journal(journal_path, seq):
+        if event["seq"] <= seq:
+            continue
+        _merge_counters(
+            counters,
+            {event["url"]: {event["emoji"]: [event["count"], event["added"]]}},
+        )
+        seq = event["seq"]
+    return counters, seq
+
+
+def _load_pre_shard_likes():
+    """Likes as the single-instance layout left them: snapshot plus journal."""
+
+    def to_likes(d):
+        return {url: OrderedDict(emojis) for url, emojis in d.items()}
+
+    snapshot = _load_json(PATH_LIKES_SNAPSHOT)
+    if snapshot is not None:
+        likes, base_seq = to_likes(snapshot["likes"]), snapshot["seq"]
+    else:
+        likes = (
+            _load_json(PATH_LIKES, to_likes)
+            or _load_json(PATH_FAVORITES_LEGACY, to_likes)
+            or {}
+        )
+        base_seq = 0
+    for event in _read_journal(PATH_LIKES_JOURNAL_LEGACY, base_seq):
+        url = event["url"]
+        likes[url] = _add_reaction(likes.get(url), event["emoji"], event["count"])
+    return likes
+
+
+def _ensure_likes_base():
+    """Freeze the pre-shard likes into base.json, once across all instances.
+
+    Exclusive create makes exactly one instance win when several start on the
+    migration at once; the others read what it wrote.
+    """
+    os.makedirs(DIR_LIKES, exist_ok=True)
+    if os.path.exists(PATH_LIKES_BASE):
+        return
+    payload = json.dumps(_counters_from_likes(_load_pre_shard_likes()))
+    try:
+        fd = os.open(PATH_LIKES_BASE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        return
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+    logger.info("Migrated pre-shard likes into %s", PATH_LIKES_BASE)
+
+
+def _likes_dir_stats():
+    """(name, mtime_ns, size) of every peer file: the cheap change check."""
+    own = {
+        os.path.basename(PATH_LIKES_SHARD),
+        os.path.basename(PATH_LIKES_JOURNAL),
+        f"{INSTANCE_ID}.sqlite",
+    }
+    stats = []
+    try:
+        with os.scandir(DIR_LIKES) as it:
+            for item in it:
+                if item.name in own or item.name.endswith(".tmp"):
+                    continue
+                st = item.stat()
+                stats.append((item.name, st.st_mtime_ns, st.st_size))
+    except FileNotFoundError:
+        pass
+    return sorted(stats)
+
+
+def _load_likes_base():
+    """(counters, folded instance ids) from base.json.
+
+    The migration writes bare counters; a fold adds the ids whose shards it
+    moved in, so a shard left behind by a fold interrupted before deleting
+    it is not counted twice.
+    """
+    data = _load_json(PATH_LIKES_BASE) if os.path.exists(PATH_LIKES_BASE) else None
+    if not data:
+        return {}, set()
+    if "likes" in data and "folded" in data:  # URLs never look like these keys
+        return data["likes"], set(data["folded"])
+    return data, set()
+
+
+def _shard_instances(stats):
+    """Instance id -> newest mtime_ns over its shard files."""
+    newest = {}
+    for name, mtime, _ in stats:
+        if name.endswith((".json", ".journal", ".sqlite")) and name != "base.json":
+            instance = name.rsplit(".", 1)[0]
+            newest[instance] = max(newest.get(instance, 0), mtime)
+    return newest
+
+
+def _instance_counters(instance):
+    """One peer's counters, from its SQLite checkpoint or its JSON shard."""
+    # An instance on the SQLite backend imported its JSON shard when it
+    # migrated, so its checkpoint supersedes any JSON files it left.
+    checkpoint = os.path.join(DIR_LIKES, instance + ".sqlite")
+    if os.path.exists(checkpoint):
+        return _load_sqlite_shard(checkpoint)
+    counters, _ = _load_shard(
+        os.path.join(DIR_LIKES, instance + ".json"),
+        os.path.join(DIR_LIKES, instance + ".journal"),
+    )
+    return counters
+
+
+def merge_likes():
+    """Fold other instances' shards into likes_dict when any of them changed.
+
+    A directory listing and one stat per file when nothing changed; the
+    shards are only read when a peer has written since the last merge.
+    """
+    global _peer_likes, _peer_stats
+    stats = _likes_dir_stats()
+    if stats == _peer_stats:
+        return False
+    base, folded = _load_likes_base()
+    peer = _merge_counters({}, base)
+    for instance in sorted(_shard_instances(stats)):
+        if instance not in folded:
+            _merge_counters(peer, _instance_counters(instance))
+    with _likes_lock:
+        before = likes_dict
+        _peer_likes, _peer_stats = peer, stats
+        _publish_likes()
+        changed = [
+            url
+            for url in before.keys() | likes_dict.keys()
+            if before.get(url) != likes_dict.get(url)
+        ]
+        if changed:
+            _rebuild_liked_cache(changed)
+    return True
+
+
+def _take_fold_lock():
+    try:
+        fd = os.open(PATH_LIKES_FOLD_LOCK, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        try:
+            age = time.time() - os.stat(PATH_LIKES_FOLD_LOCK).st_mtime
+            if age < LIKES_FOLD_LOCK_STALE_SECONDS:
+                return False
+            os.remove(PATH_LIKES_FOLD_LOCK)
+        except OSError:
+            return False
+        return _take_fold_lock()
+    os.close(fd)
+    return True
+
+
+def _closed_marker(instance):
+    return os.path.join(DIR_LIKES, instance + ".closed")
+
+
+def _mark_closed(instance):
+    """Let fold_idle_shards() fold `instance`: it will never write again."""
+    with open(_closed_marker(instance), "w", encoding="utf-8"):
+        pass
+
+
+def _reopen_own_shard():
+    """Withdraw this instance's closed marker before its shard is loaded.
+
+    Done under the fold lock, so a fold of this id either finished first,
+    and took the shard with it, or sees the instance live and skips it.
+    Only a restart under a pinned SW_INSTANCE_ID finds a marker.
+    """
+    if not os.path.exists(_closed_marker(INSTANCE_ID)):
+        return
+    deadline = time.monotonic() + LIKES_FOLD_LOCK_STALE_SECONDS
+    while not _take_fold_lock():
+        if time.monotonic() > deadline:
+            logger.error("Fold lock still held; reopening %s without it", INSTANCE_ID)
+            break
+        time.sleep(0.2)
+    else:
+        try:
+            os.remove(_closed_marker(INSTANCE_ID))
+        finally:
+            os.remove(PATH_LIKES_FOLD_LOCK)
+        return
+    os.remove(_closed_marker(INSTANCE_ID))
+
+
+def _remove_instance_files(instance):
+    # The marker goes last: files without it are never folded again.
+    for suffix in (".json", ".journal", ".sqlite", ".closed"):
+        try:
+            os.remove(os.path.join(DIR_LIKES, instance + suffix))
+        except FileNotFoundError:
+            pass
+
+
+def fold_idle_shards():
+    """Move closed, idle peers' counts into base.json and delete their shards.
+
+    One instance folds at a time, under an exclusive-create lock file. The
+    new base lists the folded ids before their files go, and they are
+    dropped from the list once the files are gone. Returns how many shards
+    were folded.
+    """
+    cutoff = time.time_ns() - int(LIKES_SHARD_IDLE_SECONDS * 1e9)
+    stats = _likes_dir_stats()
+    closed = {name[: -len(".closed")] for name, _, _ in stats if name.endswith(".closed")}
+    idle = sorted(
+        instance
+        for instance, mtime in _shard_instances(stats).items()
+        if mtime < cutoff and instance in closed
+    )
+    if not idle or not _take_fold_lock():
+        return 0
+    try:
+        base, folded = _load_likes_base()
+        moved = [instance for instance in idle if instance not in folded]
+        for instance in moved:
+            _merge_counters(base, _instance_counters(instance))
+        folded.update(moved)
+        _write_json_atomic(PATH_LIKES_BASE, {"likes": base, "folded": sorted(folded)})
+        for instance in idle:
+            _remove_instance_files(instance)
+        remaining = {
+            instance
+            for instance in folded
+            if any(
+                os.path.exists(os.path.join(DIR_LIKES, instance + suffix))
+                for suffix in (".json", ".journal", ".sqlite")
+            )
+        }
+        _write_json_atomic(PATH_LIKES_BASE, {"likes": base, "folded": sorted(remaining)})
+    except OSError as e:
+        logger.error("Cannot fold idle like shards: %s", e)
+        return 0
+    finally:
+        try:
+            os.remove(PATH_LIKES_FOLD_LOCK)
+        except OSError:
+            pass
+    logger.info("Folded %d idle like shards into %s", len(moved), PATH_LIKES_BASE)
+    return len(moved)
+
+
+def _touch_own_shard():
+    """Mark this instance's shard files live for fold_idle_shards()."""
+    for path in (
+        PATH_LIKES_SHARD,
+        PATH_LIKES_JOURNAL,
+        os.path.join(DIR_LIKES, f"{INSTANCE_ID}.sqlite"),
+    ):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+
+def load_likes():
+    """Load base, this instance's shard and every peer shard into likes_dict.
+
+    Sets the journal sequence counters as a side effect. This instance's own
+    shard only exists when SW_INSTANCE_ID pins the id across restarts.
+    """
+    global _own_likes, _peer_stats, _journal_seq, _journal_durable, _snapshot_seq
+    _ensure_likes_base()
+    own, seq = _store.load_likes()
+    with _likes_lock:
+        _own_likes, _peer_stats = own, None
+        _snapshot_seq = _journal_seq = _journal_durable = seq
+    merge_likes()
+    return likes_dict
+
+
+def compact_likes():
+    """Fold this instance's journal into its shard and trim the journal.
+
+    Runs off the request path. The shard covers every sequence number handed
+    out so far, including events still queued for the journal; replay skips
+    those by sequence number, so nothing is applied twice. Also refreshes the
+    likes.json / favorites.json exports of the merged view. Returns whether
+    the shard now covers every event.
+    """
+    with _compact_lock:
+        done = _compact_likes()
+    try:
+        _touch_own_shard()
+    except OSError as e:
+        logger.error("Cannot touch likes shard: %s", e)
+    return done
+
+
+def _compact_likes():
+    """True once the shard covers every event handed out so far."""
+    global _snapshot_seq
+    with _likes_lock:
+        upto = _journal_seq
+        if upto == _snapshot_seq:
+            return True
+        counters = {
+            url: {emoji: list(rec) for emoji, rec in emojis.items()}
+            for url, emojis in _own_likes.items()
+        }
+        payload = {u: dict(emojis) for u, emojis in likes_dict.items()}
+
+    try:
+        _store.compact_likes(counters, upto)
+    except (OSError, sqlite3.Error) as e:
+        logger.error("Cannot write likes shard: %s", e)
+        return False
+    save_likes(payload)
+    _snapshot_seq = upto
+    logger.info("Compacted likes through event %d", upto)
+    return True
+
+
+# --- Storage backends -------------------------------------------------------
+# SW_STORE picks where this instance keeps its likes shard, notes and flags.
+# "json" is the file layout above plus whole-file notes.json and
+# flagged_content.json. "sqlite" keeps all three in a local WAL database with
+# per-row upserts and checkpoints a copy into likes.d/ for peers and restarts.
+STORE_BACKEND = os.environ.get("SW_STORE", "json")
+DIR_SQLITE_LOCAL = os.environ.get("SW_SQLITE_DIR", tempfile.gettempdir())
+STORE_CHECKPOINT_SECONDS = 60
+
+
+def _append_journal(path, events):
+    with open(path, "a", encoding="utf-8") as file:
+        file.write("".join(json.dumps(ev, ensure_ascii=False) + "\n" for ev in events))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _trim_journal(path, upto):
+    """Drop the events a shard through `upto` already covers."""
+    try:
+        kept = [
+            json.dumps(event, ensure_ascii=False) + "\n"
+            for event in _read_journal(path, upto)
+        ]
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as file:
+            file.write("".join(kept))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+    except OSError as e:
+        # Harmless: replay skips events the shard already covers.
+        logger.error("Cannot trim likes journal %s: %s", path, e)
+
+
+def _try_lock(path):
+    """An fd holding an exclusive flock on `path`, or None if it is held."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _local_journal_path(instance):
+    return os.path.join(DIR_SQLITE_LOCAL, f"smallweb-{instance}.journal")
+
+
+def _adopt_orphan_journals():
+    """Ship the local journals of dead processes on this machine to the mount.
+
+    A worker that crashed, or was respawned under a new id, leaves the events
+    it acknowledged in its local journal, and its lock with nobody holding
+    it. They are appended to that instance's journal on the mount, where
+    peers merge them and fold_idle_shards() eventually moves them to the base.
+    """
+    try:
+        names = os.listdir(DIR_SQLITE_LOCAL)
+    except FileNotFoundError:
+        return
+    own = os.path.basename(_local_journal_path(INSTANCE_ID))
+    for name in names:
+        if not (name.startswith("smallweb-") and name.endswith(".journal")) or name == own:
+            continue
+        path = os.path.join(DIR_SQLITE_LOCAL, name)
+        fd = _try_lock(path + ".lock")
+        if fd is None:
+            continue
+        try:
+            events = _read_journal(path, 0)
+            instance = name[len("smallweb-") : -len(".journal")]
+            if events:
+                _append_journal(os.path.join(DIR_LIKES, instance + ".journal"), events)
+                logger.info("Shipped %d orphaned like events from %s", len(events), path)
+            _mark_closed(instance)
+            os.remove(path)
+            os.remove(path + ".lock")
+        except OSError as e:
+            logger.error("Cannot ship orphaned likes journal %s: %s", path, e)
+        finally:
+            os.close(fd)
+
+
+class JsonStore:
+    """Likes journal and shard files; notes and flags as whole JSON files.
+
+    With `local_journal`, a like is journaled to that file on local disk,
+    which is what the request waits for, and ship_likes() copies it to this
+    instance's journal on the mount in the background, where peers read it.
+    Without one (importing into another store) the mount journal is the
+    only journal.
+    """
+
+    name = "json"
+    # Each save rewrites a whole file, so callers batch them.
+    row_level = False
+
+    def __init__(self, local_journal=None):
+        self.shard, self.journal = PATH_LIKES_SHARD, PATH_LIKES_JOURNAL
+        self.flags = os.path.join(DIR_FLAGS, f"{INSTANCE_ID}.json")
+        self.local_journal = local_journal
+        self.shipped = 0  # last sequence number in the mount journal
+        self.lock_fd = None
+        if local_journal:
+            # Held for the life of the store, so _adopt_orphan_journals()
+            # in another process leaves this journal alone.
+            self.lock_fd = _try_lock(local_journal + ".lock")
+            if self.lock_fd is None:
+                logger.error("%s is in use by another process", local_journal)
+        # Serializes mount journal appends against compaction trimming it.
+        self.ship_lock = threading.Lock() if local_journal else _journal_io_lock
+
+    def load_likes(self):
+        counters, seq = _load_shard(self.shard, self.journal)
+        self.shipped = seq
+        if self.local_journal:
+            counters, seq = _replay_journal(counters, self.local_journal, seq)
+        return counters, seq
+
+    def append_likes(self, events):
+        _append_journal(self.local_journal or self.journal, events)
+
+    def ship_likes(self):
+        """Copy journaled events the mount does not have yet. Off the request path."""
+        if not self.local_journal:
+            return
+        with _journal_io_lock:
+            events = _read_journal(self.local_journal, self.shipped)
+        with self.ship_lock:
+            events = [event for event in events if event["seq"] > self.shipped]
+            if events:
+                _append_journal(self.journal, events)
+                self.shipped = events[-1]["seq"]
+
+    def compact_likes(self, counters, upto):
+        _write_json_atomic(
+            self.shard,
+            {"instance": INSTANCE_ID, "seq": upto, "likes": counters},
+        )
+        with self.ship_lock:
+            _trim_journal(self.journal, upto)
+            self.shipped = max(self.shipped, upto)
+        if self.local_journal:
+            with _journal_io_lock:
+                _trim_journal(self.local_journal, upto)
+
+    def load_notes(self):
+        return _load_json(PATH_NOTES, deserialize_notes) or {}
+
+    def load_flags(self):
+        return _load_json(self.flags) or {}
+
+    def save_notes(self, notes, urls):
+        _write_json_atomic(PATH_NOTES, serialize_notes(notes))
+
+    def save_flags(self, flags, urls):
+        _write_json_atomic(self.flags, flags)
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+
+class SqliteStore:
+    """Likes, notes and flags in a local SQLite WAL database.
+
+    Writes are per-row upserts against local disk. checkpoint() copies the
+    database to `checkpoint_path` on the mount, which is what peers merge and
+    what a restart with the same SW_INSTANCE_ID restores from. Writes made
+    since the last checkpoint are lost if the instance dies.
+    """
+
+    name = "sqlite"
+    row_level = True
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS reactions (
+            url TEXT NOT NULL,
+            emoji TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            added REAL NOT NULL,
+            PRIMARY KEY (url, emoji)
+        );
+        CREATE TABLE IF NOT EXISTS notes (
+            url TEXT NOT NULL,
+            content TEXT NOT NULL,
+            ts TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS notes_url ON notes (url);
+        CREATE TABLE IF NOT EXISTS flags (
+            url TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path, checkpoint_path):
+        self.path, self.checkpoint_path = path, checkpoint_path
+        if not os.path.exists(path) and os.path.exists(checkpoint_path):
+            shutil.copyfile(checkpoint_path, path)
+            logger.info("Restored %s from %s", path, checkpoint_path)
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        if self._meta("migrated") is None:
+            self.migrate_from(JsonStore())
+
+    def _meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, statements):
+        """Run (sql, params) pairs in one transaction."""
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    self.db.execute(sql, params)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            self.dirty = True
+
+    def migrate_from(self, other):
+        """One-shot import of another store's state into this database."""
+        counters, seq = other.load_likes()
+        notes, flags = other.load_notes(), other.load_flags()
+        self._write(
+            [
+                (self.UPSERT_REACTION, (url, emoji, count, added))
+                for url, emojis in counters.items()
+                for emoji, (count, added) in emojis.items()
+            ]
+            + self._note_rows(notes, notes.keys())
+            + [(self.UPSERT_FLAG, (url, count)) for url, count in flags.items()]
+            + [
+                (self.SET_META, ("seq", str(seq))),
+                (self.SET_META, ("migrated", other.name)),
+            ]
+        )
+        logger.info(
+            "Migrated %d liked posts, %d noted posts and %d flags from %s into %s",
+            len(counters), len(notes), len(flags), other.name, self.path,
+        )
+
+    UPSERT_REACTION = """
+        INSERT INTO reactions (url, emoji, count, added) VALUES (?, ?, ?, ?)
+        ON CONFLICT (url, emoji) DO UPDATE SET
+            count = count + excluded.count, added = max(added, excluded.added)
+    """
+    UPSERT_FLAG = """
+        INSERT INTO flags (url, count) VALUES (?, ?)
+        ON CONFLICT (url) DO UPDATE SET count = excluded.count
+    """
+    SET_META = "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)"
+
+    def load_likes(self):
+        with self.lock:
+            rows = self.db.execute("SELECT url, emoji, count, added FROM reactions")
+            counters = _counters_from_rows(rows)
+            seq = int(self._meta("seq") or 0)
+        return counters, seq
+
+    def append_likes(self, events):
+        self._write(
+            [
+                (self.UPSERT_REACTION, (ev["url"], ev["emoji"], ev["count"], ev["added"]))
+                for ev in events
+            ]
+            + [(self.SET_META, ("seq", str(events[-1]["seq"])))]
+        )
+
+    def ship_likes(self):
+        # checkpoint() publishes the rows instead.
+        pass
+
+    def compact_likes(self, counters, upto):
+        # The rows already are the shard; checkpoint() publishes them.
+        pass
+
+    def load_notes(self):
+        notes = {}
+        with self.lock:
+            for url, content, ts in self.db.execute(
+                "SELECT url, content, ts FROM notes ORDER BY rowid"
+            ):
+                notes.setdefault(url, []).append((content, datetime.fromisoformat(ts)))
+        return notes
+
+    def load_flags(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT url, count FROM flags"))
+
+    @staticmethod
+    def _note_rows(notes, urls):
+        rows = []
+        for url in urls:
+            rows.append(("DELETE FROM notes WHERE url = ?", (url,)))
+            rows += [
+                (
+                    "INSERT INTO notes (url, content, ts) VALUES (?, ?, ?)",
+                    (url, content, ts.isoformat()),
+                )
+                for content, ts in notes.get(url, [])
+            ]
+        return rows
+
+    def save_notes(self, notes, urls):
+        self._write(self._note_rows(notes, urls))
+
+    def save_flags(self, flags, urls):
+        self._write([(self.UPSERT_FLAG, (url, flags[url])) for url in urls if url in flags])
+
+    def checkpoint(self):
+        """Copy the database to the mount if anything changed since last time.
+
+        The online backup goes to local disk first and is then copied across
+        and renamed into place, so peers never open a half-written file.
+        """
+        if not self.dirty:
+            return
+        self.dirty = False
+        local = self.path + ".checkpoint"
+        try:
+            target = sqlite3.connect(local)
+            try:
+                with self.lock:
+                    self.db.backup(target)
+            finally:
+                target.close()
+            shutil.copyfile(local, self.checkpoint_path + ".tmp")
+            os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+        except (OSError, sqlite3.Error):
+            self.dirty = True
+            raise
+
+    def close(self):
+        self.db.close()
+
+
+def _counters_from_rows(rows):
+    counters = {}
+    for url, emoji, count, added in rows:
+        counters.setdefault(url, {})[emoji] = [count, added]
+    return counters
+
+
+def _load_sqlite_shard(path):
+    """A peer's counters from its checkpointed database, opened read-only."""
+    try:
+        db = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True)
+        try:
+            return _counters_from_rows(
+                db.execute("SELECT url, emoji, count, added FROM reactions")
+            )
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        logger.error("Cannot read likes checkpoint %s: %s", path, e)
+        return {}
+
+
+def _load_sqlite_user_data(path):
+    """A peer's (notes, flags) from its checkpointed database, read-only."""
+    notes = {}
+    try:
+        db = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True)
+        try:
+            for url, content, ts in db.execute(
+                "SELECT url, content, ts FROM notes ORDER BY rowid"
+            ):
+                notes.setdefault(url, []).append((content, datetime.fromisoformat(ts)))
+            flags = dict(db.execute("SELECT url, count FROM flags"))
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        logger.error("Cannot read notes and flags from %s: %s", path, e)
+        return {}, {}
+    return notes, flags
+
+
+def _open_store(kind=None):
+    """Open the configured backend for this instance."""
+    kind = kind or STORE_BACKEND
+    os.makedirs(DIR_LIKES, exist_ok=True)
+    os.makedirs(DIR_FLAGS, exist_ok=True)
+    _reopen_own_shard()
+    if kind == "sqlite":
+        return SqliteStore(
+            os.path.join(DIR_SQLITE_LOCAL, f"smallweb-{INSTANCE_ID}.sqlite"),
+            os.path.join(DIR_LIKES, f"{INSTANCE_ID}.sqlite"),
+        )
+    if kind != "json":
+        logger.error("Unknown SW_STORE %r, using json", kind)
+    store = JsonStore(_local_journal_path(INSTANCE_ID))
+    _adopt_orphan_journals()
+    return store
+
+
+# Notes and flags are written by a background thread, never by the request
+# that made them: note() and flag_content() mutate the dicts under
+# _user_data_cond and mark the URL dirty, and the writer coalesces whatever
+# piled up since its last pass into one store call per kind. A crash loses at
+# most USER_DATA_FLUSH_SECONDS of them; SIGTERM flushes within
+# SHUTDOWN_FLUSH_BUDGET (Cloud Run allows 10 s before SIGKILL).
+USER_DATA_FLUSH_SECONDS = float(os.environ.get("SW_FLUSH_SECONDS", "5"))
+SHUTDOWN_FLUSH_BUDGET = float(os.environ.get("SW_SHUTDOWN_BUDGET", "8"))
+_user_data_cond = threading.Condition()
+_notes_dirty = set()
+_flags_dirty = set()
+_oldest_unflushed = None  # time.monotonic() of the oldest write not on disk
+# Serializes whole flushes, so the writer and a shutdown flush never interleave.
+_flush_lock = threading.Lock()
+
+
+def _mark_dirty(dirty, url):
+    """Record an unflushed write; caller holds _user_data_cond."""
+    global _oldest_unflushed
+    dirty.add(url)
+    if _oldest_unflushed is None:
+        _oldest_unflushed = time.monotonic()
+
+
+def unflushed_write_age():
+    """Seconds the oldest unflushed note or flag has waited, 0 when clean."""
+    since = _oldest_unflushed
+    return time.monotonic() - since if since is not None else 0.0
+
+
+def flush_user_data():
+    """Write dirty notes and flags through the store. Never called by requests.
+
+    Only the dirty rows are copied for a row-level store; the JSON store gets a
+    copy of the whole dict, which is what it writes anyway. On failure the URLs
+    are marked dirty again and keep their original age.
+    """
+    global _oldest_unflushed
+    with _flush_lock:
+        with _user_data_cond:
+            if not (_notes_dirty or _flags_dirty):
+                return
+            since = _oldest_unflushed
+            note_urls, flag_urls = list(_notes_dirty), list(_flags_dirty)
+            _notes_dirty.clear()
+            _flags_dirty.clear()
+            _oldest_unflushed = None
+            if _store.row_level:
+                notes = {u: notes_dict[u] for u in note_urls if u in notes_dict}
+                flags = {u: _own_flags[u] for u in flag_urls if u in _own_flags}
+            else:
+                # Notes lists are replaced, never appended to, so a shallow
+                # copy is a consistent snapshot.
+                notes = dict(notes_dict)
+                flags = dict(_own_flags)
+
+        failed = []
+        for kind, save, data, urls in (
+            ("notes", _store.save_notes, notes, note_urls),
+            ("flags", _store.save_flags, flags, flag_urls),
+        ):
+            if not urls:
+                continue
+            try:
+                save(data, urls)
+            except (OSError, sqlite3.Error) as e:
+                logger.error("Cannot save %s: %s", kind, e)
+                failed.append(kind)
+
+        if failed:
+            with _user_data_cond:
+                if "notes" in failed:
+                    _notes_dirty.update(note_urls)
+                if "flags" in failed:
+                    _flags_dirty.update(flag_urls)
+                if _oldest_unflushed is None or since < _oldest_unflushed:
+                    _oldest_unflushed = since
+
+
+def _add_note(url, content):
+    """Append a note to a post: the only writer of notes_dict after startup."""
+    with _user_data_cond:
+        notes_dict[url] = notes_dict.get(url, []) + [(content, datetime.now())]
+        _mark_dirty(_notes_dirty, url)
+
+
+def _add_flag(url):
+    """Count one flag on a post: the only writer of _own_flags after startup."""
+    with _user_data_cond:
+        _own_flags[url] = _own_flags.get(url, 0) + 1
+        flagged_content_dict[url] = flagged_content_dict.get(url, 0) + 1
+        _mark_dirty(_flags_dirty, url)
+
+
+def _publish_flags():
+    """Rebuild flagged_content_dict from the counts. Hold _user_data_cond."""
+    global flagged_content_dict
+    flagged_content_dict = _sum_flags(_sum_flags({}, _peer_flags), _own_flags)
+
+
+def _rebuild_flagged_cache():
+    """Rebuild the flagged pool from every cache and flagged_content_dict."""
+    global urls_flagged_cache
+    urls_flagged_cache = [
+        e
+        for e in (urls_cache + urls_yt_cache + urls_gh_cache + urls_comic_cache)
+        if e.link in flagged_content_dict
+    ]
+
+
+# Peer instances write notes and flags too: into the shared notes.json and
+# their own flags.d/<id>.json on the JSON store, into their likes.d/<id>.sqlite
+# checkpoints on the SQLite one. refresh_user_data() stats those files and
+# only reads them when one changed. Notes merge as a union. Each instance
+# writes only the flags it counted itself, as it does its like shard, so the
+# merged count is the sum over instances plus the legacy flagged_content.json.
+USER_DATA_REFRESH_SECONDS = LIKES_MERGE_SECONDS
+_own_flags = {}  # flags counted by this instance, what its store writes
+_peer_flags = {}  # legacy base plus every other instance's flags, summed
+_user_data_stats = None  # (path, mtime_ns, size) of the files last merged
+_last_refresh = time.monotonic()  # when this instance last checked its peers
+
+
+def _shared_user_data_stats():
+    stats = []
+    try:
+        flag_names = sorted(os.listdir(DIR_FLAGS))
+    except FileNotFoundError:
+        flag_names = []
+    paths = (
+        [PATH_NOTES, PATH_FLAGGED]
+        + [os.path.join(DIR_FLAGS, name) for name in flag_names if name.endswith(".json")]
+        + [
+            os.path.join(DIR_LIKES, name)
+            for name, _, _ in _likes_dir_stats()
+            if name.endswith(".sqlite")
+        ]
+    )
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stats.append((path, st.st_mtime_ns, st.st_size))
+    return stats
+
+
+def _merge_notes(into, notes):
+    """Add `notes` to `into` copy-on-write; True if anything was new."""
+    changed = False
+    for url, entries in notes.items():
+        have = into.get(url, [])
+        new = [n for n in entries if n not in have]
+        if new:
+            into[url] = sorted(have + new, key=lambda n: n[1])
+            changed = True
+    return changed
+
+
+def _sum_flags(into, flags):
+    """Add `flags` counts into `into`; returns `into`."""
+    for url, count in flags.items():
+        into[url] = into.get(url, 0) + count
+    return into
+
+
+def merge_user_data():
+    """Fold notes and flags written by other instances into this one.
+
+    A stat per shared file when nothing changed. Returns True if anything
+    new was merged, after republishing the flagged pool.
+    """
+    global _user_data_stats, _peer_flags
+    stats = _shared_user_data_stats()
+    if stats == _user_data_stats:
+        return False
+    # A checkpoint supersedes the flags file its instance wrote before it
+    # moved to the SQLite store, as it does the JSON like shard.
+    checkpointed = {
+        os.path.basename(path)[: -len(".sqlite")]
+        for path, _, _ in stats
+        if path.endswith(".sqlite")
+    }
+    peer_notes, peer_flags = [], {}
+    for path, _, _ in stats:
+        instance = os.path.basename(path).rsplit(".", 1)[0]
+        if path == PATH_NOTES:
+            peer_notes.append(_load_json(PATH_NOTES, deserialize_notes) or {})
+        elif path == PATH_FLAGGED:
+            _sum_flags(peer_flags, _load_json(PATH_FLAGGED) or {})
+        elif path.endswith(".sqlite"):
+            notes, flags = _load_sqlite_user_data(path)
+            peer_notes.append(notes)
+            if instance != INSTANCE_ID:
+                _sum_flags(peer_flags, flags)
+        elif instance != INSTANCE_ID and instance not in checkpointed:
+            _sum_flags(peer_flags, _load_json(path) or {})
+    changed = False
+    with _user_data_cond:
+        for notes in peer_notes:
+            changed |= _merge_notes(notes_dict, notes)
+        before = flagged_content_dict
+        _peer_flags = peer_flags
+        _publish_flags()
+        changed |= flagged_content_dict != before
+    _user_data_stats = stats
+    if changed:
+        _rebuild_flagged_cache()
+    return changed
+
+
+def refresh_user_data():
+    """Scheduler job: pick up likes, notes and flags from peer instances."""
+    global _last_refresh
+    try:
+        merge_likes()
+        merge_user_data()
+    except Exception as e:
+        logger.error("Cannot refresh shared user data: %s", e)
+        return
+    _last_refresh = time.monotonic()
+
+
+def refresh_lag():
+    """Seconds since this instance last caught up with its peers' writes."""
+    return time.monotonic() - _last_refresh
+
+
+def _user_data_writer():
+    while True:
+        with _user_data_cond:
+            _user_data_cond.wait(USER_DATA_FLUSH_SECONDS)
+        try:
+            flush_user_data()
+        except Exception as e:  # keep the writer alive whatever the store does
+            logger.error("Notes and flags writer failed: %s", e)
+
+
+def checkpoint_store():
+    try:
+        _store.checkpoint()
+    except (OSError, sqlite3.Error) as e:
+        logger.error("Cannot checkpoint %s store: %s", _store.name, e)
+
+
 def time_ago(timestamp):
     delta = datetime.now() - timestamp
     seconds = delta.total_seconds()
@@ -659,6 +2276,47 @@ def make_excerpt(html, max_len=200):
     return truncated + "\u2026"
 
 
+def _build_river_fields(link, description, categories):
+    """Card fields for the river: (domain, excerpt, badge, river_query)."""
+    domain = display_domain(link)
+    badge = next(
+        (
+            (slug, CATEGORIES[slug][0], CATEGORIES[slug][2])
+            for slug in categories
+            if slug in CATEGORIES and slug != "spam"
+        ),
+        None,
+    )
+    return domain, make_excerpt(description, 200), badge, urlencode({"url": link})
+
+
+def _build_source_fields(feed_url, domain):
+    """Card fields from the feed registry: (source_name, more_query)."""
+    try:
+        source = feed_registry.get(normalize_feed_url(feed_url)) if feed_url else None
+    except ValueError:  # a via link urlsplit cannot parse
+        source = None
+    # "More from this blog": the river narrowed to the post's feed. A post
+    # without a rel="via" link is matched to a listed feed on its host; failing
+    # that ?domain= narrows it only when the host is the whole registrable
+    # domain, not one blog among many on a platform like substack.com.
+    listed = None if feed_url else feed_hosts.get(domain.lower())
+    more_query = ""
+    if feed_url or listed:
+        more_query = urlencode({"source": feed_url or listed.feed_url})
+    elif domain and _domain_key(domain) == domain.lower():
+        more_query = urlencode({"domain": domain})
+    return (source and source.name) or "", more_query
+
+
+def _with_source_fields(entry):
+    """`entry` with its registry fields re-derived; itself if they still hold."""
+    source_name, more_query = _build_source_fields(entry.feed_url, entry.display_domain)
+    if (source_name, more_query) == (entry.source_name, entry.more_query):
+        return entry
+    return entry._replace(source_name=source_name, more_query=more_query)
+
+
 prefix = os.environ.get("URL_PREFIX", "")
 app = Flask(__name__, static_url_path=prefix + "/static")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1)
@@ -749,7 +2407,7 @@ def _apply_search_filter(cache, search_query):
     phrases, words = _parse_search_query(search_query)
     if not phrases and not words:
         return cache
-    return [entry for entry in cache if _entry_matches(entry, phrases, words)]
+    return _narrow(cache, lambda entry: _entry_matches(entry, phrases, words))
 
 
 def _build_redirect_params():
@@ -766,6 +2424,7 @@ def _similar_candidate_cache(req):
     the other silently kept the old behaviour.
     """
     cache, current_mode = _select_mode_cache(req.args)
+    cache = _apply_source_filter(cache, *_source_args(req.args))
     cache = _apply_search_filter(cache, req.args.get("search", "").lower())
     current_cat = _resolve_current_cat(req, current_mode)
     return _apply_cat_filters(cache, current_cat, _excluded_cats(req))
@@ -779,6 +2438,7 @@ def _render_no_results(
     category_counts=None,
     no_results_cat="",
     feed_unavailable=False,
+    no_results_source="",
 ):
     """Render the index template with no results."""
     return render_template(
@@ -799,6 +2459,7 @@ def _render_no_results(
         search_query=search_query,
         no_results=True,
         no_results_cat=no_results_cat,
+        no_results_source=no_results_source,
         feed_unavailable=feed_unavailable,
         reactions_dict=OrderedDict(),
         reactions_list=[],
@@ -814,6 +2475,195 @@ def _render_no_results(
     )
 
 
+# GitHub repo metadata for Code mode. Page views only read this cache; a
+# background worker fills it, so rendering never waits on api.github.com.
+GITHUB_API = os.environ.get("SW_GITHUB_API", "https://api.github.com")
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN", "")
+GH_META_TTL = float(os.environ.get("SW_GH_META_TTL", "21600"))
+GH_META_NEGATIVE_TTL = 3600  # repos that 404 are not asked about again for this long
+GH_META_RETRY_SECONDS = 300  # after a network error or 5xx
+GH_META_MAX = 4096
+GH_META_TIMEOUT = 5
+# Requests left in the rate-limit window that only page views may spend;
+# the prefetcher stops short of them.
+GH_PREFETCH_RESERVE = 10
+
+_GH_REPO_RE = re.compile(r"https?://github\.com/([^/]+)/([^/#?]+)")
+
+_gh_meta_cache = OrderedDict()  # (owner, repo) lowercased -> (expires_at, meta or None)
+_gh_meta_lock = threading.Lock()
+_gh_queue = queue.Queue()
+_gh_pending = set()
+_gh_session = requests.Session()
+_gh_blocked_until = 0.0  # wall clock; set from the rate-limit headers
+_gh_remaining = None
+
+
+def _gh_repo(url):
+    """(owner, repo) for a github.com repo URL, else None."""
+    match = _GH_REPO_RE.match(url or "")
+    if not match:
+        return None
+    owner, repo = match.group(1), match.group(2)
+    if repo.endswith(".git"):
+        repo = repo[:-4]
+    return owner, repo
+
+
+def _gh_key(owner, repo):
+    return owner.lower(), repo.lower()
+
+
+def _gh_meta_from_json(data, owner, repo):
+    owner_data = data.get("owner") or {}
+    return {
+        "description": data.get("description") or "",
+        "stargazers_count": data.get("stargazers_count", 0),
+        "language": data.get("language") or "",
+        "forks_count": data.get("forks_count", 0),
+        "topics": data.get("topics", []),
+        "open_issues_count": data.get("open_issues_count", 0),
+        "homepage": data.get("homepage") or "",
+        "avatar_url": owner_data.get("avatar_url") or "",
+        "owner": owner,
+        "repo": repo,
+    }
+
+
+def _store_gh_meta(key, meta, ttl):
+    with _gh_meta_lock:
+        _gh_meta_cache[key] = (time.monotonic() + ttl, meta)
+        _gh_meta_cache.move_to_end(key)
+        while len(_gh_meta_cache) > GH_META_MAX:
+            _gh_meta_cache.popitem(last=False)
+
+
+def _note_rate_limit(resp):
+    """Track GitHub's rate-limit headers; back off until the window resets."""
+    global _gh_blocked_until, _gh_remaining
+    headers = resp.headers
+    try:
+        _gh_remaining = int(headers["X-RateLimit-Remaining"])
+    except (KeyError, ValueError):
+        pass
+    until = 0.0
+    if resp.status_code in (403, 429) and "Retry-After" in headers:
+        try:
+            until = time.time() + float(headers["Retry-After"])
+        except ValueError:
+            until = time.time() + GH_META_RETRY_SECONDS
+    elif _gh_remaining == 0 or resp.status_code in (403, 429):
+        try:
+            until = float(headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            until = time.time() + GH_META_RETRY_SECONDS
+    if until:
+        _gh_blocked_until = max(_gh_blocked_until, until)
+        return True
+    return False
+
+
+def fetch_gh_meta(owner, repo):
+    """Ask GitHub about one repo and cache the answer, good or bad."""
+    key = _gh_key(owner, repo)
+    headers = {"Accept": "application/vnd.github.v3+json"}
+    if GITHUB_TOKEN:
+        headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
+    try:
+        resp = _gh_session.get(
+            f"{GITHUB_API}/repos/{owner}/{repo}",
+            timeout=GH_META_TIMEOUT,
+            headers=headers,
+        )
+    except requests.RequestException as e:
+        logger.warning("GitHub metadata for %s/%s failed: %s", owner, repo, e)
+        resp = None
+    if resp is not None and _note_rate_limit(resp) and resp.status_code != 200:
+        logger.warning("GitHub rate limit hit, pausing until %d", _gh_blocked_until)
+        return
+    if resp is not None and resp.status_code == 200:
+        try:
+            meta = _gh_meta_from_json(resp.json(), owner, repo)
+        except ValueError:
+            meta = None
+        if meta is not None:
+            _store_gh_meta(key, meta, GH_META_TTL)
+            return
+    if resp is not None and resp.status_code in (404, 410, 451):
+        _store_gh_meta(key, None, GH_META_NEGATIVE_TTL)
+        return
+    # Transient failure: keep serving whatever we had, try again later.
+    with _gh_meta_lock:
+        cached = _gh_meta_cache.get(key)
+    _store_gh_meta(key, cached[1] if cached else None, GH_META_RETRY_SECONDS)
+
+
+def _enqueue_gh_meta(owner, repo, prefetch=False):
+    key = _gh_key(owner, repo)
+    with _gh_meta_lock:
+        if key in _gh_pending:
+            return
+        _gh_pending.add(key)
+    _gh_queue.put((owner, repo, prefetch))
+
+
+def gh_repo_meta(owner, repo):
+    """Cached metadata for a repo, stale or not; never blocks on GitHub.
+
+    A missing or expired entry is queued for the background worker, so the
+    next view of the repo sees the refreshed answer.
+    """
+    key = _gh_key(owner, repo)
+    with _gh_meta_lock:
+        cached = _gh_meta_cache.get(key)
+        if cached is not None:
+            _gh_meta_cache.move_to_end(key)
+    if cached is None or cached[0] <= time.monotonic():
+        _enqueue_gh_meta(owner, repo)
+    return cached[1] if cached else None
+
+
+def prefetch_gh_meta(entries):
+    """Queue every repo in `entries` that has no fresh cache entry."""
+    now = time.monotonic()
+    queued = set()
+    for entry in entries:
+        repo = _gh_repo(entry.link)
+        if repo is None:
+            continue
+        key = _gh_key(*repo)
+        if key in queued:
+            continue
+        with _gh_meta_lock:
+            cached = _gh_meta_cache.get(key)
+        if cached is None or cached[0] <= now:
+            queued.add(key)
+            _enqueue_gh_meta(*repo, prefetch=True)
+    return len(queued)
+
+
+def _gh_meta_worker():
+    while True:
+        owner, repo, prefetch = _gh_queue.get()
+        try:
+            # While rate limited, or when only the page-view reserve is left
+            # for a prefetch, drop the job: the next view or refresh queues
+            # it again and the stale entry is served meanwhile.
+            limited = time.time() < _gh_blocked_until or (
+                prefetch
+                and _gh_remaining is not None
+                and _gh_remaining <= GH_PREFETCH_RESERVE
+            )
+            if not limited:
+                fetch_gh_meta(owner, repo)
+        except Exception as e:  # keep the worker alive whatever GitHub sends
+            logger.error("GitHub metadata worker failed: %s", e)
+        finally:
+            with _gh_meta_lock:
+                _gh_pending.discard(_gh_key(owner, repo))
+            _gh_queue.task_done()
+
+
 def update_all():
     global \
         urls_cache, \
@@ -822,14 +2672,14 @@ def update_all():
         urls_gh_cache, \
         urls_comic_cache, \
         urls_flagged_cache, \
-        master_feed, \
-        likes_dict, \
-        liked_feed
+        master_feed
 
     url = API_BASE + "/"
 
     try:
         logger.info("begin update_all")
+        # Cards take their source names from the registry at ingest.
+        refresh_feed_lists()
 
         try:
             resp = requests.get(url, timeout=30)
@@ -868,35 +2718,53 @@ def update_all():
         if not urls_comic_cache or new_entries:
             urls_comic_cache = new_entries
 
-        # Prune likes_dict to only include URLs present in urls_cache or urls_yt_cache
-        current_urls = set(entry.link for entry in urls_cache + urls_yt_cache)
-        likes_dict = {
-            u: count for u, count in likes_dict.items() if u in current_urls
-        }
+        _install_corpus()
+        prefetch_gh_meta(urls_gh_cache)
+
+    except Exception as e:
+        logger.error("Error during update_all: %s", e)
+    finally:
+        logger.info("end update_all")
+
+
+def _install_corpus():
+    """Rebuild everything derived from the feed pools after they change."""
+    global urls_cache, urls_yt_cache, urls_gh_cache, urls_comic_cache, _likeable_entries
+    if refresh_feed_lists():
+        # Entries ingested against the previous lists name their sources
+        # from it; update_all() refreshes first, so normally only a follower's
+        # first snapshot gets here.
+        urls_cache, urls_yt_cache, urls_gh_cache, urls_comic_cache = (
+            [_with_source_fields(e) for e in pool]
+            for pool in (urls_cache, urls_yt_cache, urls_gh_cache, urls_comic_cache)
+        )
 
+    # Prune likes_dict to only include URLs present in urls_cache or urls_yt_cache
+    with _likes_lock:
+        _likeable_entries = {e.link: e for e in urls_cache + urls_yt_cache}
+        _publish_likes()
         # Build urls_liked_cache from liked entries in urls_cache and urls_yt_cache
-        urls_liked_cache = [
-            e for e in (urls_cache + urls_yt_cache) if e.link in likes_dict
-        ]
+        _rebuild_liked_cache()
 
-        # Build urls_flagged_cache from flagged entries in all caches
-        urls_flagged_cache = [
-            e
-            for e in (urls_cache + urls_yt_cache + urls_gh_cache + urls_comic_cache)
-            if e.link in flagged_content_dict
-        ]
+    # Build urls_flagged_cache from flagged entries in all caches
+    _rebuild_flagged_cache()
 
-        # Generate the liked feed
-        generate_liked_feed()
+    _rebuild_group_indexes()
+    _update_corpus_version()
 
-        # Update cached OPML
-        global opml_cache
-        opml_cache = generate_opml_feed()
 
-    except Exception as e:
-        logger.error("Error during update_all: %s", e)
-    finally:
-        logger.info("end update_all")
+def _update_corpus_version():
+    """Fingerprint the feed pools; a change invalidates every cached feed."""
+    global _corpus_version, _corpus_modified
+    digest = hashlib.blake2b(digest_size=8)
+    for pool in (urls_cache, urls_yt_cache, urls_gh_cache, urls_comic_cache):
+        for e in pool:
+            digest.update(f"{e.link}\0{e.updated.isoformat()}\n".encode())
+        digest.update(b"\1")
+    version = digest.hexdigest()
+    if version != _corpus_version:
+        _corpus_version = version
+        _corpus_modified = datetime.now(timezone.utc).replace(microsecond=0)
 
 
 def _extract_content(entry):
@@ -957,6 +2825,10 @@ def update_entries(url):
             haystack, title_tokens, rest_tokens, link_norm = _build_search_fields(
                 title, author, description, link
             )
+            domain, excerpt, badge, river_query = _build_river_fields(
+                link, description, categories
+            )
+            source_name, more_query = _build_source_fields(via_url, domain)
             formatted_entries.append(
                 FeedEntry(
                     link=link,
@@ -970,6 +2842,12 @@ def update_entries(url):
                     search_title_tokens=title_tokens,
                     search_rest_tokens=rest_tokens,
                     search_link=link_norm,
+                    display_domain=domain,
+                    excerpt=excerpt,
+                    badge=badge,
+                    river_query=river_query,
+                    source_name=source_name,
+                    more_query=more_query,
                 )
             )
 
@@ -980,28 +2858,36 @@ def update_entries(url):
         return []
 
 
-def load_public_suffix_list(file_path):
-    public_suffix_list = set()
-    with open(file_path, "r") as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("//"):
-                public_suffix_list.add(line)
-    return public_suffix_list
+PSL_CACHE_SIZE = 65536
+
+# Compiled once at image build (see psl.py); parsed from the text if not.
+public_suffix_trie = psl.load("public_suffix_list.dat")
 
 
-# Load the list from your actual file path
-public_suffix_list = load_public_suffix_list("public_suffix_list.dat")
+@lru_cache(maxsize=PSL_CACHE_SIZE)
+def registrable_domain(host):
+    """The registrable domain (public suffix plus one label) of `host`.
 
+    'a.b.example.co.uk' -> 'example.co.uk', 'me.github.io' -> 'me.github.io'.
+    None when the host is itself a public suffix or empty.
+    """
+    labels = host.lower().rstrip(".").split(".")
+    if not all(labels):
+        return None
+    n = psl.public_suffix_length(public_suffix_trie, labels)
+    if len(labels) <= n:
+        return None
+    return ".".join(labels[-n - 1:])
 
-def get_registered_domain(url):
-    parsed_url = urlparse(url)
-    netloc_parts = parsed_url.netloc.split(".")
-    for i in range(len(netloc_parts)):
-        possible_suffix = ".".join(netloc_parts[i:])
-        if possible_suffix in public_suffix_list:
-            return ".".join(netloc_parts[:i]) + "." + possible_suffix
-    return parsed_url.netloc
+
+@lru_cache(maxsize=PSL_CACHE_SIZE)
+def display_domain(url):
+    """Host shown on cards and headers: the full host without 'www.'.
+
+    Deliberately not registrable_domain(): 'bogleech.tumblr.com' and
+    'jim.substack.com' are who wrote the post, not 'tumblr.com'.
+    """
+    return urlparse(url).netloc.removeprefix("www.")
 
 
 # Domains that refuse to be framed (Tumblr sends X-Frame-Options: deny), so an
@@ -1012,9 +2898,8 @@ NO_EMBED_DOMAINS = {"tumblr.com"}
 def _is_embeddable(link):
     """False for a blocked domain or any of its subdomains.
 
-    Matches on the host suffix rather than get_registered_domain(), which keeps
-    every label before the public suffix ('bogleech.tumblr.com', not
-    'tumblr.com') because callers want the full host for display.
+    Matches on the host suffix rather than registrable_domain(), so blocking
+    'tumblr.com' covers every blog on it whether or not the PSL lists it.
     """
     host = (urlparse(link).hostname or "").lower()
     return not any(
@@ -1066,36 +2951,419 @@ def _excluded_cats(req):
 
 def _apply_cat_filters(cache, current_cat, excluded_cats):
     """Drop spam, user-hidden categories, and anything outside the chosen one."""
+    tests = []
     if current_cat != "spam":
-        cache = [entry for entry in cache if "spam" not in entry.categories]
+        tests.append(lambda entry: "spam" not in entry.categories)
 
     if excluded_cats and not current_cat:
-        cache = [
-            entry
-            for entry in cache
-            if not excluded_cats.intersection(entry.categories or ["uncategorized"])
-        ]
+        tests.append(
+            lambda entry: not excluded_cats.intersection(
+                entry.categories or ["uncategorized"]
+            )
+        )
+
+    if current_cat and current_cat in CATEGORIES:
+        if current_cat == "uncategorized":
+            tests.append(
+                lambda entry: not entry.categories
+                or "uncategorized" in entry.categories
+            )
+        else:
+            tests.append(lambda entry: current_cat in entry.categories)
+
+    if not tests:
+        return cache
+    return _narrow(cache, lambda entry: all(test(entry) for test in tests))
+
+
+def _domain_key(value):
+    """Registrable domain for a ?domain= host or URL.
+
+    A host that is itself a public suffix ('github.io') is its own key, so it
+    matches only posts served from that exact host. None when there is no
+    host at all.
+    """
+    host = display_domain(value) if "//" in value else value
+    host = host.split(":")[0].lower().rstrip(".")
+    return registrable_domain(host) or host or None
+
+
+def _entry_domain_key(entry):
+    return _domain_key(entry.display_domain or entry.link)
+
+
+def _build_group_index(pool):
+    by_source, by_domain = {}, {}
+    for row, entry in enumerate(pool):
+        if entry.feed_url:
+            by_source.setdefault(normalize_feed_url(entry.feed_url), []).append(row)
+        by_domain.setdefault(_entry_domain_key(entry), []).append(row)
+    return pool, by_source, by_domain
+
+
+def _rebuild_group_indexes():
+    """Index the current feed pools by source feed and by domain."""
+    global _group_indexes, _alias_tables, _source_weights, _pool_seen_codes, _pool_rows
+    pools = (urls_cache, urls_yt_cache, urls_gh_cache, urls_comic_cache)
+    indexes = {id(pool): _build_group_index(pool) for pool in pools}
+    _pool_rows = {
+        id(pool): (pool, {e.link: row for row, e in enumerate(pool)}) for pool in pools
+    }
+    _pool_seen_codes = {
+        id(pool): (
+            pool,
+            np.fromiter((_seen_code(e.link) for e in pool), np.uint32, len(pool)),
+        )
+        for pool in pools
+    }
+    tables, weights = {}, {}
+    if SAMPLING_MODE == "source":
+        for pool in pools:
+            pool_weights = _source_fair_weights(indexes[id(pool)])
+            tables[id(pool)] = (pool, *_build_alias_table(pool_weights))
+            for entry, weight in zip(pool, pool_weights):
+                weights.setdefault(entry.link, weight)
+    _group_indexes, _alias_tables, _source_weights = indexes, tables, weights
+
+
+# "uniform" draws every candidate post with equal probability, so a feed with
+# 200 posts in the pool comes up 200 times as often as a feed with one.
+# "source" weights each post by 1 / (posts from its source), so every source
+# is equally likely and its posts share that chance. "popular" weights each
+# post by (1 + its reactions) ** POPULARITY_EXPONENT.
+SAMPLING_MODE = os.environ.get("SAMPLING_MODE", "uniform")
+POPULARITY_EXPONENT = float(os.environ.get("POPULARITY_EXPONENT", "0.5"))
+# Draws from a pool's alias table or Fenwick tree that may be rejected (seen,
+# filtered out) before the pick falls back to weighting the candidates
+# directly.
+SAMPLING_DRAWS = 32
+
+
+class _Subset(list):
+    """A filtered pool that remembers where it came from.
+
+    `base` is the unfiltered pool, `rows` this list's positions in it and
+    `accept` the test every member passed. Weighted draws sample the base
+    pool's alias table or Fenwick tree and reject with `accept`, and
+    _seen_mask() reads the base pool's precomputed seen codes at `rows`.
+    """
+
+    __slots__ = ("base", "rows", "accept")
+
+
+def _origin(cache):
+    """(base pool, rows in it or None for all of them, test or None)."""
+    if isinstance(cache, _Subset):
+        return cache.base, cache.rows, cache.accept
+    return cache, None, None
+
+
+def _subset(cache, keep, accept):
+    """The entries of `cache` at positions `keep`, all of which pass `accept`."""
+    base, rows, test = _origin(cache)
+    keep = np.asarray(keep, dtype=np.intp)
+    out = _Subset(cache[i] for i in keep)
+    out.base = base
+    out.rows = keep if rows is None else rows[keep]
+    out.accept = accept if test is None else (lambda e: test(e) and accept(e))
+    return out
+
+
+def _narrow(cache, accept):
+    """`cache` filtered by `accept`, as a _Subset of its base pool."""
+    return _subset(cache, [i for i, e in enumerate(cache) if accept(e)], accept)
+
+
+def _member_lookup(cache):
+    """link -> that post if it is in `cache`, else None.
+
+    A pool indexed at ingest, or a _Subset of one, answers from its link ->
+    row map and the subset's test; anything else is mapped in one pass.
+    """
+    base, _, test = _origin(cache)
+    indexed = _pool_rows.get(id(base))
+    if indexed is None or indexed[0] is not base:
+        return {e.link: e for e in cache}.get
+    rows = indexed[1]
+
+    def lookup(link):
+        row = rows.get(link)
+        if row is None:
+            return None
+        entry = base[row]
+        return entry if test is None or test(entry) else None
+
+    return lookup
+
+
+def _source_fair_weights(index):
+    """Per-row weights for a _build_group_index() result.
+
+    A post's source is its feed; a post without a via link counts toward its
+    registrable domain among the other feedless posts.
+    """
+    pool, by_source, by_domain = index
+    weights = [0.0] * len(pool)
+    for rows in by_source.values():
+        for row in rows:
+            weights[row] = 1.0 / len(rows)
+    for rows in by_domain.values():
+        feedless = [row for row in rows if not pool[row].feed_url]
+        for row in feedless:
+            weights[row] = 1.0 / len(feedless)
+    return weights
+
+
+def _build_alias_table(weights):
+    """Vose's alias method: (prob, alias) lists for O(1) weighted draws.
+
+    Draw row i uniformly, keep it with probability prob[i], else take
+    alias[i].
+    """
+    n = len(weights)
+    total = sum(weights)
+    if not n or total <= 0:
+        return [1.0] * n, list(range(n))
+    scaled = [w * n / total for w in weights]
+    prob, alias = [1.0] * n, list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        prob[less], alias[less] = scaled[less], more
+        scaled[more] -= 1.0 - scaled[less]
+        (small if scaled[more] < 1.0 else large).append(more)
+    # Whatever is left is 1.0 up to rounding and keeps prob 1.0.
+    return prob, alias
+
+
+def _fair_choice(cache, accept=None):
+    """Source-fair random entry of `cache` that `accept` allows, or None.
+
+    Draws come from the alias table of the indexed pool `cache` is, or was
+    filtered from, in O(1) each; a draw outside `cache` or refused by
+    `accept` is retried. After SAMPLING_DRAWS misses (a small subset of a
+    big pool) the candidates are weighted directly in one pass. Either way
+    each post's chance is proportional to 1 / (posts from its source in the
+    full pool).
+    """
+    base, _, test = _origin(cache)
+    table = _alias_tables.get(id(base))
+    if table is not None and table[0] is base and base and cache:
+        pool, prob, alias = table
+        for _ in range(SAMPLING_DRAWS):
+            row = random.randrange(len(pool))
+            if random.random() >= prob[row]:
+                row = alias[row]
+            entry = pool[row]
+            if (test is None or test(entry)) and (accept is None or accept(entry)):
+                return entry
+    candidates = [e for e in cache if accept is None or accept(e)]
+    if not candidates:
+        return None
+    weights = [_source_weights.get(e.link, 1.0) for e in candidates]
+    return random.choices(candidates, weights=weights)[0]
+
+
+class FenwickTree:
+    """Prefix sums over a weight array: O(log n) reweight, append and draw."""
+
+    def __init__(self, weights):
+        self.weights = [float(w) for w in weights]
+        n = len(self.weights)
+        self.tree = [0.0] + self.weights  # 1-based; node i sums (i - lowbit(i), i]
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(self.weights)
+
+    def __len__(self):
+        return len(self.weights)
+
+    def set(self, row, weight):
+        delta = weight - self.weights[row]
+        self.weights[row] = weight
+        self.total += delta
+        i = row + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def append(self, weight):
+        i = len(self.tree)
+        node, low, j = weight, i - (i & -i), i - 1
+        while j > low:
+            node += self.tree[j]
+            j -= j & -j
+        self.tree.append(node)
+        self.weights.append(weight)
+        self.total += weight
+
+    def find(self, target):
+        """Row whose slot of the cumulative weights holds `target`."""
+        pos, step = 0, 1 << (len(self.weights).bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt < len(self.tree) and self.tree[nxt] <= target:
+                pos = nxt
+                target -= self.tree[nxt]
+            step >>= 1
+        return min(pos, len(self.weights) - 1)
+
+
+# Popularity sampling (SAMPLING_MODE=popular): id(pool) -> (pool, FenwickTree
+# of weights, link -> row) for the blog and liked pools. Rebuilt with the
+# liked pool and reweighted in place by each like; all under _likes_lock.
+_popularity_trees = {}
+
+
+def _popularity_weight(reactions):
+    """Smoothed weight of a post with `reactions` ({emoji: count} or None)."""
+    return (1 + sum(reactions.values()) if reactions else 1) ** POPULARITY_EXPONENT
+
+
+def _rebuild_popularity(changed=None):
+    """Rebuild the popularity trees from likes_dict. Hold _likes_lock.
+
+    With `changed`, the URLs a merge changed the reactions of, the blog
+    pool's tree is kept and reweighted at their rows only; the liked pool
+    was just replaced, and is rebuilt.
+    """
+    global _popularity_trees
+    if SAMPLING_MODE != "popular":
+        return
+    trees = {}
+    indexed = _popularity_trees.get(id(urls_cache))
+    if changed is not None and indexed is not None and indexed[0] is urls_cache:
+        _, tree, rows = indexed
+        for url in changed:
+            row = rows.get(url)
+            if row is not None:
+                tree.set(row, _popularity_weight(likes_dict.get(url)))
+        trees[id(urls_cache)] = indexed
+    for pool in (urls_cache, urls_liked_cache):
+        if id(pool) in trees:
+            continue
+        tree = FenwickTree(_popularity_weight(likes_dict.get(e.link)) for e in pool)
+        trees[id(pool)] = (pool, tree, {e.link: row for row, e in enumerate(pool)})
+    _popularity_trees = trees
+
+
+def _update_popularity(url):
+    """Reweight `url` after a like, appending it to a pool that grew by it.
+
+    Hold _likes_lock.
+    """
+    if SAMPLING_MODE != "popular":
+        return
+    weight = _popularity_weight(likes_dict.get(url))
+    for pool, tree, rows in _popularity_trees.values():
+        row = rows.get(url)
+        if row is not None:
+            tree.set(row, weight)
+        elif len(pool) == len(tree) + 1 and pool[-1].link == url:
+            rows[url] = len(tree)
+            tree.append(weight)
+
+
+def _popular_choice(cache, accept=None):
+    """Popularity-weighted random entry of `cache` that `accept` allows, or None.
+
+    Draws come from the Fenwick tree of the blog or liked pool `cache` is,
+    or was filtered from, in O(log n) each, rejecting as _fair_choice()
+    does; other pools, and subsets the draws keep missing, weight their
+    candidates in one pass.
+    """
+    base, _, test = _origin(cache)
+    indexed = _popularity_trees.get(id(base))
+    if indexed is not None and indexed[0] is base and indexed[1].total > 0 and cache:
+        pool, tree, _ = indexed
+        for _ in range(SAMPLING_DRAWS):
+            row = tree.find(random.random() * tree.total)
+            if row >= len(pool):
+                continue
+            entry = pool[row]
+            if (test is None or test(entry)) and (accept is None or accept(entry)):
+                return entry
+    candidates = [e for e in cache if accept is None or accept(e)]
+    if not candidates:
+        return None
+    weights = [_popularity_weight(likes_dict.get(e.link)) for e in candidates]
+    return random.choices(candidates, weights=weights)[0]
+
+
+def _weighted_choice(cache, accept=None):
+    if SAMPLING_MODE == "popular":
+        return _popular_choice(cache, accept)
+    return _fair_choice(cache, accept)
+
+
+def _sample(candidates):
+    """One random entry of a non-empty list, per SAMPLING_MODE."""
+    if SAMPLING_MODE in ("source", "popular"):
+        return _weighted_choice(candidates)
+    return random.choice(candidates)
+
+
+def _source_args(args):
+    """(source, domain) filter values from request args, "" when absent."""
+    return args.get("source", "").strip(), args.get("domain", "").strip()
+
+
+def _apply_source_filter(cache, source, domain):
+    """Only posts from one feed (`source`, its URL) and/or one domain.
+
+    An indexed pool is answered from its group-by rows; derived pools (recent,
+    liked, flagged) are scanned with the same keys.
+    """
+    if not source and not domain:
+        return cache
+    try:
+        source_key = normalize_feed_url(source) if source else None
+        domain_key = _domain_key(domain) if domain else None
+    except ValueError:
+        # Not a URL urlsplit can parse ('http://[bad'): nothing comes from it.
+        return []
+    if domain and domain_key is None:
+        # Not a host: nothing comes from it.
+        return []
 
-    if current_cat and current_cat in CATEGORIES:
-        if current_cat == "uncategorized":
-            cache = [
-                entry
-                for entry in cache
-                if not entry.categories or "uncategorized" in entry.categories
-            ]
+    def accept(e):
+        return (
+            source_key is None
+            or (e.feed_url and normalize_feed_url(e.feed_url) == source_key)
+        ) and (domain_key is None or _entry_domain_key(e) == domain_key)
+
+    indexed = _group_indexes.get(id(cache))
+    if indexed is not None and indexed[0] is cache:
+        _, by_source, by_domain = indexed
+        if source_key is not None:
+            rows = by_source.get(source_key, ())
         else:
-            cache = [entry for entry in cache if current_cat in entry.categories]
+            rows = by_domain.get(domain_key, ())
+        if source_key is not None and domain_key is not None:
+            rows = [row for row in rows if _entry_domain_key(cache[row]) == domain_key]
+        return _subset(cache, rows, accept)
+    return _narrow(cache, accept)
 
-    return cache
 
+def _with_source_params(url, source, domain):
+    """`url` with the ?source= / ?domain= filters that are set appended."""
+    params = {k: v for k, v in (("source", source), ("domain", domain)) if v}
+    if not params:
+        return url
+    return url + ("&" if "?" in url else "?") + urlencode(params)
 
-def _liked_pool(search_query, current_cat, excluded_cats):
+
+def _liked_pool(search_query, current_cat, excluded_cats, source="", domain=""):
     """Liked posts narrowed by the same filters as the main pool.
 
     _pick_next_entry draws its occasional surprise post from here, so the
-    surprise cannot land outside an active search or category.
+    surprise cannot land outside an active search, category or source.
     """
-    pool = _apply_search_filter(urls_liked_cache, search_query)
+    pool = _apply_source_filter(urls_liked_cache, source, domain)
+    pool = _apply_search_filter(pool, search_query)
     return _apply_cat_filters(pool, current_cat, excluded_cats)
 
 
@@ -1122,16 +3390,20 @@ def _pick_next_entry(
             return cache[cur_idx + 1]
         return None
 
-    # Exclude current URL from next candidates, then pick unseen
-    next_pool = [e for e in cache if _url_key(e.link) != current_key]
-    if not next_pool:
-        # Single-post pool (e.g. a search with one match): loop back to the
-        # same post so the Next button never disappears.
-        return cache[0]
+    # Pick unseen; the current URL is in seen_plus, so that excludes it too
     seen_plus = seen | {_hash_url(url)}
-    next_candidates = [e for e in next_pool if _hash_url(e.link) not in seen_plus]
+    seen_codes = {_token_code(t) for t in seen_plus}
+    next_candidates = _subset(
+        cache,
+        np.flatnonzero(~_seen_mask(cache, seen_plus)),
+        lambda e: _seen_code(e.link) not in seen_codes,
+    )
     if not next_candidates:
-        next_candidates = next_pool
+        next_candidates = _narrow(cache, lambda e: _url_key(e.link) != current_key)
+        if not next_candidates:
+            # Single-post pool (e.g. a search with one match): loop back to
+            # the same post so the Next button never disappears.
+            return cache[0]
     # 7% chance next post comes from the liked pool (unseen). Blogs only: the
     # liked pool is blog posts, so surfacing one while browsing Comics or Videos
     # drops the reader out of the mode they chose.
@@ -1143,15 +3415,19 @@ def _pick_next_entry(
         ]
         if liked_unseen:
             return random.choice(liked_unseen)
-    # 60% chance to stay in the same category when browsing all
-    if not current_cat and post_cats and random.random() < 0.6:
-        same_cat = [
-            e for e in next_candidates
-            if any(c in e.categories for c in post_cats)
-        ]
+    # 60% chance to stay on the same topic when browsing all
+    cluster_mode = SAME_TOPIC_MODE == "cluster"
+    if not current_cat and (post_cats or cluster_mode) and random.random() < 0.6:
+        if cluster_mode:
+            same_topic = _pick_same_cluster(url, next_candidates)
+            if same_topic is not None:
+                return same_topic
+        same_cat = _narrow(
+            next_candidates, lambda e: any(c in e.categories for c in post_cats)
+        )
         if same_cat:
             next_candidates = same_cat
-    return random.choice(next_candidates)
+    return _sample(next_candidates)
 
 
 @app.route("/")
@@ -1171,6 +3447,16 @@ def index():
     # category or excluded-category filters would hide it.
     mode_cache = cache
 
+    source, domain = _source_args(request.args)
+    cache = _apply_source_filter(cache, source, domain)
+    if (source or domain) and not cache:
+        return _render_no_results(
+            current_mode,
+            title="No results found",
+            search_query=search_query,
+            no_results_source=source or domain,
+        )
+
     if (
         search_query.strip()
     ):  # Only perform search if query is not empty or just whitespace
@@ -1272,7 +3558,7 @@ def index():
         post_cats,
         current_cat,
         current_mode,
-        _liked_pool(search_query, current_cat, excluded_cats),
+        _liked_pool(search_query, current_cat, excluded_cats, source, domain),
     )
     if next_entry:
         next_params = request.args.to_dict(flat=True)
@@ -1283,8 +3569,7 @@ def index():
     short_url = re.sub(r"^https?://(www\.)?", "", url)
     short_url = short_url.rstrip("/")
 
-    domain = get_registered_domain(url)
-    domain = re.sub(r"^(www\.)?", "", domain)
+    domain = display_domain(url)
 
     videoid = ""
 
@@ -1316,35 +3601,12 @@ def index():
         (s, CATEGORIES[s][0], CATEGORIES[s][2]) for s in post_cats if s in CATEGORIES
     ]
 
-    # GitHub API enrichment for Code mode
+    # GitHub API enrichment for Code mode, from the metadata cache
     gh_meta = None
     if current_mode == 3:
-        gh_match = re.match(r"https?://github\.com/([^/]+)/([^/]+)", url)
-        if gh_match:
-            owner, repo = gh_match.group(1), gh_match.group(2)
-            try:
-                gh_resp = requests.get(
-                    f"https://api.github.com/repos/{owner}/{repo}",
-                    timeout=5,
-                    headers={"Accept": "application/vnd.github.v3+json"},
-                )
-                if gh_resp.status_code == 200:
-                    data = gh_resp.json()
-                    owner_data = data.get("owner") or {}
-                    gh_meta = {
-                        "description": data.get("description") or "",
-                        "stargazers_count": data.get("stargazers_count", 0),
-                        "language": data.get("language") or "",
-                        "forks_count": data.get("forks_count", 0),
-                        "topics": data.get("topics", []),
-                        "open_issues_count": data.get("open_issues_count", 0),
-                        "homepage": data.get("homepage") or "",
-                        "avatar_url": owner_data.get("avatar_url") or "",
-                        "owner": owner,
-                        "repo": repo,
-                    }
-            except requests.RequestException:
-                pass
+        gh_repo = _gh_repo(url)
+        if gh_repo:
+            gh_meta = gh_repo_meta(*gh_repo)
 
     # Build feed URL for <link rel="alternate">
     if current_mode == 6:
@@ -1361,6 +3623,7 @@ def index():
         feed_url = prefix + "/feed?cat=" + current_cat
     else:
         feed_url = prefix + "/feed"
+    feed_url = _with_source_params(feed_url, source, domain)
 
     # Calculate counts
     all_count = len(urls_cache) if urls_cache else 0
@@ -1440,39 +3703,90 @@ def index():
 RIVER_PAGE_SIZE = 50
 
 
+def _river_cursor(entries, keys, end):
+    """Opaque cursor for the page starting at `end`.
+
+    Encodes the last shown timestamp plus a row: how many posts with that
+    timestamp were already shown. It stays put when newer posts arrive or the
+    corpus is re-sorted, and is shared by /river and /api/river.
+    """
+    last = end - 1
+    row = last - bisect.bisect_left(keys, keys[last]) + 1
+    raw = f"{entries[last].updated.isoformat()}_{row}".encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _decode_river_cursor(cursor):
+    """(sort key, row) from a cursor, or None if it does not parse."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        stamp, _, row = raw.rpartition("_")
+        return -datetime.fromisoformat(stamp).timestamp(), int(row)
+    except ValueError:
+        return None
+
+
+def _river_cursor_start(keys, cursor):
+    """Index a cursor resumes at, or None if it does not parse."""
+    decoded = _decode_river_cursor(cursor)
+    if decoded is None:
+        return None
+    key, row = decoded
+    first = bisect.bisect_left(keys, key)
+    return first + max(0, min(row, bisect.bisect_right(keys, key) - first))
+
+
+def _river_card(entry, mode):
+    """Template/JSON fields for one river card."""
+    sw_url = prefix + "/?" + entry.river_query
+    more_url = None
+    if entry.more_query:
+        more_url = prefix + "/river?" + (f"{mode}=&" if mode else "") + entry.more_query
+    if mode:
+        sw_url += f"&{mode}="
+    return {
+        "link": entry.link,
+        "sw_url": sw_url,
+        "title": entry.title,
+        "domain": entry.source_name or entry.display_domain,
+        "date": river_date(entry.updated),
+        "excerpt": entry.excerpt,
+        "badge": entry.badge,
+        "feed_url": entry.feed_url,
+        "more_url": more_url,
+    }
+
+
+def _river_spec(args):
+    """(kind, mode, topic, feed_url) for a river request's query params."""
+    for mode in ("yt", "gh", "comic"):
+        if mode in args:
+            kind, feed_url = mode, prefix + f"/feed?{mode}"
+            break
+    else:
+        kind, mode, feed_url = "blogs", "", prefix + "/feed"
+    topic = args.get("topic", "")
+    if topic in CATEGORIES:
+        feed_url = prefix + f"/feed?cat={topic}"
+    else:
+        topic = ""
+    return kind, mode, topic, feed_url
+
+
 @app.route("/river")
 @app.route(f"{prefix}/river")
 def river():
-    """River view: reverse-chronological card stream."""
-    # Pick cache based on mode
-    if "yt" in request.args:
-        cache = sorted(urls_yt_cache, key=lambda e: e.updated, reverse=True)
-        mode = "yt"
-        feed_url = prefix + "/feed?yt"
-    elif "gh" in request.args:
-        cache = sorted(urls_gh_cache, key=lambda e: e.updated, reverse=True)
-        mode = "gh"
-        feed_url = prefix + "/feed?gh"
-    elif "comic" in request.args:
-        cache = sorted(urls_comic_cache, key=lambda e: e.updated, reverse=True)
-        mode = "comic"
-        feed_url = prefix + "/feed?comic"
-    else:
-        cache = sorted(urls_cache, key=lambda e: e.updated, reverse=True)
-        mode = ""
-        feed_url = prefix + "/feed"
-
-    # Exclude spam
-    cache = [e for e in cache if "spam" not in e.categories]
+    """River view: reverse-chronological card stream.
 
-    # Topic filtering
-    topic = request.args.get("topic", "")
-    if topic and topic in CATEGORIES:
-        if topic == "uncategorized":
-            cache = [e for e in cache if not e.categories or "uncategorized" in e.categories]
-        else:
-            cache = [e for e in cache if topic in e.categories]
-        feed_url = prefix + f"/feed?cat={topic}"
+    Pages through the presorted order with a timestamp+row `cursor`, so a
+    deep page is a bisect rather than a sort and a slice from the top.
+    `?page=N` links from before the cursor still work. `source` (a feed URL)
+    or `domain` narrows the stream to one blog.
+    """
+    kind, mode, topic, feed_url = _river_spec(request.args)
+    source, domain = _source_args(request.args)
+    feed_url = _with_source_params(feed_url, source, domain)
+    entries, keys = _feed_order(kind, topic, True, source, domain)
 
     # Pagination
     page = request.args.get("page", "1")
@@ -1480,52 +3794,24 @@ def river():
         page = max(1, int(page))
     except ValueError:
         page = 1
+    start = None
+    if request.args.get("cursor"):
+        start = _river_cursor_start(keys, request.args["cursor"])
+    if start is None:
+        start = (page - 1) * RIVER_PAGE_SIZE
 
-    total = len(cache)
-    start = (page - 1) * RIVER_PAGE_SIZE
+    total = len(entries)
     end = start + RIVER_PAGE_SIZE
-    entries = cache[start:end]
     has_next = end < total
-
-    # Build cards with pre-computed display fields
-    cards = []
-    for entry in entries:
-        domain = get_registered_domain(entry.link)
-        domain = re.sub(r"^(www\.)?", "", domain)
-        desc = entry.description or ""
-        excerpt = make_excerpt(desc, 200)
-        # Topic badge: first non-spam category
-        badge = None
-        for cat_slug in entry.categories:
-            if cat_slug in CATEGORIES and cat_slug != "spam":
-                badge = (cat_slug, CATEGORIES[cat_slug][0], CATEGORIES[cat_slug][2])
-                break
-        # Build Small Web URL: /?url=<post>&mode_param
-        sw_params = {"url": entry.link}
-        if mode == "yt":
-            sw_params["yt"] = ""
-        elif mode == "gh":
-            sw_params["gh"] = ""
-        elif mode == "comic":
-            sw_params["comic"] = ""
-        sw_url = prefix + "/?" + urlencode(sw_params)
-        cards.append({
-            "link": entry.link,
-            "sw_url": sw_url,
-            "title": entry.title,
-            "domain": domain,
-            "date": river_date(entry.updated),
-            "excerpt": excerpt,
-            "badge": badge,
-            "feed_url": entry.feed_url,
-        })
+    cards = [_river_card(entry, mode) for entry in entries[start:end]]
 
     # Build next page URL preserving params
-    next_page_url = None
+    next_page_url = next_api_url = None
     if has_next:
-        params = {k: v for k, v in request.args.items() if k != "page"}
-        params["page"] = str(page + 1)
+        params = {k: v for k, v in request.args.items() if k not in ("page", "cursor")}
+        params["cursor"] = _river_cursor(entries, keys, end)
         next_page_url = prefix + "/river?" + urlencode(params)
+        next_api_url = prefix + "/api/river?" + urlencode(params)
 
     return render_template(
         "river.html",
@@ -1533,6 +3819,7 @@ def river():
         page=page,
         has_next=has_next,
         next_page_url=next_page_url,
+        next_api_url=next_api_url,
         mode=mode,
         topic=topic,
         prefix=prefix + "/",
@@ -1543,6 +3830,89 @@ def river():
     )
 
 
+RIVER_API_MAX = 200
+
+
+@app.route("/api/river")
+@app.route(f"{prefix}/api/river")
+def api_river():
+    """River cards as JSON, for infinite scroll and cheap polling.
+
+    Takes the /river params (`yt`/`gh`/`comic` or `mode=`, `topic`, `source`,
+    `domain`) plus an opaque `cursor` from a previous page's `next_cursor`,
+    `limit`, and `since`, a `latest` value from an earlier response: only posts
+    newer than it are returned. Cards carry `updated` instead of the relative
+    date, so a response depends only on the corpus version and its ETag holds
+    until the corpus changes.
+    """
+    args = request.args.to_dict()
+    mode_arg = args.pop("mode", "")
+    if mode_arg in ("yt", "gh", "comic"):
+        args[mode_arg] = ""
+    kind, mode, topic, _ = _river_spec(args)
+    source, domain = _source_args(request.args)
+
+    try:
+        limit = int(request.args.get("limit", RIVER_PAGE_SIZE))
+    except ValueError:
+        limit = RIVER_PAGE_SIZE
+    limit = max(1, min(limit, RIVER_API_MAX))
+    cursor = request.args.get("cursor", "")
+    since = request.args.get("since", "")
+
+    etag = hashlib.blake2b(
+        f"{_feed_version(kind)}\0{kind}\0{topic}\0{limit}\0{cursor}\0{since}"
+        f"\0{source}\0{domain}".encode(),
+        digest_size=8,
+    ).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    entries, keys = _feed_order(kind, topic, True, source, domain)
+    stop = len(entries)
+    if since:
+        # Only posts strictly newer than the `since` timestamp.
+        decoded = _decode_river_cursor(since)
+        if decoded is None:
+            return jsonify({"error": "invalid since"}), 400
+        stop = bisect.bisect_left(keys, decoded[0])
+    start = 0
+    if cursor:
+        start = _river_cursor_start(keys, cursor)
+        if start is None:
+            return jsonify({"error": "invalid cursor"}), 400
+    end = max(start, min(start + limit, stop))
+
+    cards = []
+    for entry in entries[start:end]:
+        card = _river_card(entry, mode)
+        del card["date"]
+        card["updated"] = entry.updated.isoformat() + "Z"
+        if card["badge"]:
+            slug, label, emoji = card["badge"]
+            card["badge"] = {"slug": slug, "label": label, "emoji": emoji}
+        cards.append(card)
+
+    params = {k: v for k, v in request.args.items() if k != "cursor"}
+    next_cursor = next_url = None
+    if end < stop:
+        next_cursor = params["cursor"] = _river_cursor(entries, keys, end)
+        next_url = prefix + "/api/river?" + urlencode(params)
+    response = jsonify({
+        "cards": cards,
+        "next_cursor": next_cursor,
+        "next_url": next_url,
+        # Pass back as `since` to poll for newer posts.
+        "latest": _river_cursor(entries, keys, 1) if entries else None,
+    })
+    response.set_etag(etag)
+    # Cacheable, but revalidated: the ETag is what keeps polling cheap.
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
 @app.route("/similar")
 @app.route(f"{prefix}/similar")
 def similar():
@@ -1576,7 +3946,8 @@ def like():
         emoji = emoji_from_form
 
     if url:
-        _apply_like(url, emoji=emoji, count=1)
+        if _apply_like(url, emoji=emoji, count=1) is None:
+            return Response("like not saved\n", status=503, mimetype="text/plain")
 
         # Always try to redirect to a similar post after a like
         if url in embeddings_cache:
@@ -1621,6 +3992,8 @@ def api_like():
         emoji = emoji_from_input
 
     entry = _apply_like(url, emoji=emoji, count=1)
+    if entry is None:
+        return jsonify({"ok": False, "error": "like not saved"}), 503
     return jsonify(
         {
             "ok": True,
@@ -1658,6 +4031,8 @@ def api_likes():
         return jsonify({"ok": False, "error": "count must be greater than 0"}), 400
 
     entry = _apply_like(url, emoji=emoji, count=count)
+    if entry is None:
+        return jsonify({"ok": False, "error": "like not saved"}), 503
     return jsonify(
         {
             "ok": True,
@@ -1674,25 +4049,12 @@ def api_likes():
 @app.post("/note")
 @app.post(f"{prefix}/note")
 def note():
-    global notes_dict, time_saved_notes
     url = request.form.get("url")
     note_content = request.form.get("note_content")
 
     # Add the new note to the notes list for this URL
     if url and note_content:
-        timestamp = datetime.now()
-        if url not in notes_dict:
-            notes_dict[url] = []
-        notes_dict[url].append((note_content, timestamp))
-
-        # Save to disk
-        if (datetime.now() - time_saved_notes).total_seconds() > 60:
-            time_saved_notes = datetime.now()
-            try:
-                with open(PATH_NOTES, "w", encoding="utf-8") as file:
-                    json.dump(serialize_notes(notes_dict), file)
-            except OSError as e:
-                logger.error("Cannot write notes file: %s", e)
+        _add_note(url, note_content)
 
     query_string = _build_redirect_params()
     redirect_path = f"{prefix}/?url={url}"
@@ -1704,7 +4066,6 @@ def note():
 @app.post("/flag_content")
 @app.post(f"{prefix}/flag_content")
 def flag_content():
-    global flagged_content_dict, time_saved_flagged_content
     url = request.form.get("url")
 
     # Check if user has already flagged this URL using cookie
@@ -1714,20 +4075,11 @@ def flag_content():
 
     if url and not already_flagged:
         # Increment flagged content count
-        flagged_content_dict[url] = flagged_content_dict.get(url, 0) + 1
+        _add_flag(url)
 
         # Add URL to user's flagged set
         flagged_urls.add(url)
 
-        # Save to disk
-        if (datetime.now() - time_saved_flagged_content).total_seconds() > 60:
-            time_saved_flagged_content = datetime.now()
-            try:
-                with open(PATH_FLAGGED, "w", encoding="utf-8") as file:
-                    json.dump(flagged_content_dict, file)
-            except OSError as e:
-                logger.error("Cannot write flagged content file: %s", e)
-
     query_string = _build_redirect_params()
 
     # Create response with updated cookie
@@ -1753,46 +4105,106 @@ def get_page():
     return app.send_static_file("extension.html")
 
 
-@app.route("/feed")
-@app.route(f"{prefix}/feed")
-def feed():
-    """Per-mode Atom feed. Accepts the same query params as the main route."""
-    if "recent" in request.args:
-        cache = sorted(urls_cache, key=lambda e: e.updated, reverse=True)
-        title = "Kagi Small Web - Recent"
-        feed_url = "https://kagi.com/smallweb/feed?recent"
-    elif "yt" in request.args:
-        cache, title = urls_yt_cache, "Kagi Small Web - Videos"
-        feed_url = "https://kagi.com/smallweb/feed?yt"
+def _feed_spec(args):
+    """(kind, cat, title, feed_url) for a /feed request's query params."""
+    if "recent" in args:
+        return "recent", "", "Kagi Small Web - Recent", "https://kagi.com/smallweb/feed?recent"
+    if "yt" in args:
+        return "yt", "", "Kagi Small Web - Videos", "https://kagi.com/smallweb/feed?yt"
     # `?app` is kept as a legacy alias for older native-app builds.
-    elif "liked" in request.args or "app" in request.args:
-        cache, title = urls_liked_cache, "Kagi Small Web - Liked"
-        feed_url = "https://kagi.com/smallweb/feed?liked"
-    elif "gh" in request.args:
-        cache, title = urls_gh_cache, "Kagi Small Web - Code"
-        feed_url = "https://kagi.com/smallweb/feed?gh"
-    elif "comic" in request.args:
-        cache, title = urls_comic_cache, "Kagi Small Web - Comics"
-        feed_url = "https://kagi.com/smallweb/feed?comic"
-    else:
-        cache, title = urls_cache, "Kagi Small Web"
-        cat = request.args.get("cat", "")
-        if cat and cat in CATEGORIES:
-            title += f" - {CATEGORIES[cat][0]}"
-            feed_url = f"https://kagi.com/smallweb/feed?cat={cat}"
-            if cat == "uncategorized":
-                cache = [
-                    e
-                    for e in cache
-                    if not e.categories or "uncategorized" in e.categories
-                ]
-            else:
-                cache = [e for e in cache if cat in e.categories]
-        else:
-            feed_url = "https://kagi.com/smallweb/feed"
+    if "liked" in args or "app" in args:
+        return "liked", "", "Kagi Small Web - Liked", "https://kagi.com/smallweb/feed?liked"
+    if "gh" in args:
+        return "gh", "", "Kagi Small Web - Code", "https://kagi.com/smallweb/feed?gh"
+    if "comic" in args:
+        return "comic", "", "Kagi Small Web - Comics", "https://kagi.com/smallweb/feed?comic"
+    cat = args.get("cat", "")
+    if cat and cat in CATEGORIES:
+        return (
+            "blogs",
+            cat,
+            f"Kagi Small Web - {CATEGORIES[cat][0]}",
+            f"https://kagi.com/smallweb/feed?cat={cat}",
+        )
+    return "blogs", "", "Kagi Small Web", "https://kagi.com/smallweb/feed"
+
+
+def _feed_entries(kind, cat, source="", domain=""):
+    """The posts a /feed variant lists, unordered."""
+    cache = {
+        "yt": urls_yt_cache,
+        "liked": urls_liked_cache,
+        "gh": urls_gh_cache,
+        "comic": urls_comic_cache,
+    }.get(kind, urls_cache)
+    cache = _apply_source_filter(cache, source, domain)
+    if cat == "uncategorized":
+        return [e for e in cache if not e.categories or "uncategorized" in e.categories]
+    if cat:
+        return [e for e in cache if cat in e.categories]
+    return list(cache)
+
+
+def _feed_order(kind, cat, river=False, source="", domain=""):
+    """A variant's posts newest first, sorted once per version.
+
+    Returns (entries, keys) where keys[i] is -entries[i].updated as a POSIX
+    timestamp, ascending, so a timestamp cursor is one bisect. Posts sharing a
+    timestamp are ordered by link, so the order is the same on every instance
+    and across refreshes. The river's order leaves out spam. A source or
+    domain filter comes from the group-by index and is sorted per call, which
+    costs O(matches) rather than a cache entry per feed.
+    """
+    if source or domain:
+        entries = _feed_entries(kind, cat, source, domain)
+        if river:
+            entries = [e for e in entries if "spam" not in e.categories]
+        entries.sort(key=lambda e: (e.updated, e.link), reverse=True)
+        return entries, [-e.updated.timestamp() for e in entries]
+    version = _feed_version(kind)
+    cached = _feed_orders.get((kind, cat, river))
+    if cached is None or cached[0] != version:
+        entries = _feed_entries(kind, cat)
+        if river:
+            entries = [e for e in entries if "spam" not in e.categories]
+        entries.sort(key=lambda e: (e.updated, e.link), reverse=True)
+        keys = [-e.updated.timestamp() for e in entries]
+        cached = (version, entries, keys)
+        _feed_orders[(kind, cat, river)] = cached
+    return cached[1], cached[2]
+
+
+def _feed_page(kind, cat, limit, before, source="", domain=""):
+    """(entries, next cursor or None) for one page of a variant.
+
+    A page never ends partway through posts sharing a timestamp, so the
+    strictly-older `before` cursor never skips one; such a page runs a few
+    over `limit`.
+    """
+    entries, keys = _feed_order(kind, cat, source=source, domain=domain)
+    start = bisect.bisect_right(keys, -before.timestamp()) if before else 0
+    end = len(entries) if limit is None else min(start + limit, len(entries))
+    while 0 < end < len(entries) and keys[end] == keys[end - 1]:
+        end += 1
+    cursor = entries[end - 1].updated if end < len(entries) else None
+    return entries[start:end], cursor
+
 
-    atom = AtomFeed(title, feed_url=feed_url)
-    for entry in cache:
+def _feed_version(kind):
+    if kind == "liked":
+        return f"{_corpus_version}-{_liked_version}"
+    return _corpus_version
+
+
+def _feed_modified(kind):
+    if kind == "liked":
+        return max(_corpus_modified, _liked_modified)
+    return _corpus_modified
+
+
+def _render_feed(title, feed_url, entries, links=()):
+    atom = AtomFeed(title, feed_url=feed_url, links=list(links))
+    for entry in entries:
         atom.add(
             title=entry.title,
             content=entry.description,
@@ -1801,7 +4213,135 @@ def feed():
             updated=entry.updated,
             author=entry.author,
         )
-    return Response(atom.to_string(), mimetype="application/atom+xml")
+    return atom.to_string()
+
+
+def _stream_feed(title, feed_url, entries, links=()):
+    """Yield an Atom document entry by entry instead of building it whole."""
+    updated = entries[0].updated if entries else datetime.now(timezone.utc)
+    head = list(AtomFeed(title, feed_url=feed_url, links=list(links), updated=updated).generate())
+    # Everything but the closing </feed>.
+    yield "".join(head[:-1])
+    for entry in entries:
+        atom_entry = AtomEntry(
+            title=entry.title,
+            content=entry.description,
+            content_type="html",
+            url=entry.link,
+            updated=entry.updated,
+            # With no feed-level author, Atom needs one on every entry.
+            author=entry.author or "Unknown author",
+        )
+        yield "".join("  " + line for line in atom_entry.generate())
+    yield head[-1]
+
+
+FEED_DEFAULT_LIMIT = 500
+# Pages larger than this (or ?limit=all) are streamed rather than built whole.
+FEED_STREAM_MIN = 2000
+
+
+def _feed_page_url(feed_url, limit, before=None):
+    params = {}
+    if limit != FEED_DEFAULT_LIMIT:
+        params["limit"] = "all" if limit is None else limit
+    if before is not None:
+        params["before"] = before.isoformat()
+    if not params:
+        return feed_url
+    return feed_url + ("&" if "?" in feed_url else "?") + urlencode(params)
+
+
+@app.route("/feed")
+@app.route(f"{prefix}/feed")
+def feed():
+    """Per-mode Atom feed, newest first. Accepts the main route's query params.
+
+    `limit` (default FEED_DEFAULT_LIMIT, or `all`) and `before` (a timestamp
+    cursor from the previous page's rel="next" link) page through the
+    variant as an RFC 5005 paged feed. The first page is serialized and
+    gzipped once per corpus version; a poller that sends back the ETag gets a
+    304 before any of that is even looked up. Large exports are streamed.
+    """
+    kind, cat, title, feed_url = _feed_spec(request.args)
+    source, domain = _source_args(request.args)
+    if source or domain:
+        try:
+            row = feed_registry.get(normalize_feed_url(source)) if source else None
+        except ValueError:
+            row = None
+        title += f" - {(row.name or row.host) if row else source or domain}"
+        feed_url = _with_source_params(feed_url, source, domain)
+    if request.args.get("limit") == "all":
+        limit = None
+    else:
+        try:
+            limit = int(request.args.get("limit", FEED_DEFAULT_LIMIT))
+        except ValueError:
+            limit = FEED_DEFAULT_LIMIT
+        limit = max(1, limit)
+    before = None
+    if request.args.get("before"):
+        try:
+            before = datetime.fromisoformat(request.args["before"])
+            if before.tzinfo is not None:
+                # Post timestamps are naive UTC.
+                before = before.astimezone(timezone.utc).replace(tzinfo=None)
+            # The sort key _feed_page() bisects on; out of range at the edges
+            # of datetime's (0001-01-01T00:00:00).
+            before.timestamp()
+        except (ValueError, OverflowError):
+            return jsonify({"error": "before must be an ISO 8601 timestamp"}), 400
+
+    version = _feed_version(kind)
+    first_page = limit == FEED_DEFAULT_LIMIT and before is None
+    first_page = first_page and not (source or domain)
+    gzipped = first_page and "gzip" in request.accept_encodings
+    etag = hashlib.blake2b(
+        f"{kind}\0{cat}\0{version}\0{limit}\0{before}\0{source}\0{domain}".encode(),
+        digest_size=8,
+    ).hexdigest()
+    if gzipped:
+        # A strong ETag names one byte sequence, not both encodings of it.
+        etag += "-gz"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        entries, cursor = _feed_page(kind, cat, limit, before, source, domain)
+        links = [{"rel": "first", "href": _feed_page_url(feed_url, limit)}]
+        if cursor is not None:
+            links.append({"rel": "next", "href": _feed_page_url(feed_url, limit, cursor)})
+        self_url = _feed_page_url(feed_url, limit, before)
+        cached = _feed_cache.get((kind, cat)) if first_page else None
+        if first_page and (cached is None or cached[0] != version):
+            xml = _render_feed(title, self_url, entries, links).encode()
+            cached = (version, xml, gzip.compress(xml, compresslevel=6))
+            _feed_cache[(kind, cat)] = cached
+
+        if cached is not None:
+            _, xml, gz = cached
+            if gzipped:
+                response = Response(gz, mimetype="application/atom+xml")
+                response.headers["Content-Encoding"] = "gzip"
+            else:
+                response = Response(xml, mimetype="application/atom+xml")
+        elif len(entries) > FEED_STREAM_MIN:
+            response = Response(
+                _stream_feed(title, self_url, entries, links),
+                mimetype="application/atom+xml",
+            )
+        else:
+            response = Response(
+                _render_feed(title, self_url, entries, links),
+                mimetype="application/atom+xml",
+            )
+    response.set_etag(etag)
+    response.last_modified = _feed_modified(kind)
+    response.vary.add("Accept-Encoding")
+    if response.is_streamed:
+        # make_conditional would buffer the body to compute a length.
+        return response
+    return response.make_conditional(request)
 
 
 @app.route("/liked")
@@ -1810,8 +4350,7 @@ def feed():
 @app.route("/appreciated")
 @app.route(f"{prefix}/appreciated")
 def liked():
-    global liked_feed
-    return Response(liked_feed.to_string(), mimetype="application/atom+xml")
+    return Response(generate_liked_feed(), mimetype="application/atom+xml")
 
 
 @app.route("/api/random")
@@ -1842,8 +4381,7 @@ def api_random():
 
     seen = _get_seen(request)
     entry = _pick_unseen(cache, seen)
-    domain = get_registered_domain(entry.link)
-    domain = re.sub(r"^(www\.)?", "", domain)
+    domain = entry.display_domain or display_domain(entry.link)
     likes_total = sum(likes_dict.get(entry.link, OrderedDict()).values())
 
     response = jsonify({
@@ -1877,7 +4415,7 @@ def _deck_item(entry, base_params, next_link, current_mode):
     ]
     flag_content_count = flagged_content_dict.get(link, 0)
 
-    domain = re.sub(r"^(www\.)?", "", get_registered_domain(link))
+    domain = entry.display_domain or display_domain(link)
     url = _https_url(link)
 
     params = dict(base_params)
@@ -1939,6 +4477,65 @@ def _deck_item(entry, base_params, next_link, current_mode):
     }
 
 
+# "random" chains _pick_next_entry() once per slot; "mmr" picks the whole batch
+# by maximal marginal relevance over the embeddings, so one refill does not
+# queue several near-identical posts from the same source or topic.
+DECK_FILL_MODE = os.environ.get("DECK_FILL_MODE", "random")
+# Unseen candidates sampled per requested slot for the MMR pass.
+DECK_MMR_POOL = 5
+# Weight of relevance (similarity to the current post) against redundancy.
+DECK_MMR_LAMBDA = 0.5
+
+
+def _mmr_deck_fill(cache, cur_link, seen, queued, count):
+    """Pick up to `count` posts from `cache` by maximal marginal relevance.
+
+    Relevance is similarity to the current post. Redundancy is a candidate's
+    highest similarity to a post already picked, or 1 when it shares that
+    post's source feed. Both come from one product over a small random sample
+    of the pool, so the work per pick does not grow with the corpus. Seen posts
+    only fill slots the unseen sample cannot.
+    """
+    unseen = ~_seen_mask(cache, seen)
+
+    def draw(rows, k):
+        # Oversample by the few queued posts rather than scanning for them.
+        picks = random.sample(range(len(rows)), min(len(rows), k + len(queued)))
+        drawn = [cache[rows[i]] for i in picks]
+        return [e for e in drawn if _url_key(e.link) not in queued][:k]
+
+    sample = draw(np.flatnonzero(unseen), count * DECK_MMR_POOL)
+    fresh = len(sample)
+    if len(sample) < count:
+        sample += draw(np.flatnonzero(~unseen), count - len(sample))
+    if not sample:
+        return []
+
+    rows = np.array([_emb_url_to_idx.get(e.link, -1) for e in sample])
+    emb = np.zeros((len(sample), _emb_matrix.shape[1]), dtype=np.float32)
+    emb[rows >= 0] = _emb_matrix[rows[rows >= 0]]
+    cur_idx = _emb_url_to_idx.get(cur_link)
+    relevance = (
+        emb @ _emb_matrix[cur_idx] if cur_idx is not None else np.zeros(len(sample))
+    )
+    sources = np.array(
+        [e.feed_url or registrable_domain(urlparse(e.link).hostname or "") or "" for e in sample]
+    )
+    redundancy = np.maximum(emb @ emb.T, sources[:, None] == sources[None, :])
+    # Unseen candidates always outrank seen ones.
+    base = DECK_MMR_LAMBDA * relevance - 2.0 * (np.arange(len(sample)) >= fresh)
+
+    picked = []
+    penalty = np.zeros(len(sample), dtype=np.float32)
+    for _ in range(min(count, len(sample))):
+        score = base - (1 - DECK_MMR_LAMBDA) * penalty
+        score[picked] = -np.inf
+        best = int(np.argmax(score))
+        picked.append(best)
+        penalty = np.maximum(penalty, redundancy[best])
+    return [sample[i] for i in picked]
+
+
 @app.route("/api/deck")
 @app.route(f"{prefix}/api/deck")
 def api_deck():
@@ -1950,7 +4547,10 @@ def api_deck():
     # Unfiltered, so the current post's categories resolve even when it sits
     # outside the active search or category filter.
     mode_cache = cache
-    # Same order as index(): search narrows the pool, then category filters.
+    # Same order as index(): source and search narrow the pool, then
+    # category filters.
+    source, domain = _source_args(request.args)
+    cache = _apply_source_filter(cache, source, domain)
     search_query = request.args.get("search", "").lower()
     cache = _apply_search_filter(cache, search_query)
     current_cat = _resolve_current_cat(request, current_mode)
@@ -1958,7 +4558,7 @@ def api_deck():
     cache = _apply_cat_filters(cache, current_cat, excluded_cats)
     if not cache:
         return jsonify({"error": "no posts available"}), 404
-    liked_pool = _liked_pool(search_query, current_cat, excluded_cats)
+    liked_pool = _liked_pool(search_query, current_cat, excluded_cats, source, domain)
 
     try:
         count = int(request.args.get("count", 3))
@@ -1967,10 +4567,8 @@ def api_deck():
     count = max(1, min(count, DECK_MAX))
 
     cur_url = request.args.get("url", "")
-    cur_cats = next(
-        (e.categories for e in mode_cache if _urls_match(e.link, cur_url)),
-        [],
-    )
+    cur_entry = next((e for e in mode_cache if _urls_match(e.link, cur_url)), None)
+    cur_cats = cur_entry.categories if cur_entry else []
 
     base_params = {
         k: v
@@ -1991,60 +4589,63 @@ def api_deck():
         queued.add(_url_key(cur_url))
     if cur_url:
         seen = seen | {_hash_url(cur_url)}
-    for _ in range(count):
-        if current_mode == 6:
-            cur_idx = next(
-                (
-                    i
-                    for i, candidate in enumerate(cache)
-                    if _urls_match(candidate.link, cur_url)
-                ),
-                -1,
+    if DECK_FILL_MODE == "mmr" and current_mode != 6 and _emb_matrix is not None:
+        entries = _mmr_deck_fill(
+            cache, cur_entry.link if cur_entry else cur_url, seen, queued, count
+        )
+    else:
+        for _ in range(count):
+            if current_mode == 6:
+                cur_idx = next(
+                    (
+                        i
+                        for i, candidate in enumerate(cache)
+                        if _urls_match(candidate.link, cur_url)
+                    ),
+                    -1,
+                )
+                entry = next(
+                    (
+                        candidate
+                        for candidate in cache[cur_idx + 1 :]
+                        if _url_key(candidate.link) not in queued
+                    ),
+                    None,
+                )
+                if cur_idx < 0 or entry is None:
+                    break
+                entries.append(entry)
+                queued.add(_url_key(entry.link))
+                seen = seen | {_hash_url(entry.link)}
+                cur_url, cur_cats = entry.link, entry.categories
+                continue
+
+            taken = frozenset(queued)
+            remaining = _narrow(
+                cache, lambda candidate: _url_key(candidate.link) not in taken
             )
-            entry = next(
-                (
-                    candidate
-                    for candidate in cache[cur_idx + 1 :]
-                    if _url_key(candidate.link) not in queued
-                ),
-                None,
+            if not remaining:
+                break
+            remaining_keys = {_url_key(candidate.link) for candidate in remaining}
+            remaining_liked = _narrow(
+                liked_pool,
+                lambda candidate: _url_key(candidate.link) in remaining_keys,
+            )
+            entry = _pick_next_entry(
+                remaining,
+                cur_url,
+                seen,
+                cur_cats,
+                current_cat,
+                current_mode,
+                remaining_liked,
             )
-            if cur_idx < 0 or entry is None:
+            if entry is None:
                 break
             entries.append(entry)
             queued.add(_url_key(entry.link))
             seen = seen | {_hash_url(entry.link)}
             cur_url, cur_cats = entry.link, entry.categories
-            continue
-
-        remaining = [
-            candidate
-            for candidate in cache
-            if _url_key(candidate.link) not in queued
-        ]
-        if not remaining:
-            break
-        remaining_keys = {_url_key(candidate.link) for candidate in remaining}
-        remaining_liked = [
-            candidate
-            for candidate in liked_pool
-            if _url_key(candidate.link) in remaining_keys
-        ]
-        entry = _pick_next_entry(
-            remaining,
-            cur_url,
-            seen,
-            cur_cats,
-            current_cat,
-            current_mode,
-            remaining_liked,
-        )
-        if entry is None:
-            break
-        entries.append(entry)
-        queued.add(_url_key(entry.link))
-        seen = seen | {_hash_url(entry.link)}
-        cur_url, cur_cats = entry.link, entry.categories
 
     posts = []
     for i, entry in enumerate(entries):
@@ -2076,6 +4677,8 @@ def api_like_target():
     if current_mode not in DECK_MODES or not url:
         return jsonify({"post": None})
 
+    source, domain = _source_args(request.args)
+    cache = _apply_source_filter(cache, source, domain)
     search_query = request.args.get("search", "").lower()
     cache = _apply_search_filter(cache, search_query)
     current_cat = _resolve_current_cat(request, current_mode)
@@ -2088,9 +4691,27 @@ def api_like_target():
         return jsonify({"post": None})
 
     base_params = {k: v for k, v in request.args.items() if k != "url"}
+    liked_pool = _liked_pool(search_query, current_cat, excluded_cats, source, domain)
+
+    response = jsonify(
+        {
+            "post": _like_target_item(
+                sim, cache, seen, base_params, current_cat, current_mode, liked_pool
+            )
+        }
+    )
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
-    # Resolve the similar post's own next link too, so the no-JS anchor is not
-    # left pointing at the post we came from.
+
+def _like_target_item(
+    sim, cache, seen, base_params, current_cat, current_mode, liked_pool
+):
+    """Deck item for a like target, with its own no-JS next link resolved.
+
+    Resolving the similar post's next link too keeps the no-JS anchor from
+    pointing at the post we came from.
+    """
     nxt = _pick_next_entry(
         cache,
         sim.link,
@@ -2098,17 +4719,85 @@ def api_like_target():
         sim.categories,
         current_cat,
         current_mode,
-        _liked_pool(search_query, current_cat, excluded_cats),
+        liked_pool,
     )
     next_link = None
     if nxt:
         next_params = dict(base_params)
         next_params["url"] = _https_url(nxt.link)
         next_link = prefix + "/?" + urlencode(next_params)
+    return _deck_item(sim, base_params, next_link, current_mode)
 
-    response = jsonify(
-        {"post": _deck_item(sim, base_params, next_link, current_mode)}
-    )
+
+SIMILAR_BATCH_MAX = DECK_MAX
+SIMILAR_BATCH_NEIGHBORS = 5
+
+
+@app.route("/api/similar-batch")
+@app.route(f"{prefix}/api/similar-batch")
+def api_similar_batch():
+    """Like targets for several posts at once, so the deck can prefetch them.
+
+    Takes repeated ?url= plus the usual mode, search and category filters. Each
+    result's `post` is the post /api/like-target would return for that URL,
+    and `neighbors` lists the runners-up so a client can skip one it has seen
+    since. Every input is scored by the same matrix product.
+    """
+    cache, current_mode = _select_mode_cache(request.args)
+    if current_mode not in DECK_MODES:
+        return jsonify({"error": "mode does not support deck"}), 400
+    urls = [u for u in request.args.getlist("url") if u][:SIMILAR_BATCH_MAX]
+
+    try:
+        limit = int(request.args.get("limit", SIMILAR_BATCH_NEIGHBORS))
+    except ValueError:
+        limit = SIMILAR_BATCH_NEIGHBORS
+    limit = max(1, min(limit, SIMILAR_BATCH_NEIGHBORS))
+
+    source, domain = _source_args(request.args)
+    cache = _apply_source_filter(cache, source, domain)
+    search_query = request.args.get("search", "").lower()
+    cache = _apply_search_filter(cache, search_query)
+    current_cat = _resolve_current_cat(request, current_mode)
+    excluded_cats = _excluded_cats(request)
+    cache = _apply_cat_filters(cache, current_cat, excluded_cats)
+    liked_pool = _liked_pool(search_query, current_cat, excluded_cats, source, domain)
+
+    seen = _get_seen(request)
+    base_params = {
+        k: v for k, v in request.args.items() if k not in ("url", "limit")
+    }
+    results = []
+    for url, ranked in zip(urls, find_similar_batch(urls, seen, cache, limit)):
+        post = None
+        if ranked:
+            post = _like_target_item(
+                ranked[0][0],
+                cache,
+                seen | {_hash_url(url)},
+                base_params,
+                current_cat,
+                current_mode,
+                liked_pool,
+            )
+        results.append(
+            {
+                "url": url,
+                "post": post,
+                "neighbors": [
+                    {
+                        "url": _https_url(e.link),
+                        "source_url": e.link,
+                        "title": e.title,
+                        "score": round(score, 4),
+                    }
+                    for e, score in ranked
+                ],
+            }
+        )
+
+    response = jsonify({"results": results})
+    # Filtered by the caller's seen cookie, like /api/like-target.
     response.headers["Cache-Control"] = "no-store"
     return response
 
@@ -2116,10 +4805,29 @@ def api_like_target():
 @app.route("/opml")
 @app.route(f"{prefix}/opml")
 def opml():
-    global opml_cache
-    if opml_cache is None:  # first call before update_all ran?
-        opml_cache = generate_opml_feed()
-    return Response(opml_cache, mimetype="text/x-opml+xml")
+    """OPML of every curated feed, or one list with `mode=blogs|yt|comic`.
+
+    Served from the prebuilt variants with a content-hash ETag, gzipped when
+    the client accepts it. Unknown modes get the full list.
+    """
+    if not _opml_cache:  # first call before update_all ran?
+        refresh_feed_lists()
+    mode = request.args.get("mode", "")
+    etag, xml, gz = _opml_cache.get(mode) or _opml_cache[""]
+    gzipped = "gzip" in request.accept_encodings
+    if gzipped:
+        # A strong ETag names one byte sequence, not both encodings of it.
+        etag += "-gz"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif gzipped:
+        response = Response(gz, mimetype="text/x-opml+xml")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(xml, mimetype="text/x-opml+xml")
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response.make_conditional(request)
 
 
 # Cloud Run probe endpoints. Registered without the URL prefix because the
@@ -2160,9 +4868,189 @@ def healthz():
     return Response("ok\n", mimetype="text/plain")
 
 
-time_saved_likes = datetime.now()
-time_saved_notes = datetime.now()
-time_saved_flagged_content = datetime.now()
+@app.route("/metricz")
+def metricz():
+    """Prometheus text-format gauges for this instance's persistence lag."""
+    lines = [
+        "# TYPE smallweb_unflushed_write_age_seconds gauge",
+        f"smallweb_unflushed_write_age_seconds {unflushed_write_age():.3f}",
+        "# TYPE smallweb_user_data_refresh_lag_seconds gauge",
+        f"smallweb_user_data_refresh_lag_seconds {refresh_lag():.3f}",
+        "# TYPE smallweb_corpus_snapshot_version gauge",
+        f"smallweb_corpus_snapshot_version {_snapshot_version}",
+    ]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+# --- Shared fetcher ---------------------------------------------------------
+# With SW_SHARED_DIR set, the gunicorn workers on an instance share one
+# fetcher instead of each polling the API: whoever holds the lock file runs
+# update_all and update_embeddings and writes a versioned snapshot, and the
+# others load it when it changes. The kernel drops the lock with its holder,
+# so another worker takes over on its next poll.
+SHARED_DIR = os.environ.get("SW_SHARED_DIR", "")
+# Set SW_PRELOAD=1 to have gunicorn.conf.py preload the app: the master loads
+# the corpus once and forks, and start_worker() runs in each worker. The
+# workers share a fetcher, in a fresh directory unless SW_SHARED_DIR is set.
+PRELOAD = os.environ.get("SW_PRELOAD") == "1"
+# True until start_worker() runs: the preloading master starts no threads.
+_preload_master = PRELOAD
+if PRELOAD and not SHARED_DIR:
+    SHARED_DIR = os.path.join(tempfile.gettempdir(), f"smallweb-{os.getpid()}")
+SNAPSHOT_POLL_SECONDS = float(os.environ.get("SW_SNAPSHOT_POLL_SECONDS", "5"))
+SNAPSHOT_WAIT_SECONDS = 60  # how long a starting follower waits for the first one
+FETCH_INTERVAL_SECONDS = 300
+
+_fetcher_lock_fd = None
+_snapshot_stat = None  # (st_ino, st_mtime_ns) of the snapshot last loaded or written
+_snapshot_version = 0
+_snapshot_emb = (None, None)  # (matrix, file name) last written or mapped
+_snapshot_corpus = ""  # _corpus_version of the snapshot last written or loaded
+_next_fetch = 0.0
+
+
+def _shared_path(name):
+    return os.path.join(SHARED_DIR, name)
+
+
+def _try_become_fetcher():
+    """Take the fetcher lock if it is free; True while this process holds it."""
+    global _fetcher_lock_fd
+    if _fetcher_lock_fd is not None:
+        return True
+    fd = os.open(_shared_path("fetcher.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _fetcher_lock_fd = fd
+    logger.info("Process %d is the shared fetcher", os.getpid())
+    return True
+
+
+def write_snapshot():
+    """Publish the feed pools and embedding matrix as the next version.
+
+    The matrix goes to its own .npy file, rewritten only when update_embeddings
+    replaced it, so followers can memory-map it and share its pages.
+    """
+    global _snapshot_stat, _snapshot_version, _snapshot_emb, _snapshot_corpus
+    version = _snapshot_version + 1
+    matrix, emb_name = _snapshot_emb
+    if _emb_matrix is not None and _emb_matrix is not matrix:
+        emb_name = f"embeddings.{version}.npy"
+        with open(_shared_path(emb_name + ".tmp"), "wb") as f:
+            np.save(f, np.asarray(_emb_matrix, dtype=np.float32))
+        os.replace(_shared_path(emb_name + ".tmp"), _shared_path(emb_name))
+        _snapshot_emb = (_emb_matrix, emb_name)
+    snapshot = {
+        "version": version,
+        "urls_cache": urls_cache,
+        "urls_yt_cache": urls_yt_cache,
+        "urls_gh_cache": urls_gh_cache,
+        "urls_comic_cache": urls_comic_cache,
+        "emb_urls": _emb_urls,
+        "emb_file": emb_name,
+        "emb_digest": _emb_digest,
+    }
+    path = _shared_path("corpus.pickle")
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    st = os.stat(path)
+    _snapshot_stat = (st.st_ino, st.st_mtime_ns)
+    _snapshot_version = version
+    _snapshot_corpus = _corpus_version
+    # Unlinked matrices stay readable to followers that still map them.
+    for name in os.listdir(SHARED_DIR):
+        if name.startswith("embeddings.") and name.endswith(".npy") and name != emb_name:
+            try:
+                os.remove(_shared_path(name))
+            except OSError:
+                pass
+
+
+def load_snapshot():
+    """Switch to the fetcher's snapshot if it changed; True if one was loaded."""
+    global urls_cache, urls_yt_cache, urls_gh_cache, urls_comic_cache
+    global embeddings_cache, _emb_matrix, _emb_urls, _emb_url_to_idx, _emb_digest
+    global _snapshot_stat, _snapshot_version, _snapshot_emb, _snapshot_corpus
+    try:
+        with open(_shared_path("corpus.pickle"), "rb") as f:
+            st = os.fstat(f.fileno())
+            if (st.st_ino, st.st_mtime_ns) == _snapshot_stat:
+                return False
+            snapshot = pickle.load(f)
+        matrix, emb_name = _snapshot_emb
+        if snapshot["emb_file"] and snapshot["emb_file"] != emb_name:
+            emb_name = snapshot["emb_file"]
+            matrix = np.load(_shared_path(emb_name), mmap_mode="r")
+    except FileNotFoundError:
+        # No snapshot yet, or its matrix was replaced under us: next poll.
+        return False
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError) as e:
+        logger.error("Cannot load corpus snapshot: %s", e)
+        return False
+
+    urls_cache = snapshot["urls_cache"]
+    urls_yt_cache = snapshot["urls_yt_cache"]
+    urls_gh_cache = snapshot["urls_gh_cache"]
+    urls_comic_cache = snapshot["urls_comic_cache"]
+    _install_corpus()
+    if matrix is not None and matrix is not _snapshot_emb[0]:
+        _emb_urls = snapshot["emb_urls"]
+        _emb_url_to_idx = {u: i for i, u in enumerate(_emb_urls)}
+        _emb_matrix = matrix
+        embeddings_cache = _emb_url_to_idx  # membership checks only
+        _emb_digest = snapshot.get("emb_digest", "")
+        _snapshot_emb = (matrix, emb_name)
+        _start_clustering()
+    _snapshot_stat = (st.st_ino, st.st_mtime_ns)
+    _snapshot_version = snapshot["version"]
+    _snapshot_corpus = _corpus_version
+    logger.info("Loaded corpus snapshot %d", _snapshot_version)
+    return True
+
+
+def sync_shared_corpus():
+    """Scheduler job in shared mode: fetch if elected, else follow the snapshot."""
+    global _next_fetch
+    if not _try_become_fetcher():
+        load_snapshot()
+        return
+    if time.monotonic() < _next_fetch:
+        return
+    _next_fetch = time.monotonic() + FETCH_INTERVAL_SECONDS
+    update_all()
+    update_embeddings()
+    # A fetch that changed nothing publishes nothing: followers keep what
+    # they hold instead of unpickling the same corpus again.
+    if (
+        _snapshot_stat is not None
+        and _corpus_version == _snapshot_corpus
+        and _emb_matrix is _snapshot_emb[0]
+    ):
+        return
+    try:
+        write_snapshot()
+    except OSError as e:
+        logger.error("Cannot write corpus snapshot: %s", e)
+
+
+def start_shared_corpus():
+    """First sync at import; a follower waits a while for the fetcher's snapshot."""
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    deadline = time.monotonic() + SNAPSHOT_WAIT_SECONDS
+    sync_shared_corpus()
+    while (
+        _fetcher_lock_fd is None
+        and _snapshot_stat is None
+        and time.monotonic() < deadline
+    ):
+        time.sleep(0.5)
+        sync_shared_corpus()
+
 
 urls_cache = []
 urls_yt_cache = []
@@ -2170,61 +5058,176 @@ urls_liked_cache = []
 urls_gh_cache = []
 urls_comic_cache = []
 urls_flagged_cache = []
+likes_dict = {}
+notes_dict = {}
+flagged_content_dict = {}
 
-likes_dict = (
-    _load_json(
-        PATH_LIKES,
-        lambda d: {url: OrderedDict(emojis) for url, emojis in d.items()},
-    )
-    or _load_json(
-        PATH_FAVORITES_LEGACY,
-        lambda d: {url: OrderedDict(emojis) for url, emojis in d.items()},
-    )
-    or {}
-)
-urls_liked_cache = []  # Initialize empty in case urls_cache isn't loaded yet
-generate_liked_feed()  # Initialize the liked feed
+scheduler = BackgroundScheduler()
 
-notes_dict = _load_json(PATH_NOTES, deserialize_notes) or {}
 
-flagged_content_dict = _load_json(PATH_FLAGGED) or {}
+def load_corpus():
+    """Fetch the feeds and embeddings this process starts with."""
+    global _next_fetch
+    if PRELOAD:
+        # The gunicorn master, before it forks: no lock is taken here, the
+        # workers elect a fetcher among themselves. The snapshot gives them
+        # the version they already hold, so they do not reload it.
+        update_all()
+        update_embeddings()
+        os.makedirs(SHARED_DIR, exist_ok=True)
+        try:
+            write_snapshot()
+        except OSError as e:
+            logger.error("Cannot write corpus snapshot: %s", e)
+        _next_fetch = time.monotonic() + FETCH_INTERVAL_SECONDS
+    elif SHARED_DIR:
+        start_shared_corpus()
+    else:
+        update_all()
+        update_embeddings()
 
 
-# get feeds
-update_all()
-update_embeddings()
+def _worker_instance_id(slot):
+    """This preloaded worker's shard id; forked workers must not share one.
 
-opml_cache = generate_opml_feed()
+    A pinned SW_INSTANCE_ID gets the worker's slot (assigned in
+    gunicorn.conf.py's pre_fork: the same 1..N on every start of the server,
+    and a respawned worker's replacement takes its slot) so each worker
+    still writes its own shard and reuses it across restarts.
+    """
+    pinned = os.environ.get("SW_INSTANCE_ID")
+    if not pinned:
+        return uuid.uuid4().hex[:12]
+    return f"{pinned}-{slot if slot is not None else os.getpid()}"
 
-# Update feeds every 5 minutes
-scheduler = BackgroundScheduler()
-scheduler.start()
-scheduler.add_job(update_all, "interval", minutes=5)
-scheduler.add_job(update_embeddings, "interval", minutes=5)
+
+def start_worker(slot=None):
+    """Open this process's user data and start its threads and scheduler.
+
+    Runs at import, or from gunicorn.conf.py's post_worker_init under
+    SW_PRELOAD so that no file handle, thread or lock holder is shared
+    with the master or the other workers.
+    """
+    global _store, likes_dict, notes_dict, _own_flags
+    global INSTANCE_ID, PATH_LIKES_SHARD, PATH_LIKES_JOURNAL, _gh_queue
+    global _previous_sigterm, _preload_master
+    _preload_master = False
+    if PRELOAD:
+        INSTANCE_ID = _worker_instance_id(slot)
+        PATH_LIKES_SHARD = os.path.join(DIR_LIKES, f"{INSTANCE_ID}.json")
+        PATH_LIKES_JOURNAL = os.path.join(DIR_LIKES, f"{INSTANCE_ID}.journal")
+        # Repos the master queued for prefetching would be fetched once per
+        # worker; the fetcher queues them again on its next refresh.
+        _gh_queue = queue.Queue()
+        _gh_pending.clear()
+
+    _store = _open_store()
+    likes_dict = load_likes()
+    threading.Thread(target=_journal_committer, name="likes-journal", daemon=True).start()
+    threading.Thread(target=_journal_shipper, name="likes-ship", daemon=True).start()
+
+    notes_dict = _store.load_notes()
+
+    _own_flags = _store.load_flags()
+    # Peers' flags, and their notes, rather than waiting for the first refresh.
+    merge_user_data()
+    threading.Thread(target=_user_data_writer, name="user-data-writer", daemon=True).start()
+    threading.Thread(target=_gh_meta_worker, name="gh-meta", daemon=True).start()
+
+    if PRELOAD:
+        # The master built the liked and flagged pools before any were loaded.
+        with _likes_lock:
+            _publish_likes()
+            _rebuild_liked_cache()
+        _rebuild_flagged_cache()
+        _start_clustering()
+    else:
+        load_corpus()
+
+    # Update feeds every 5 minutes
+    scheduler.start()
+    if SHARED_DIR:
+        scheduler.add_job(sync_shared_corpus, "interval", seconds=SNAPSHOT_POLL_SECONDS)
+    else:
+        scheduler.add_job(update_all, "interval", minutes=5)
+        scheduler.add_job(update_embeddings, "interval", minutes=5)
+    scheduler.add_job(compact_likes, "interval", seconds=LIKES_COMPACT_SECONDS)
+    scheduler.add_job(fold_idle_shards, "interval", seconds=LIKES_FOLD_SECONDS)
+    scheduler.add_job(refresh_user_data, "interval", seconds=USER_DATA_REFRESH_SECONDS)
+    scheduler.add_job(checkpoint_store, "interval", seconds=STORE_CHECKPOINT_SECONDS)
+
+    atexit.register(save_all_data)
+    # gunicorn installs its worker handlers before it imports the app (or,
+    # preloaded, before post_worker_init), so chaining to whatever is there
+    # keeps its graceful shutdown intact.
+    _previous_sigterm = signal.getsignal(signal.SIGTERM)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _flush_on_sigterm)
+    atexit.register(_stop_scheduler)
+
+
+def _stop_scheduler():
+    if scheduler.running:
+        scheduler.shutdown()
 
 
 def save_all_data():
     """Save all data before shutdown."""
     logger.info("Saving all data before shutdown...")
+    closed = False
     try:
-        save_likes()
+        # Anything the committer has not written yet goes into the snapshot.
+        closed = compact_likes()
         logger.info("Saved %d likes", len(likes_dict))
     except Exception as e:
         logger.error("Error saving likes: %s", e)
 
     try:
-        with open(PATH_NOTES, "w", encoding="utf-8") as file:
-            json.dump(serialize_notes(notes_dict), file)
-            logger.info("Saved %d notes", len(notes_dict))
+        flush_user_data()
+        logger.info(
+            "Saved %d notes and %d flagged items", len(notes_dict), len(flagged_content_dict)
+        )
     except Exception as e:
-        logger.error("Error saving notes: %s", e)
+        logger.error("Error saving notes and flagged content: %s", e)
 
     try:
-        with open(PATH_FLAGGED, "w", encoding="utf-8") as file:
-            json.dump(flagged_content_dict, file)
-            logger.info("Saved %d flagged items", len(flagged_content_dict))
+        _store.checkpoint()
     except Exception as e:
-        logger.error("Error saving flagged content: %s", e)
+        closed = False
+        logger.error("Error checkpointing %s store: %s", _store.name, e)
+
+    if closed:
+        try:
+            _mark_closed(INSTANCE_ID)
+        except OSError as e:
+            logger.error("Cannot mark likes shard closed: %s", e)
+
 
-atexit.register(save_all_data)
-atexit.register(lambda: scheduler.shutdown())
+def _flush_on_sigterm(signum, frame):
+    """Save within SHUTDOWN_FLUSH_BUDGET, then hand over to gunicorn's handler.
+
+    atexit only runs if the worker gets to exit cleanly before Cloud Run's
+    SIGKILL, so the flush happens here first. It runs on a thread so a hung
+    mount costs the budget and not the whole grace period.
+    """
+    saver = threading.Thread(target=save_all_data, name="sigterm-flush", daemon=True)
+    saver.start()
+    saver.join(SHUTDOWN_FLUSH_BUDGET)
+    if saver.is_alive():
+        logger.error("Shutdown flush still running after %.1fs", SHUTDOWN_FLUSH_BUDGET)
+    if callable(_previous_sigterm):
+        _previous_sigterm(signum, frame)
+    elif _previous_sigterm != signal.SIG_IGN:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+_previous_sigterm = None
+
+if PRELOAD:
+    # Everything loaded so far is shared with the workers copy-on-write;
+    # frozen, the collector never writes to those pages.
+    load_corpus()
+    gc.freeze()
+else:
+    start_worker()
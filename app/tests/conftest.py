@@ -3,8 +3,11 @@
 sw.py fetches every feed at import time and resolves data paths relative to the
 app directory, so both have to be handled before the module is imported.
 """
+import atexit
 import os
+import shutil
 import sys
+import tempfile
 from datetime import datetime, timedelta
 
 import pytest
@@ -20,17 +23,32 @@ def _no_network(*args, **kwargs):
 os.chdir(APP_DIR)
 sys.path.insert(0, APP_DIR)
 requests.get = _no_network
+# Tests flush notes and flags explicitly; keep the background writer out of it.
+os.environ["SW_FLUSH_SECONDS"] = "3600"
+# Whatever import or a test writes goes to a scratch dir, never app/data.
+DATA_DIR = tempfile.mkdtemp(prefix="sw-tests-")
+os.environ["SW_DATA_DIR"] = DATA_DIR
+os.environ["SW_SQLITE_DIR"] = DATA_DIR
 
 import sw  # noqa: E402
 
 sw.scheduler.shutdown(wait=False)
+atexit.unregister(sw.save_all_data)
+atexit.register(shutil.rmtree, DATA_DIR, ignore_errors=True)
 
 
-def entry(link, title="T", cats=None, minutes_old=0, author="A", description="D"):
+def entry(
+    link, title="T", cats=None, minutes_old=0, author="A", description="D", feed_url=""
+):
     # Naive timestamps, matching what update_entries() stores.
     haystack, title_tokens, rest_tokens, link_norm = sw._build_search_fields(
         title, author, description, link
     )
+    domain, excerpt, badge, river_query = sw._build_river_fields(
+        link, description, cats or []
+    )
+    # Against the registry as it stands: build entries after patching it.
+    source_name, more_query = sw._build_source_fields(feed_url, domain)
     return sw.FeedEntry(
         link=link,
         title=title,
@@ -38,12 +56,19 @@ def entry(link, title="T", cats=None, minutes_old=0, author="A", description="D"
         description=description,
         updated=datetime.now() - timedelta(minutes=minutes_old),
         categories=cats if cats is not None else [],
+        feed_url=feed_url,
         # update_entries() precomputes these at ingest; _entry_matches reads only
         # these fields, so a fixture without them can never match a search.
         search_haystack=haystack,
         search_title_tokens=title_tokens,
         search_rest_tokens=rest_tokens,
         search_link=link_norm,
+        display_domain=domain,
+        excerpt=excerpt,
+        badge=badge,
+        river_query=river_query,
+        source_name=source_name,
+        more_query=more_query,
     )
 
 
@@ -71,8 +96,24 @@ def app_module():
     sw.urls_liked_cache = []
     sw.urls_flagged_cache = []
     sw.likes_dict = {}
+    sw._own_likes = {}
+    sw._peer_likes = {}
+    with sw._likes_lock:
+        sw._snapshot_seq = sw._journal_seq
     sw.flagged_content_dict = {}
+    sw._own_flags = {}
+    sw._peer_flags = {}
     sw.embeddings_cache = {}
+    sw._emb_matrix = None
+    sw._emb_urls = []
+    sw._emb_url_to_idx = {}
+    sw._emb_clusters = None
+    sw._notes_dirty.clear()
+    sw._flags_dirty.clear()
+    sw._oldest_unflushed = None
+    sw._feed_cache.clear()
+    sw._rebuild_group_indexes()
+    sw._update_corpus_version()
     return sw
 
 
@@ -80,3 +121,56 @@ def app_module():
 def client(app_module):
     app_module.app.config["TESTING"] = True
     return app_module.app.test_client()
+
+
+def _as_instance(app_module, monkeypatch, instance):
+    """Switch the module to another instance's shard, as a restart would."""
+    monkeypatch.setattr(app_module, "INSTANCE_ID", instance)
+    monkeypatch.setattr(
+        app_module, "PATH_LIKES_SHARD", os.path.join(app_module.DIR_LIKES, instance + ".json")
+    )
+    monkeypatch.setattr(
+        app_module,
+        "PATH_LIKES_JOURNAL",
+        os.path.join(app_module.DIR_LIKES, instance + ".journal"),
+    )
+    app_module._store.close()
+    monkeypatch.setattr(app_module, "_store", app_module._open_store())
+    return app_module.load_likes()
+
+
+def _point_at(app_module, tmp_path, monkeypatch):
+    """Point every likes file into `tmp_path` and start as instance "one"."""
+    for name, filename in (
+        ("PATH_LIKES", "likes.json"),
+        ("PATH_FAVORITES_LEGACY", "favorites.json"),
+        ("PATH_LIKES_SNAPSHOT", "likes.snapshot.json"),
+        ("PATH_LIKES_JOURNAL_LEGACY", "likes.journal"),
+        ("DIR_LIKES", "likes.d"),
+        ("PATH_LIKES_BASE", "likes.d/base.json"),
+        ("PATH_LIKES_FOLD_LOCK", "likes.d/fold.lock"),
+        ("PATH_NOTES", "notes.json"),
+        ("PATH_FLAGGED", "flagged_content.json"),
+        ("DIR_FLAGS", "flags.d"),
+    ):
+        monkeypatch.setattr(app_module, name, str(tmp_path / filename))
+    monkeypatch.setattr(app_module, "_likeable_entries", {})
+    _as_instance(app_module, monkeypatch, "one")
+
+
+@pytest.fixture
+def data_dir(app_module, tmp_path, monkeypatch):
+    # Restored afterwards, so no test's likes outlive it in memory.
+    for name in (
+        "_own_likes",
+        "_peer_likes",
+        "_peer_stats",
+        "_journal_seq",
+        "_journal_durable",
+        "_snapshot_seq",
+    ):
+        monkeypatch.setattr(app_module, name, getattr(app_module, name))
+    monkeypatch.setattr(app_module, "DIR_SQLITE_LOCAL", str(tmp_path))
+    _point_at(app_module, tmp_path, monkeypatch)
+    yield tmp_path
+    app_module._store.close()
@@ -158,7 +158,7 @@ function deckPost(url) {
     source_url: url,
     page_url: pageUrl(url),
     next_link: null,
-    seen_hash: url.slice(-4),
+    seen_hash: url.slice(-3).replace(/[^\w-]/g, '_'),
     flagged: false,
     similar_href: '',
     slots: {},
@@ -169,7 +169,11 @@ function deckPost(url) {
  * Boot deck.js on a page showing post A.
  * `batches` is consumed one /api/deck response at a time.
  */
-function boot({batches = [], nextHref = pageUrl('https://z.example/0')} = {}) {
+function boot({
+  batches = [],
+  nextHref = pageUrl('https://z.example/0'),
+  cookie = '',
+} = {}) {
   const root = new El('html');
   root.appendChild(makeEl('meta', {name: 'sw-deck-url'})).content =
     PREFIX + 'api/deck';
@@ -190,7 +194,7 @@ function boot({batches = [], nextHref = pageUrl('https://z.example/0')} = {}) {
 
   const listeners = new Map();
   const document = {
-    cookie: '',
+    cookie,
     querySelector: (s) => root.querySelector(s),
     querySelectorAll: (s) => root.querySelectorAll(s),
     getElementById: (id) => root.querySelector('#' + id),
@@ -271,6 +275,7 @@ function boot({batches = [], nextHref = pageUrl('https://z.example/0')} = {}) {
     location,
     flush,
     nextHref: () => nextBtn.getAttribute('href'),
+    cookie: () => document.cookie,
     /** The panel element currently mounted for a post, whatever its state. */
     panelFor: (url) =>
       content.childNodes.find((c) => c.getAttribute('data-url') === url) || null,
@@ -398,3 +403,16 @@ test('a self-referential server next_link is not offered', async () => {
 
   assert.equal(deck.nextHref(), null, 'Next must not link to the current page');
 });
+
+test('a legacy seen cookie is rewritten in the compact format', async () => {
+  // "0123abcd": the first five hex digits >> 2 give the 18-bit code 0x048e,
+  // which is the token "ASO".
+  const deck = boot({
+    batches: [[deckPost(B), deckPost(C)]],
+    cookie: 'seen=0123abcd,bogus',
+  });
+  await deck.flush();
+  await deck.clickNext();
+  assert.equal(deck.shown(), B);
+  assert.match(deck.cookie(), /^seen=1\.ASOe_2;/);
+});
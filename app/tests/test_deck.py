@@ -582,3 +582,72 @@ def test_index_search_and_deck_agree_on_pool(client, app_module):
     deck = client.get("/api/deck?search=rust&count=4&url=https://r.example/1")
     for post in deck.get_json()["posts"]:
         assert "k.example" not in post["url"]
+
+
+# --- diversity (MMR) fill ---------------------------------------------------------
+
+def _near_duplicates(app_module):
+    """Four posts from one source that are nearly the same, and three distinct."""
+    dupes = [entry(f"https://dup.example/{i}", f"Dup {i}") for i in range(4)]
+    distinct = [
+        entry("https://x.example/1", "X"),
+        entry("https://y.example/1", "Y"),
+        entry("https://z.example/1", "Z"),
+    ]
+    app_module.urls_cache = dupes + distinct
+    vectors = {e.link: [1.0, 0.0, 0.0, 0.01 * i] for i, e in enumerate(dupes)}
+    vectors.update({
+        "https://x.example/1": [0.0, 1.0, 0.0, 0.0],
+        "https://y.example/1": [0.0, 0.0, 1.0, 0.0],
+        "https://z.example/1": [0.0, 0.0, 0.0, 1.0],
+    })
+    app_module.embeddings_cache = vectors
+    app_module._build_embedding_matrix(vectors)
+
+
+def test_mmr_deck_never_queues_near_duplicates_together(client, app_module, monkeypatch):
+    _near_duplicates(app_module)
+    monkeypatch.setattr(app_module, "DECK_FILL_MODE", "mmr")
+    for _ in range(20):
+        res = client.get("/api/deck?count=3&url=https://dup.example/0")
+        links = [p["url"] for p in res.get_json()["posts"]]
+        assert len(links) == 3
+        assert sum("dup.example" in link for link in links) <= 1
+
+
+def test_mmr_deck_keeps_deck_invariants(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "DECK_FILL_MODE", "mmr")
+    app_module._build_embedding_matrix(
+        {e.link: [float(i), 1.0] for i, e in enumerate(app_module.urls_cache)}
+    )
+    seen = app_module._hash_url("https://b.example/2")
+    client.set_cookie("seen", seen, domain="localhost")
+    res = client.get(
+        "/api/deck?count=4&url=https://a.example/1&exclude=https://c.example/3"
+    )
+    links = [p["url"] for p in res.get_json()["posts"]]
+    assert len(links) == 3
+    assert "https://a.example/1" not in links
+    assert "https://c.example/3" not in links
+    # The seen post only fills the slot nothing unseen could.
+    assert links[-1] == "https://b.example/2"
+
+    res = client.get("/api/deck?cat=art&count=3&url=https://c.example/3")
+    assert [p["url"] for p in res.get_json()["posts"]] == ["https://d.example/4"]
+
+
+def test_mmr_deck_reads_seen_codes_instead_of_hashing(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "DECK_FILL_MODE", "mmr")
+    app_module._build_embedding_matrix(
+        {e.link: [float(i), 1.0] for i, e in enumerate(app_module.urls_cache)}
+    )
+    seen = {app_module._hash_url("https://b.example/2")}
+
+    def hashed(url):
+        raise AssertionError(f"hashed {url}")
+
+    monkeypatch.setattr(app_module, "_hash_url", hashed)
+    picks = app_module._mmr_deck_fill(
+        app_module.urls_cache, "https://a.example/1", seen, {"a.example/1"}, 3
+    )
+    assert "https://b.example/2" not in [e.link for e in picks]
@@ -0,0 +1,182 @@
+"""/feed: per-variant serialization cache, gzip, conditional requests, paging."""
+import gzip
+import re
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+
+@pytest.fixture
+def renders(app_module, monkeypatch):
+    calls = []
+    real = app_module._render_feed
+
+    def counting(title, feed_url, entries, links=()):
+        calls.append((title, [e.link for e in entries]))
+        return real(title, feed_url, entries, links)
+
+    monkeypatch.setattr(app_module, "_render_feed", counting)
+    return calls
+
+
+def test_feed_is_rendered_once_per_corpus_version(client, renders):
+    first = client.get("/feed")
+    assert first.status_code == 200
+    assert first.headers["ETag"]
+    assert first.headers["Last-Modified"]
+    assert "https://a.example/1" in first.get_data(as_text=True)
+    assert client.get("/feed").get_data() == first.get_data()
+    assert len(renders) == 1
+
+
+def test_matching_etag_gets_304_without_rendering(client, renders):
+    etag = client.get("/feed?comic").headers["ETag"]
+    renders.clear()
+    res = client.get("/feed?comic", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.get_data() == b""
+    assert res.headers["ETag"] == etag
+    assert renders == []
+
+
+def test_if_modified_since_gets_304(client):
+    last_modified = client.get("/feed").headers["Last-Modified"]
+    res = client.get("/feed", headers={"If-Modified-Since": last_modified})
+    assert res.status_code == 304
+
+
+def test_gzip_is_served_when_accepted(client):
+    plain = client.get("/feed?cat=tech")
+    packed = client.get("/feed?cat=tech", headers={"Accept-Encoding": "gzip"})
+    assert packed.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in packed.headers["Vary"]
+    assert gzip.decompress(packed.get_data()) == plain.get_data()
+    assert packed.headers["ETag"] == plain.headers["ETag"][:-1] + '-gz"'
+    res = client.get(
+        "/feed?cat=tech",
+        headers={"Accept-Encoding": "gzip", "If-None-Match": plain.headers["ETag"]},
+    )
+    assert res.status_code == 200
+
+
+def test_variants_are_cached_separately(client, renders):
+    client.get("/feed?cat=tech")
+    client.get("/feed?cat=art")
+    client.get("/feed?recent")
+    assert renders == [
+        ("Kagi Small Web - Technology", ["https://b.example/2", "https://a.example/1"]),
+        ("Kagi Small Web - Art & Design", ["https://d.example/4", "https://c.example/3"]),
+        (
+            "Kagi Small Web - Recent",
+            [
+                "https://e.example/5",
+                "https://d.example/4",
+                "https://c.example/3",
+                "https://b.example/2",
+                "https://a.example/1",
+            ],
+        ),
+    ]
+
+
+def test_corpus_change_invalidates(app_module, client, renders):
+    before = client.get("/feed").headers["ETag"]
+    app_module.urls_cache = app_module.urls_cache[:2]
+    app_module._update_corpus_version()
+    res = client.get("/feed", headers={"If-None-Match": before})
+    assert res.status_code == 200
+    assert res.headers["ETag"] != before
+    assert "https://e.example/5" not in res.get_data(as_text=True)
+
+
+def test_liked_feed_follows_the_liked_pool(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "_liked_version", app_module._liked_version)
+    before = client.get("/feed?liked").headers["ETag"]
+    app_module.urls_liked_cache = [app_module.urls_cache[0]]
+    app_module._liked_version += 1
+    res = client.get("/feed?liked", headers={"If-None-Match": before})
+    assert res.status_code == 200
+    assert "https://a.example/1" in res.get_data(as_text=True)
+
+
+def test_liked_feed_is_modified_by_a_like(app_module, client, monkeypatch):
+    corpus = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    monkeypatch.setattr(app_module, "_corpus_modified", corpus)
+    monkeypatch.setattr(app_module, "_liked_modified", corpus - timedelta(days=1))
+    assert client.get("/feed?liked").headers["Last-Modified"] == "Thu, 01 Jan 2026 00:00:00 GMT"
+    app_module._liked_modified = corpus + timedelta(days=31)
+    modified = client.get("/feed?liked").headers["Last-Modified"]
+    assert modified == "Sun, 01 Feb 2026 00:00:00 GMT"
+    assert client.get("/feed").headers["Last-Modified"] == "Thu, 01 Jan 2026 00:00:00 GMT"
+
+
+# --- paging ---------------------------------------------------------------------
+
+
+def _links(body):
+    return {
+        rel: href.replace("&amp;", "&")
+        for rel, href in re.findall(r'<link rel="(\w+)" href="([^"]+)"', body)
+    }
+
+
+def _links_in(body):
+    return re.findall(r"<link href=\"(https://[a-e]\.example/\d)\" />", body)
+
+
+def _follow(client, href):
+    query = urlparse(href).query
+    return client.get("/feed?" + query).get_data(as_text=True)
+
+
+def test_pages_follow_rfc5005_next_links(client):
+    body = client.get("/feed?limit=2").get_data(as_text=True)
+    seen = _links_in(body)
+    links = _links(body)
+    assert parse_qs(urlparse(links["first"]).query) == {"limit": ["2"]}
+    while "next" in links:
+        body = _follow(client, links["next"])
+        seen += _links_in(body)
+        links = _links(body)
+    assert seen == [f"https://{c}.example/{n}" for c, n in zip("edcba", "54321")]
+
+
+def test_default_page_is_capped(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "FEED_DEFAULT_LIMIT", 3)
+    body = client.get("/feed").get_data(as_text=True)
+    assert len(_links_in(body)) == 3
+    assert "before=" in _links(body)["next"]
+    assert "next" not in _links(client.get("/feed?limit=all").get_data(as_text=True))
+
+
+def test_page_never_splits_posts_with_the_same_timestamp(app_module, client):
+    stamp = datetime(2024, 5, 1, 12, 0)
+    app_module.urls_cache = [
+        e._replace(updated=stamp if i < 3 else stamp - timedelta(hours=i))
+        for i, e in enumerate(app_module.urls_cache)
+    ]
+    app_module._update_corpus_version()
+    body = client.get("/feed?limit=2").get_data(as_text=True)
+    assert len(_links_in(body)) == 3
+    rest = _links_in(_follow(client, _links(body)["next"]))
+    assert len(rest) == 2
+
+
+@pytest.mark.parametrize(
+    "before", ["yesterday", "0001-01-01T00:00:00", "0001-01-01T00:00:00%2B14:00"]
+)
+def test_unusable_cursors_are_rejected(client, before):
+    assert client.get(f"/feed?before={before}").status_code == 400
+
+
+def test_large_exports_are_streamed(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "FEED_STREAM_MIN", 2)
+    res = client.get("/feed?limit=all")
+    assert res.is_streamed
+    body = res.get_data(as_text=True)
+    assert body.startswith("<?xml") and body.rstrip().endswith("</feed>")
+    assert len(_links_in(body)) == 5
+    # Same entries as the document built in one go.
+    monkeypatch.setattr(app_module, "FEED_STREAM_MIN", 100)
+    assert _links_in(client.get("/feed?limit=all").get_data(as_text=True)) == _links_in(body)
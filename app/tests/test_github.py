@@ -0,0 +1,163 @@
+"""Code-mode repo metadata: a TTL cache filled in the background.
+
+GitHub is played by a local HTTP server, so none of this touches the network.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import entry
+
+REPO = "https://github.com/Kagi/Demo"
+
+
+class _FakeGitHub(BaseHTTPRequestHandler):
+    routes = {}  # path -> (status, headers, body)
+    hits = []
+    delay = 0.0
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        time.sleep(self.delay)
+        status, headers, body = self.routes.get(self.path, (404, {}, {}))
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def github(app_module, monkeypatch):
+    """A local stand-in for api.github.com and an empty metadata cache."""
+    _FakeGitHub.routes = {
+        "/repos/Kagi/Demo": (
+            200,
+            {"X-RateLimit-Remaining": "59"},
+            {
+                "description": "A demo",
+                "stargazers_count": 7,
+                "owner": {"avatar_url": "https://avatars.example/k"},
+            },
+        )
+    }
+    _FakeGitHub.hits = []
+    _FakeGitHub.delay = 0.0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeGitHub)
+    threading.Thread(
+        target=server.serve_forever, args=(0.05,), daemon=True
+    ).start()
+    monkeypatch.setattr(
+        app_module, "GITHUB_API", f"http://127.0.0.1:{server.server_port}"
+    )
+    monkeypatch.setattr(app_module, "_gh_meta_cache", OrderedDict())
+    monkeypatch.setattr(app_module, "_gh_blocked_until", 0.0)
+    monkeypatch.setattr(app_module, "_gh_remaining", None)
+    yield _FakeGitHub
+    app_module._gh_queue.join()
+    server.shutdown()
+    server.server_close()
+
+
+def _expire(app_module, owner="kagi", repo="demo"):
+    meta = app_module._gh_meta_cache[(owner, repo)][1]
+    app_module._gh_meta_cache[(owner, repo)] = (time.monotonic() - 1, meta)
+
+
+def test_first_view_queues_and_the_next_one_has_it(app_module, github):
+    assert app_module.gh_repo_meta("Kagi", "Demo") is None
+    app_module._gh_queue.join()
+    meta = app_module.gh_repo_meta("Kagi", "Demo")
+    assert meta["description"] == "A demo"
+    assert meta["stargazers_count"] == 7
+    assert (meta["owner"], meta["repo"]) == ("Kagi", "Demo")
+    assert github.hits == ["/repos/Kagi/Demo"]
+
+
+def test_page_view_never_waits_on_github(app_module, client, github, monkeypatch):
+    monkeypatch.setattr(app_module, "urls_gh_cache", [entry(REPO, "Demo")])
+    github.delay = 1.0
+    started = time.monotonic()
+    body = client.get(f"/?gh&url={REPO}").get_data(as_text=True)
+    assert time.monotonic() - started < 0.5
+    assert "A demo" not in body
+    app_module._gh_queue.join()
+    assert "A demo" in client.get(f"/?gh&url={REPO}").get_data(as_text=True)
+
+
+def test_stale_entries_are_served_while_refreshing(app_module, github):
+    app_module.fetch_gh_meta("Kagi", "Demo")
+    _expire(app_module)
+    github.routes["/repos/Kagi/Demo"][2]["description"] = "Renamed"
+    assert app_module.gh_repo_meta("Kagi", "Demo")["description"] == "A demo"
+    app_module._gh_queue.join()
+    assert app_module.gh_repo_meta("Kagi", "Demo")["description"] == "Renamed"
+
+
+def test_missing_repos_are_cached_as_misses(app_module, github):
+    app_module.fetch_gh_meta("Kagi", "Gone")
+    assert app_module._gh_meta_cache[("kagi", "gone")][1] is None
+    assert app_module.gh_repo_meta("Kagi", "Gone") is None
+    app_module._gh_queue.join()
+    assert github.hits == ["/repos/Kagi/Gone"]
+
+
+def test_errors_keep_the_stale_answer(app_module, github):
+    app_module.fetch_gh_meta("Kagi", "Demo")
+    github.routes["/repos/Kagi/Demo"] = (502, {}, {})
+    app_module.fetch_gh_meta("Kagi", "Demo")
+    expires, meta = app_module._gh_meta_cache[("kagi", "demo")]
+    assert meta["description"] == "A demo"
+    assert expires - time.monotonic() <= app_module.GH_META_RETRY_SECONDS
+
+
+def test_rate_limit_pauses_the_worker(app_module, github):
+    reset = int(time.time()) + 600
+    github.routes["/repos/Kagi/Demo"] = (
+        403,
+        {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(reset)},
+        {"message": "API rate limit exceeded"},
+    )
+    app_module.fetch_gh_meta("Kagi", "Demo")
+    assert app_module._gh_blocked_until == reset
+    # Not cached as a miss: the repo exists, we just may not ask yet.
+    assert ("kagi", "demo") not in app_module._gh_meta_cache
+    app_module.gh_repo_meta("Kagi", "Other")
+    app_module._gh_queue.join()
+    assert github.hits == ["/repos/Kagi/Demo"]
+
+
+def test_prefetch_warms_the_code_pool_within_its_budget(app_module, github):
+    github.routes["/repos/Kagi/Two"] = (200, {"X-RateLimit-Remaining": "5"}, {})
+    pool = [
+        entry("https://github.com/Kagi/Two", "Two"),
+        entry(REPO + "/issues", "Demo issues"),
+        entry(REPO, "Demo"),
+        entry("https://example.com/not-a-repo", "Blog"),
+    ]
+    assert app_module.prefetch_gh_meta(pool) == 2
+    app_module._gh_queue.join()
+    assert github.hits == ["/repos/Kagi/Two"]
+    # The reserve left for page views is not spent on prefetching...
+    assert app_module.gh_repo_meta("Kagi", "Demo") is None
+    # ...but a page view may spend it.
+    app_module._gh_queue.join()
+    assert github.hits == ["/repos/Kagi/Two", "/repos/Kagi/Demo"]
+    assert app_module.prefetch_gh_meta(pool) == 0
+
+
+def test_cache_is_bounded(app_module, github, monkeypatch):
+    monkeypatch.setattr(app_module, "GH_META_MAX", 2)
+    for name in ("a", "b", "c"):
+        app_module._store_gh_meta(("kagi", name), None, 60)
+    assert list(app_module._gh_meta_cache) == [("kagi", "b"), ("kagi", "c")]
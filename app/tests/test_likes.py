@@ -0,0 +1,477 @@
+"""Like persistence: per-instance journals and shards, compaction and merge."""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from conftest import _as_instance, _point_at
+
+REAL_REPLACE = os.replace
+
+
+def _fail_for(suffix):
+    def replace(src, dst):
+        if str(dst).endswith(suffix):
+            raise OSError("simulated crash")
+        return REAL_REPLACE(src, dst)
+
+    return replace
+
+
+def _journal(data_dir, instance="one"):
+    path = data_dir / "likes.d" / f"{instance}.journal"
+    with open(path, encoding="utf-8") as handle:
+        return [json.loads(line) for line in handle]
+
+
+def test_like_is_journaled_without_rewriting_snapshots(app_module, client, data_dir):
+    res = client.post("/api/like", json={"url": "https://a.example/1", "emoji": "🔥"})
+    assert res.get_json()["reaction_count"] == 1
+    app_module._store.ship_likes()
+    events = _journal(data_dir)
+    assert [(e["url"], e["emoji"], e["count"]) for e in events] == [
+        ("https://a.example/1", "🔥", 1)
+    ]
+    assert not (data_dir / "likes.json").exists()
+    assert not (data_dir / "favorites.json").exists()
+    assert not (data_dir / "likes.d" / "one.json").exists()
+
+
+def test_replay_rebuilds_likes_from_journal(app_module, data_dir, monkeypatch):
+    for emoji in ["👍", "👍", "🔥"]:
+        app_module._apply_like("https://a.example/1", emoji)
+    app_module._apply_like("https://b.example/2", "🚀", count=4)
+    before = dict(app_module.likes_dict)
+    assert _as_instance(app_module, monkeypatch, "one") == before
+    assert before["https://b.example/2"] == {"🚀": 4}
+
+
+def test_three_emoji_cap_survives_replay(app_module, data_dir, monkeypatch):
+    for emoji in ["👍", "🔥", "🚀", "👍", "🥳"]:
+        app_module._apply_like("https://a.example/1", emoji)
+    # 👍 was re-used while visible, so it stays the oldest and is evicted.
+    assert list(app_module.likes_dict["https://a.example/1"]) == ["🔥", "🚀", "🥳"]
+    replayed = _as_instance(app_module, monkeypatch, "one")["https://a.example/1"]
+    assert replayed == app_module.likes_dict["https://a.example/1"]
+    assert list(replayed) == ["🔥", "🚀", "🥳"]
+
+
+def test_compaction_writes_own_shard_and_trims_journal(app_module, data_dir, monkeypatch):
+    app_module._apply_like("https://a.example/1", "👍", count=2)
+    app_module.compact_likes()
+    assert _journal(data_dir) == []
+    assert sorted(os.listdir(data_dir / "likes.d")) == ["base.json", "one.journal", "one.json"]
+    for name in ("likes.json", "favorites.json"):
+        with open(data_dir / name, encoding="utf-8") as handle:
+            assert json.load(handle) == {"https://a.example/1": {"👍": 2}}
+
+    app_module._apply_like("https://a.example/1", "👍")
+    assert _as_instance(app_module, monkeypatch, "one") == {"https://a.example/1": {"👍": 3}}
+
+
+def test_replay_never_double_counts_after_interrupted_compaction(
+    app_module, data_dir, monkeypatch
+):
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module._store.ship_likes()
+    # Crash after the shard is written but before the journal is trimmed.
+    monkeypatch.setattr(os, "replace", _fail_for("one.journal"))
+    app_module.compact_likes()
+    monkeypatch.setattr(os, "replace", REAL_REPLACE)
+    assert len(_journal(data_dir)) == 1
+    assert _as_instance(app_module, monkeypatch, "one") == {"https://a.example/1": {"👍": 1}}
+
+
+def test_like_is_acknowledged_while_the_mount_stalls(app_module, client, data_dir):
+    store = app_module._store
+    mounted = store.journal
+    store.journal = str(data_dir / "gone" / "one.journal")
+    res = client.post("/api/like", json={"url": "https://a.example/1"})
+    assert res.status_code == 200
+    with pytest.raises(OSError):
+        store.ship_likes()
+    local = data_dir / "smallweb-one.journal"
+    assert [json.loads(line)["url"] for line in local.read_text().splitlines()] == [
+        "https://a.example/1"
+    ]
+    store.journal = mounted
+    store.ship_likes()
+    assert [e["url"] for e in _journal(data_dir)] == ["https://a.example/1"]
+
+
+def test_a_like_that_is_not_journaled_is_not_acknowledged(
+    app_module, client, data_dir, monkeypatch
+):
+    monkeypatch.setattr(app_module, "_wait_journal", lambda seq: False)
+    res = client.post("/api/like", json={"url": "https://a.example/1"})
+    assert res.status_code == 503
+    assert res.get_json()["ok"] is False
+
+
+def test_a_dead_workers_local_journal_is_shipped_once(app_module, data_dir, monkeypatch):
+    _as_instance(app_module, monkeypatch, "two")
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module._store.ship_likes()
+    app_module._apply_like("https://a.example/1", "👍")
+    # "two" dies before shipping or compacting; the next process adopts its
+    # local journal, whose first event the mount already has.
+    assert _as_instance(app_module, monkeypatch, "three") == {
+        "https://a.example/1": {"👍": 2}
+    }
+    assert not (data_dir / "smallweb-two.journal").exists()
+    assert sorted({e["seq"] for e in _journal(data_dir, "two")}) == [1, 2]
+
+
+def test_replay_skips_torn_final_line(app_module, data_dir, monkeypatch):
+    app_module._apply_like("https://a.example/1", "👍")
+    with open(data_dir / "likes.d" / "one.journal", "a", encoding="utf-8") as handle:
+        handle.write('{"seq": 99, "url": "https://a.exa')
+    assert _as_instance(app_module, monkeypatch, "one") == {"https://a.example/1": {"👍": 1}}
+
+
+# --- migration ------------------------------------------------------------------
+
+
+def test_legacy_likes_file_becomes_the_base(app_module, tmp_path, monkeypatch):
+    (tmp_path / "likes.json").write_text(
+        json.dumps({"https://a.example/1": {"👍": 5, "🔥": 1}}), encoding="utf-8"
+    )
+    _point_at(app_module, tmp_path, monkeypatch)
+    assert app_module.likes_dict == {"https://a.example/1": {"👍": 5, "🔥": 1}}
+    app_module._apply_like("https://a.example/1", "👍")
+    assert app_module.likes_dict["https://a.example/1"] == {"👍": 6, "🔥": 1}
+    # The export is rewritten from the merged view, never read back.
+    app_module.compact_likes()
+    assert _as_instance(app_module, monkeypatch, "two")["https://a.example/1"]["👍"] == 6
+
+
+def test_pre_shard_journal_is_folded_into_the_base(app_module, tmp_path, monkeypatch):
+    (tmp_path / "likes.snapshot.json").write_text(
+        json.dumps({"seq": 1, "likes": {"https://a.example/1": {"👍": 2}}}),
+        encoding="utf-8",
+    )
+    (tmp_path / "likes.journal").write_text(
+        '{"seq": 1, "url": "https://a.example/1", "emoji": "👍", "count": 1}\n'
+        '{"seq": 2, "url": "https://a.example/1", "emoji": "🔥", "count": 1}\n',
+        encoding="utf-8",
+    )
+    _point_at(app_module, tmp_path, monkeypatch)
+    assert app_module.likes_dict == {"https://a.example/1": {"👍": 2, "🔥": 1}}
+
+
+# --- multiple instances ---------------------------------------------------------
+
+
+def test_instances_converge_without_overwriting_each_other(
+    app_module, data_dir, monkeypatch
+):
+    app_module._apply_like("https://a.example/1", "👍", count=2)
+    app_module.compact_likes()
+
+    _as_instance(app_module, monkeypatch, "two")
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module._apply_like("https://b.example/2", "🚀")
+    # Journal only: peers see it before "two" ever compacts.
+
+    one = _as_instance(app_module, monkeypatch, "one")
+    assert one == {"https://a.example/1": {"👍": 3}, "https://b.example/2": {"🚀": 1}}
+    two = _as_instance(app_module, monkeypatch, "two")
+    assert two == one
+
+
+def test_merge_picks_up_a_peer_only_when_its_files_change(
+    app_module, data_dir, likeable
+):
+    assert app_module.merge_likes() is False
+    peer = data_dir / "likes.d" / "peer.journal"
+    peer.write_text(
+        json.dumps(
+            {"seq": 1, "url": "https://c.example/3", "emoji": "🥳", "count": 1, "added": 1.0}
+        )
+        + "\n",
+        encoding="utf-8",
+    )
+    assert app_module.merge_likes() is True
+    assert app_module.likes_dict["https://c.example/3"] == {"🥳": 1}
+    assert [e.link for e in app_module.urls_liked_cache] == ["https://c.example/3"]
+    assert app_module.merge_likes() is False
+
+
+def _age(data_dir, instance, seconds):
+    for path in (data_dir / "likes.d").glob(instance + ".*"):
+        st = path.stat()
+        os.utime(path, (st.st_atime - seconds, st.st_mtime - seconds))
+
+
+def test_idle_shards_are_folded_into_the_base(app_module, data_dir, monkeypatch):
+    _as_instance(app_module, monkeypatch, "two")
+    app_module._apply_like("https://a.example/1", "👍", count=2)
+    app_module.compact_likes()
+    app_module._apply_like("https://b.example/2", "🚀")
+    one = _as_instance(app_module, monkeypatch, "one")
+
+    assert app_module.fold_idle_shards() == 0
+    # Switching instances shipped "two"'s local journal and marked it closed.
+    assert (data_dir / "likes.d" / "two.closed").exists()
+    _age(data_dir, "two", app_module.LIKES_SHARD_IDLE_SECONDS + 60)
+    assert app_module.fold_idle_shards() == 1
+    assert sorted(p.name for p in (data_dir / "likes.d").glob("two.*")) == []
+    assert not (data_dir / "likes.d" / "fold.lock").exists()
+    base = json.loads((data_dir / "likes.d" / "base.json").read_text(encoding="utf-8"))
+    assert base["folded"] == []
+    assert base["likes"]["https://a.example/1"]["👍"][0] == 2
+    # Same merged view, now from the base alone.
+    assert _as_instance(app_module, monkeypatch, "one") == one
+
+
+def test_a_live_idle_shard_is_not_folded(app_module, data_dir, monkeypatch):
+    _as_instance(app_module, monkeypatch, "two")
+    app_module._apply_like("https://a.example/1", "👍", count=2)
+    app_module.compact_likes()
+    _as_instance(app_module, monkeypatch, "one")
+    # "two" is still running elsewhere, just throttled: it never closed.
+    (data_dir / "likes.d" / "two.closed").unlink()
+    _age(data_dir, "two", app_module.LIKES_SHARD_IDLE_SECONDS + 60)
+    assert app_module.fold_idle_shards() == 0
+
+    _as_instance(app_module, monkeypatch, "two")
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module.compact_likes()
+    assert _as_instance(app_module, monkeypatch, "one") == {"https://a.example/1": {"👍": 3}}
+
+
+def test_a_restart_under_the_same_id_withdraws_the_marker(app_module, data_dir, monkeypatch):
+    _as_instance(app_module, monkeypatch, "two")
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module.compact_likes()
+    _as_instance(app_module, monkeypatch, "one")
+    assert (data_dir / "likes.d" / "two.closed").exists()
+
+    _as_instance(app_module, monkeypatch, "two")
+    assert not (data_dir / "likes.d" / "two.closed").exists()
+    _age(data_dir, "two", app_module.LIKES_SHARD_IDLE_SECONDS + 60)
+    assert app_module.fold_idle_shards() == 0
+
+
+def test_a_folded_instance_compacts_again_without_double_counting(
+    app_module, data_dir, monkeypatch
+):
+    _as_instance(app_module, monkeypatch, "two")
+    app_module._apply_like("https://a.example/1", "👍", count=2)
+    app_module.save_all_data()
+    _as_instance(app_module, monkeypatch, "one")
+    _age(data_dir, "two", app_module.LIKES_SHARD_IDLE_SECONDS + 60)
+    assert app_module.fold_idle_shards() == 1
+
+    # Restarted under the same pinned id, after its shard went into the base.
+    _as_instance(app_module, monkeypatch, "two")
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module.compact_likes()
+    assert _as_instance(app_module, monkeypatch, "one") == {"https://a.example/1": {"👍": 3}}
+
+
+def test_a_shard_listed_as_folded_is_not_counted_twice(app_module, data_dir, monkeypatch):
+    _as_instance(app_module, monkeypatch, "two")
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module.compact_likes()
+    counters = json.loads((data_dir / "likes.d" / "two.json").read_text(encoding="utf-8"))
+    # A fold that wrote the base and died before deleting the shard.
+    (data_dir / "likes.d" / "base.json").write_text(
+        json.dumps({"likes": counters["likes"], "folded": ["two"]}), encoding="utf-8"
+    )
+    assert _as_instance(app_module, monkeypatch, "one") == {"https://a.example/1": {"👍": 1}}
+
+
+def test_compaction_keeps_a_live_shard_fresh(app_module, data_dir):
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module.compact_likes()
+    _age(data_dir, "one", app_module.LIKES_SHARD_IDLE_SECONDS + 60)
+    app_module.compact_likes()  # nothing new to compact, still a heartbeat
+    assert all(
+        p.stat().st_mtime > time.time() - 60
+        for p in (data_dir / "likes.d").glob("one.*")
+    )
+
+
+def test_cap_applies_to_the_merged_view(app_module, data_dir, monkeypatch):
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module._apply_like("https://a.example/1", "🔥")
+    _as_instance(app_module, monkeypatch, "two")
+    app_module._apply_like("https://a.example/1", "🚀")
+    app_module._apply_like("https://a.example/1", "🥳")
+    assert list(app_module.likes_dict["https://a.example/1"]) == ["🔥", "🚀", "🥳"]
+    assert _as_instance(app_module, monkeypatch, "one") == app_module.likes_dict
+
+
+# --- SQLite store ---------------------------------------------------------------
+
+
+@pytest.fixture
+def sqlite_dir(app_module, data_dir, monkeypatch):
+    monkeypatch.setattr(app_module, "STORE_BACKEND", "sqlite")
+    _as_instance(app_module, monkeypatch, "one")
+    return data_dir
+
+
+def _rows(data_dir, sql, instance="one"):
+    db = sqlite3.connect(data_dir / f"smallweb-{instance}.sqlite")
+    try:
+        return db.execute(sql).fetchall()
+    finally:
+        db.close()
+
+
+def test_sqlite_store_migrates_json_state_once(app_module, data_dir, monkeypatch):
+    app_module._apply_like("https://a.example/1", "👍", count=2)
+    app_module.compact_likes()
+    (data_dir / "notes.json").write_text(
+        json.dumps({"https://a.example/1": [["nice", "2024-01-02T03:04:05"]]}),
+        encoding="utf-8",
+    )
+    (data_dir / "flags.d" / "one.json").write_text(
+        json.dumps({"https://b.example/2": 3}), encoding="utf-8"
+    )
+
+    monkeypatch.setattr(app_module, "STORE_BACKEND", "sqlite")
+    assert _as_instance(app_module, monkeypatch, "one") == {"https://a.example/1": {"👍": 2}}
+    assert app_module._store.load_flags() == {"https://b.example/2": 3}
+    [(content, ts)] = app_module._store.load_notes()["https://a.example/1"]
+    assert (content, ts.isoformat()) == ("nice", "2024-01-02T03:04:05")
+
+    # Already migrated: later edits to the JSON files are not imported again.
+    (data_dir / "flags.d" / "one.json").write_text(
+        json.dumps({"https://b.example/2": 9}), encoding="utf-8"
+    )
+    _as_instance(app_module, monkeypatch, "one")
+    assert app_module._store.load_flags() == {"https://b.example/2": 3}
+
+
+def test_sqlite_store_writes_rows_not_files(app_module, client, sqlite_dir, monkeypatch):
+    monkeypatch.setattr(app_module, "notes_dict", {})
+    monkeypatch.setattr(app_module, "flagged_content_dict", {})
+    client.post("/api/like", json={"url": "https://a.example/1", "emoji": "🔥"})
+    client.post("/api/like", json={"url": "https://a.example/1", "emoji": "🔥"})
+    client.post("/flag_content", data={"url": "https://b.example/2"})
+    client.post("/note", data={"url": "https://c.example/3", "note_content": "hi"})
+    app_module.flush_user_data()
+
+    assert _rows(sqlite_dir, "SELECT url, emoji, count FROM reactions") == [
+        ("https://a.example/1", "🔥", 2)
+    ]
+    assert _rows(sqlite_dir, "SELECT url, count FROM flags") == [("https://b.example/2", 1)]
+    assert _rows(sqlite_dir, "SELECT url, content FROM notes") == [
+        ("https://c.example/3", "hi")
+    ]
+    assert not (sqlite_dir / "likes.d" / "one.journal").exists()
+    assert not (sqlite_dir / "flagged_content.json").exists()
+    assert not (sqlite_dir / "flags.d" / "one.json").exists()
+    assert not (sqlite_dir / "notes.json").exists()
+
+
+def test_sqlite_store_restores_from_checkpoint(app_module, sqlite_dir, monkeypatch):
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module.checkpoint_store()
+    assert (sqlite_dir / "likes.d" / "one.sqlite").exists()
+
+    # A fresh container: local disk is gone, the mount is not.
+    app_module._store.close()
+    os.remove(sqlite_dir / "smallweb-one.sqlite")
+    assert _as_instance(app_module, monkeypatch, "one") == {"https://a.example/1": {"👍": 1}}
+
+
+def test_peers_merge_a_sqlite_checkpoint(app_module, sqlite_dir, monkeypatch):
+    app_module._apply_like("https://a.example/1", "👍")
+    app_module.checkpoint_store()
+
+    monkeypatch.setattr(app_module, "STORE_BACKEND", "json")
+    two = _as_instance(app_module, monkeypatch, "two")
+    assert two == {"https://a.example/1": {"👍": 1}}
+
+
+# --- liked pool and feed --------------------------------------------------------
+
+
+@pytest.fixture
+def likeable(app_module, data_dir, monkeypatch):
+    monkeypatch.setattr(
+        app_module, "_likeable_entries", {e.link: e for e in app_module.urls_cache}
+    )
+    return app_module
+
+
+def test_first_reaction_adds_post_to_liked_pool(likeable):
+    likeable._apply_like("https://c.example/3", "👍")
+    assert [e.link for e in likeable.urls_liked_cache] == ["https://c.example/3"]
+    version = likeable._liked_version
+
+    # A further reaction on an already-liked post leaves the pool alone.
+    likeable._apply_like("https://c.example/3", "🔥")
+    assert likeable._liked_version == version
+    assert len(likeable.urls_liked_cache) == 1
+
+
+def test_like_on_unknown_post_stays_out_of_liked_pool(likeable):
+    likeable._apply_like("https://gone.example/9", "👍")
+    assert likeable.urls_liked_cache == []
+
+
+def test_liked_feed_is_built_lazily_and_reused(likeable, client, monkeypatch):
+    builds = []
+    real_feed = likeable.AtomFeed
+
+    def counting_feed(*args, **kwargs):
+        builds.append(1)
+        return real_feed(*args, **kwargs)
+
+    monkeypatch.setattr(likeable, "AtomFeed", counting_feed)
+    likeable._apply_like("https://a.example/1", "👍")
+    assert builds == []
+
+    body = client.get("/liked").get_data(as_text=True)
+    assert "https://a.example/1" in body
+    client.get("/liked")
+    likeable._apply_like("https://a.example/1", "👍")
+    client.get("/liked")
+    assert len(builds) == 1
+
+    likeable._apply_like("https://b.example/2", "👍")
+    assert "https://b.example/2" in client.get("/liked").get_data(as_text=True)
+    assert len(builds) == 2
+
+
+def test_concurrent_likes_are_all_counted(likeable, monkeypatch):
+    """Thousands of likes from many threads while the pool is republished."""
+    links = [e.link for e in likeable.urls_cache]
+    threads, per_thread = 8, 400
+    done = threading.Event()
+
+    def liker(offset):
+        for i in range(per_thread):
+            likeable._apply_like(links[(offset + i) % len(links)], "👍")
+
+    def republisher():
+        # What update_all, merge_likes and compaction do on the scheduler.
+        while not done.is_set():
+            with likeable._likes_lock:
+                likeable._publish_likes()
+                likeable._rebuild_liked_cache()
+            likeable.merge_likes()
+            likeable.compact_likes()
+
+    background = threading.Thread(target=republisher)
+    background.start()
+    workers = [threading.Thread(target=liker, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    done.set()
+    background.join()
+
+    expected = threads * per_thread // len(links)
+    assert likeable.likes_dict == {link: {"👍": expected} for link in links}
+    assert sorted(e.link for e in likeable.urls_liked_cache) == sorted(links)
+    assert _as_instance(likeable, monkeypatch, "one") == likeable.likes_dict
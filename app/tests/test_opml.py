@@ -0,0 +1,183 @@
+"""Curated feed lists: the feed registry and /opml, built once per content hash."""
+import gzip
+from html import escape
+
+import pytest
+
+from conftest import BLOGS, entry
+
+
+@pytest.fixture
+def lists(app_module, tmp_path, monkeypatch):
+    """Small feed list files in `tmp_path`, nothing built yet."""
+    (tmp_path / "smallweb.txt").write_text(
+        "https://a.example/feed\n# comment\nhttps://www.b.example/rss  # note\n"
+    )
+    (tmp_path / "smallyt.txt").write_text(
+        "https://www.youtube.com/feeds/videos.xml?channel_id=X "
+        "# Some Channel https://www.youtube.com/channel/X\n"
+    )
+    (tmp_path / "smallcomic.txt").write_text("https://comic.example/atom\n")
+    monkeypatch.setattr(
+        app_module, "_find_feed_file", lambda name: str(tmp_path / name)
+    )
+    for name, empty in [
+        ("feed_lists", {}),
+        ("feed_registry", {}),
+        ("_feed_lists_digest", ""),
+        ("_opml_cache", {}),
+    ]:
+        monkeypatch.setattr(app_module, name, empty)
+    return tmp_path
+
+
+def test_full_list_has_every_mode(client, lists):
+    body = client.get("/opml").get_data(as_text=True)
+    assert body.startswith('<?xml version="1.0" encoding="UTF-8"?>')
+    assert body.count("<outline ") == 4
+    assert 'xmlUrl="https://a.example/feed"' in body
+    assert 'title="b.example"' in body
+    assert 'title="Some Channel"' in body
+    assert 'xmlUrl="https://comic.example/atom"' in body
+
+
+@pytest.mark.parametrize(
+    "mode, url",
+    [
+        ("blogs", "https://a.example/feed"),
+        ("yt", "https://www.youtube.com/feeds/videos.xml?channel_id=X"),
+        ("comic", "https://comic.example/atom"),
+    ],
+)
+def test_mode_variants_hold_only_their_list(client, lists, mode, url):
+    body = client.get(f"/opml?mode={mode}").get_data(as_text=True)
+    assert f'xmlUrl="{escape(url)}"' in body
+    assert body.count("<outline ") == (2 if mode == "blogs" else 1)
+
+
+def test_unknown_mode_gets_the_full_list(client, lists):
+    assert client.get("/opml?mode=nope").get_data() == client.get("/opml").get_data()
+
+
+def test_gzip_etag_and_304(client, lists):
+    plain = client.get("/opml?mode=blogs")
+    packed = client.get("/opml?mode=blogs", headers={"Accept-Encoding": "gzip"})
+    assert packed.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in packed.headers["Vary"]
+    assert gzip.decompress(packed.get_data()) == plain.get_data()
+    etag = plain.headers["ETag"]
+    assert packed.headers["ETag"] == etag[:-1] + '-gz"'
+    assert etag != client.get("/opml").headers["ETag"]
+    res = client.get("/opml?mode=blogs", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.get_data() == b""
+    res = client.get(
+        "/opml?mode=blogs", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert res.status_code == 200
+    res = client.get(
+        "/opml?mode=blogs",
+        headers={"Accept-Encoding": "gzip", "If-None-Match": packed.headers["ETag"]},
+    )
+    assert res.status_code == 304
+
+
+def test_rebuilt_only_when_the_lists_change(app_module, client, lists, monkeypatch):
+    assert app_module.refresh_feed_lists() is True
+    etag = client.get("/opml").headers["ETag"]
+    builds = []
+    real = app_module.generate_opml_feed
+    monkeypatch.setattr(
+        app_module,
+        "generate_opml_feed",
+        lambda *a: builds.append(a) or real(*a),
+    )
+    assert app_module.refresh_feed_lists() is False
+    assert builds == []
+
+    (lists / "smallcomic.txt").write_text("https://comic.example/atom\nhttps://x.example/\n")
+    assert app_module.refresh_feed_lists() is True
+    assert len(builds) == 4
+    res = client.get("/opml", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.get_data(as_text=True).count("<outline ") == 5
+
+
+# --- registry -------------------------------------------------------------------
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://www.B.example/rss",
+        "http://b.example/rss/",
+        "https://b.example:443/rss",
+    ],
+)
+def test_normalized_urls_share_a_key(app_module, url):
+    assert app_module.normalize_feed_url(url) == "b.example/rss"
+
+
+def test_query_and_port_are_kept(app_module):
+    assert app_module.normalize_feed_url("https://x.example:8080/f?id=1") == (
+        "x.example:8080/f?id=1"
+    )
+
+
+def test_registry_rows(app_module, lists):
+    app_module.refresh_feed_lists()
+    assert [s.kind for s in app_module.feed_registry.values()] == [
+        "blogs",
+        "blogs",
+        "yt",
+        "comic",
+    ]
+    row = app_module.feed_registry["b.example/rss"]
+    assert row == app_module.FeedSource(
+        "https://www.b.example/rss", "blogs", "", "https://www.b.example", "b.example"
+    )
+    yt = app_module.feed_registry["youtube.com/feeds/videos.xml?channel_id=X"]
+    assert (yt.name, yt.html_url) == ("Some Channel", "https://www.youtube.com/channel/X")
+
+
+def test_duplicate_feed_keeps_its_first_row(app_module, lists):
+    (lists / "smallcomic.txt").write_text("http://a.example/feed/\n")
+    app_module.refresh_feed_lists()
+    assert app_module.feed_registry["a.example/feed"].kind == "blogs"
+    # OPML still mirrors the files.
+    assert len(app_module.feed_lists["comic"]) == 1
+
+
+def test_entries_join_on_their_via_link(app_module, lists):
+    app_module.refresh_feed_lists()
+    post = app_module.urls_cache[0]._replace(feed_url="http://b.example/rss/")
+    assert app_module.feed_source(post).host == "b.example"
+    assert app_module.feed_source(post._replace(feed_url="https://z.example/")) is None
+    assert app_module.feed_source(post._replace(feed_url="")) is None
+
+
+def test_river_cards_name_youtube_channels(app_module, lists):
+    app_module.refresh_feed_lists()
+    post = app_module.urls_cache[0]
+    video = entry(post.link, feed_url="https://www.youtube.com/feeds/videos.xml?channel_id=X")
+    assert app_module._river_card(video, "yt")["domain"] == "Some Channel"
+    blog = entry(post.link, feed_url="https://a.example/feed")
+    assert app_module._river_card(blog, "")["domain"] == post.display_domain
+
+
+def test_changed_lists_rename_the_cards(app_module, lists):
+    app_module.refresh_feed_lists()
+    video = entry(
+        "https://v.example/1", feed_url="https://www.youtube.com/feeds/videos.xml?channel_id=X"
+    )
+    assert video.source_name == "Some Channel"
+    app_module.urls_yt_cache = [video]
+    (lists / "smallyt.txt").write_text(
+        "https://www.youtube.com/feeds/videos.xml?channel_id=X "
+        "# Renamed https://www.youtube.com/channel/X\n"
+    )
+    app_module._install_corpus()
+    assert app_module._river_card(app_module.urls_yt_cache[0], "yt")["domain"] == "Renamed"
+    # A listed host now links to its feed; the rest are kept as they are.
+    assert app_module.urls_cache[0].more_query == "source=https%3A%2F%2Fa.example%2Ffeed"
+    assert app_module.urls_cache[2] is BLOGS[2]
@@ -0,0 +1,131 @@
+"""Public suffix lookup, checked against the PSL project's own test vectors.
+
+Cases are from publicsuffix.org's tests/test_psl.txt, limited to rules that
+are in the bundled public_suffix_list.dat.
+"""
+import shutil
+
+import pytest
+
+import psl
+
+CASES = [
+    # Unlisted TLD: the implicit "*" rule.
+    ("example", None),
+    ("example.example", "example.example"),
+    ("b.example.example", "example.example"),
+    ("a.b.example.example", "example.example"),
+    # TLD with only one rule.
+    ("biz", None),
+    ("domain.biz", "domain.biz"),
+    ("b.domain.biz", "domain.biz"),
+    # TLD with some two-level rules.
+    ("com", None),
+    ("example.com", "example.com"),
+    ("b.example.com", "example.com"),
+    ("uk.com", None),
+    ("example.uk.com", "example.uk.com"),
+    ("b.example.uk.com", "example.uk.com"),
+    ("test.ac", "test.ac"),
+    # Wildcard rules.
+    ("mm", None),
+    ("c.mm", None),
+    ("b.c.mm", "b.c.mm"),
+    ("a.b.c.mm", "b.c.mm"),
+    # Wildcard plus exception rules.
+    ("jp", None),
+    ("test.jp", "test.jp"),
+    ("www.test.jp", "test.jp"),
+    ("ac.jp", None),
+    ("test.ac.jp", "test.ac.jp"),
+    ("kyoto.jp", None),
+    ("test.kyoto.jp", "test.kyoto.jp"),
+    ("c.kobe.jp", None),
+    ("b.c.kobe.jp", "b.c.kobe.jp"),
+    ("a.b.c.kobe.jp", "b.c.kobe.jp"),
+    ("city.kobe.jp", "city.kobe.jp"),
+    ("www.city.kobe.jp", "city.kobe.jp"),
+    ("ck", None),
+    ("test.ck", None),
+    ("b.test.ck", "b.test.ck"),
+    ("a.b.test.ck", "b.test.ck"),
+    ("www.ck", "www.ck"),
+    ("www.www.ck", "www.ck"),
+    # US K12.
+    ("us", None),
+    ("test.us", "test.us"),
+    ("www.test.us", "test.us"),
+    ("ak.us", None),
+    ("test.ak.us", "test.ak.us"),
+    ("k12.ak.us", None),
+    ("test.k12.ak.us", "test.k12.ak.us"),
+    # Private section and mixed case.
+    ("github.io", None),
+    ("someone.github.io", "someone.github.io"),
+    ("www.blog.someone.github.io", "someone.github.io"),
+    ("bogleech.blogspot.com", "bogleech.blogspot.com"),
+    ("COM", None),
+    ("WwW.Example.COM", "example.com"),
+    # Degenerate input.
+    ("", None),
+    (".com", None),
+    ("example.com.", "example.com"),
+]
+
+
+@pytest.mark.parametrize("host, expected", CASES)
+def test_registrable_domain(app_module, host, expected):
+    assert app_module.registrable_domain(host) == expected
+
+
+def test_display_domain_keeps_the_full_host(app_module):
+    assert app_module.display_domain("https://www.example.co.uk/post") == "example.co.uk"
+    assert app_module.display_domain("https://bogleech.tumblr.com/x") == "bogleech.tumblr.com"
+    assert app_module.display_domain("https://someone.github.io/") == "someone.github.io"
+
+
+def test_lookups_are_memoized(app_module):
+    app_module.registrable_domain.cache_clear()
+    app_module.registrable_domain("a.example.com")
+    app_module.registrable_domain("a.example.com")
+    info = app_module.registrable_domain.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+    assert info.maxsize == app_module.PSL_CACHE_SIZE
+
+
+# --- precompiled artifact -------------------------------------------------------
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "public_suffix_list.dat"
+    shutil.copy("public_suffix_list.dat", path)
+    return str(path)
+
+
+def test_artifact_round_trips_the_parsed_trie(source):
+    with open(source, encoding="utf-8") as f:
+        parsed = psl.parse(f.read())
+    psl.compile_artifact(source)
+    assert psl.load(source) == parsed
+
+
+def test_artifact_is_used_while_the_source_hash_matches(source, monkeypatch):
+    psl.compile_artifact(source)
+    monkeypatch.setattr(psl, "parse", lambda text: pytest.fail("parsed the text"))
+    assert psl.load(source)["uk"]["co"][""] == psl.PSL_RULE
+
+
+def test_edited_source_invalidates_the_artifact(source):
+    psl.compile_artifact(source)
+    with open(source, "a", encoding="utf-8") as f:
+        f.write("\nsmallweb.example\n")
+    assert psl.load(source)["example"]["smallweb"][""] == psl.PSL_RULE
+    # ...and the rewritten artifact now carries the edit.
+    assert "smallweb" in psl.load(source)["example"]
+
+
+def test_corrupt_artifact_falls_back_to_parsing(source):
+    with open(psl.artifact_path(source), "wb") as f:
+        f.write(b"not marshal")
+    assert psl.load(source)["jp"]["kobe"]["city"][""] == psl.PSL_EXCEPTION
@@ -0,0 +1,155 @@
+"""River: precomputed card fields and timestamp+row cursor pagination."""
+import re
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from conftest import entry
+
+
+def _cards(body):
+    return re.findall(r'class="river-card" data-href="[^"]*url=([^"&]+)', body)
+
+
+def _next(body):
+    match = re.search(r'href="([^"]+)" class="btn river-load-btn"', body)
+    return match.group(1).replace("&amp;", "&") if match else None
+
+
+def _walk(client, url):
+    seen = []
+    while url:
+        body = client.get(url).get_data(as_text=True)
+        seen += _cards(body)
+        nxt = _next(body)
+        url = "/river?" + urlparse(nxt).query if nxt else None
+    return seen
+
+
+@pytest.fixture
+def many(app_module, monkeypatch):
+    """23 posts, six of which share one timestamp, and a spam post."""
+    monkeypatch.setattr(app_module, "RIVER_PAGE_SIZE", 4)
+    stamp = datetime(2024, 5, 1, 12, 0)
+    posts = [entry(f"https://p{i:02d}.example/", cats=["tech"]) for i in range(23)]
+    posts = [
+        p._replace(updated=stamp if 5 <= i < 11 else stamp - timedelta(hours=i - 5))
+        for i, p in enumerate(posts)
+    ]
+    posts.append(entry("https://spam.example/", cats=["spam"], minutes_old=0))
+    app_module.urls_cache = posts
+    app_module._update_corpus_version()
+    return posts
+
+
+def test_cursor_walk_returns_every_post_once_in_order(client, many):
+    seen = _walk(client, "/river")
+    expected = sorted(
+        (p for p in many if "spam" not in p.categories),
+        key=lambda p: (p.updated, p.link),
+        reverse=True,
+    )
+    assert seen == [p.link.replace(":", "%3A").replace("/", "%2F") for p in expected]
+
+
+def test_next_link_uses_a_cursor_and_keeps_other_params(client, many):
+    body = client.get("/river?topic=tech").get_data(as_text=True)
+    params = parse_qs(urlparse(_next(body)).query)
+    assert params["topic"] == ["tech"]
+    assert "page" not in params
+    assert re.fullmatch(r"[\w-]+", params["cursor"][0])
+
+
+def test_cursor_is_stable_when_newer_posts_arrive(app_module, client, many):
+    body = client.get("/river").get_data(as_text=True)
+    cursor_url = "/river?" + urlparse(_next(body)).query
+    before = _cards(client.get(cursor_url).get_data(as_text=True))
+
+    app_module.urls_cache = [entry("https://fresh.example/", cats=["tech"])] + many
+    app_module._update_corpus_version()
+    assert _cards(client.get(cursor_url).get_data(as_text=True)) == before
+
+
+def test_legacy_page_parameter_still_works(client, many):
+    first = _cards(client.get("/river").get_data(as_text=True))
+    second = _cards(client.get("/river?page=2").get_data(as_text=True))
+    assert len(first) == len(second) == 4
+    assert not set(first) & set(second)
+
+
+def test_cards_use_fields_computed_at_ingest(app_module, client, many, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("computed per request")
+
+    monkeypatch.setattr(app_module, "make_excerpt", fail)
+    monkeypatch.setattr(app_module, "display_domain", fail)
+    body = client.get("/river").get_data(as_text=True)
+    assert "p00.example" in body
+    assert re.search(r'river-card-badge">[^<]*Technology', body)
+    assert "spam.example" not in body
+
+
+# --- /api/river -----------------------------------------------------------------
+
+
+def _api_walk(client, url):
+    seen = []
+    while url:
+        data = client.get(url).get_json()
+        seen += [card["link"] for card in data["cards"]]
+        url = data["next_url"]
+    return seen
+
+
+def test_api_pages_match_the_html_river(client, many):
+    html = [link.replace("%3A", ":").replace("%2F", "/") for link in _walk(client, "/river")]
+    assert _api_walk(client, "/api/river?limit=5") == html
+
+
+def test_api_card_fields(client, many):
+    card = client.get("/api/river?limit=1").get_json()["cards"][0]
+    assert card["link"] == "https://p00.example/"
+    assert card["updated"].endswith("Z")
+    assert card["domain"].endswith(".example")
+    assert card["badge"]["slug"] == "tech"
+    assert card["badge"]["label"] == "Technology"
+    assert card["sw_url"].endswith("url=" + card["link"].replace(":", "%3A").replace("/", "%2F"))
+    assert "date" not in card
+
+
+def test_api_since_returns_only_newer_posts(app_module, client, many):
+    latest = client.get("/api/river").get_json()["latest"]
+    assert client.get(f"/api/river?since={latest}").get_json()["cards"] == []
+
+    fresh = [entry(f"https://fresh{i}.example/", cats=["tech"]) for i in range(3)]
+    app_module.urls_cache = fresh + many
+    app_module._update_corpus_version()
+    polled = client.get(f"/api/river?since={latest}&limit=2").get_json()
+    rest = client.get(polled["next_url"]).get_json()
+    assert sorted(c["link"] for c in polled["cards"] + rest["cards"]) == sorted(
+        e.link for e in fresh
+    )
+    assert rest["next_url"] is None
+
+
+def test_api_etag_holds_until_the_corpus_changes(app_module, client, many):
+    res = client.get("/api/river?topic=tech")
+    etag = res.headers["ETag"]
+    assert res.headers["Cache-Control"] == "no-cache"
+    assert client.get("/api/river?topic=tech", headers={"If-None-Match": etag}).status_code == 304
+
+    app_module.urls_cache = many[:5]
+    app_module._update_corpus_version()
+    assert client.get("/api/river?topic=tech", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_api_mode_param_and_bad_cursor(client):
+    links = [c["link"] for c in client.get("/api/river?mode=comic").get_json()["cards"]]
+    assert sorted(links) == ["https://comic.example/1", "https://comic.example/2"]
+    assert client.get("/api/river?cursor=!!").status_code == 400
+
+
+def test_html_river_links_its_api_page(client, many):
+    body = client.get("/river").get_data(as_text=True)
+    assert re.search(r'data-api="[^"]*/api/river\?cursor=[\w-]+"', body)
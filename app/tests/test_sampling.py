@@ -0,0 +1,217 @@
+"""Weighted sampling: source-fair alias tables and popularity Fenwick trees."""
+import json
+import random
+from collections import Counter
+
+import pytest
+
+from conftest import entry
+
+# Chi-square critical value for 2 degrees of freedom at p = 0.001.
+CHI2_CRIT_DF2 = 13.82
+DRAWS = 30000
+# Filtered pools reject the base pool's draws outside them, so fewer draws.
+FILTERED_DRAWS = 4000
+
+
+def _chi2(counts, expected):
+    return sum((counts.get(k, 0) - e) ** 2 / e for k, e in expected.items())
+
+
+@pytest.fixture
+def skewed(app_module, monkeypatch):
+    """Three feeds with 1, 10 and 100 posts, sampled source-fairly."""
+    posts = [
+        entry(
+            f"https://{name}.example/{i}",
+            cats=["tech" if i % 2 else "art"],
+            feed_url=f"https://{name}.example/feed",
+        )
+        for name, size in (("tiny", 1), ("mid", 10), ("huge", 100))
+        for i in range(size)
+    ]
+    monkeypatch.setattr(app_module, "SAMPLING_MODE", "source")
+    monkeypatch.setattr(app_module, "urls_cache", posts)
+    app_module._rebuild_group_indexes()
+    random.seed(12345)
+    return posts
+
+
+def _source(e):
+    return e.link.split("//")[1].split(".")[0]
+
+
+def test_alias_table_reproduces_the_weights(app_module):
+    weights = [1, 2, 3, 0.5, 10, 0]
+    prob, alias = app_module._build_alias_table(weights)
+    n, total = len(weights), sum(weights)
+    exact = [p / n for p in prob]
+    for row, target in enumerate(alias):
+        exact[target] += (1 - prob[row]) / n
+    assert exact == pytest.approx([w / total for w in weights])
+
+
+def test_sources_are_drawn_equally_often(app_module, skewed):
+    counts = Counter(_source(app_module._pick_unseen(skewed, set())) for _ in range(DRAWS))
+    assert _chi2(counts, {s: DRAWS / 3 for s in ("tiny", "mid", "huge")}) < CHI2_CRIT_DF2
+
+
+def test_uniform_mode_favours_the_prolific_feed(app_module, skewed, monkeypatch):
+    monkeypatch.setattr(app_module, "SAMPLING_MODE", "uniform")
+    counts = Counter(_source(app_module._pick_unseen(skewed, set())) for _ in range(3000))
+    assert counts["huge"] > 0.8 * 3000
+
+
+def test_seen_posts_are_rejected_and_the_rest_stay_fair(app_module, skewed):
+    # All of "mid" and 90 of "huge" seen. Weights stay 1 / (posts in the whole
+    # pool), so the 10 unseen huge posts together weigh 0.1 against tiny's 1:
+    # a feed the reader has mostly seen comes up less, not more.
+    seen = {app_module._hash_url(e.link) for e in skewed[1:101]}
+    picks = [app_module._pick_unseen(skewed, seen) for _ in range(DRAWS)]
+    assert not any(app_module._hash_url(e.link) in seen for e in picks)
+    counts = Counter(_source(e) for e in picks)
+    assert set(counts) == {"tiny", "huge"}
+    # One degree of freedom: critical value 10.83 at p = 0.001.
+    expected = {"tiny": DRAWS / 1.1, "huge": DRAWS * 0.1 / 1.1}
+    assert _chi2(counts, expected) < 10.83
+
+
+def test_everything_seen_still_picks_a_post(app_module, skewed):
+    seen = {app_module._hash_url(e.link) for e in skewed}
+    assert app_module._pick_unseen(skewed, seen) in skewed
+
+
+def test_category_filtered_pool_is_fair_by_source(app_module, skewed):
+    art = app_module._apply_cat_filters(skewed, "art", set())
+    assert {_source(e) for e in art} == {"tiny", "mid", "huge"}
+    counts = Counter(_source(app_module._pick_unseen(art, set())) for _ in range(FILTERED_DRAWS))
+    # Weights are per source in the whole pool, so within "art" each source
+    # keeps its share in proportion to the fraction of its posts tagged art:
+    # tiny 1/1, mid 5/10, huge 50/100.
+    shares = {"tiny": 1.0, "mid": 0.5, "huge": 0.5}
+    total = sum(shares.values())
+    expected = {s: FILTERED_DRAWS * share / total for s, share in shares.items()}
+    assert _chi2(counts, expected) < CHI2_CRIT_DF2
+
+
+def test_filtered_pools_draw_from_the_alias_table(app_module, skewed, monkeypatch):
+    art = app_module._apply_cat_filters(skewed, "art", set())
+    assert art.base is skewed
+
+    def linear_pass(*args, **kwargs):
+        raise AssertionError("weighted every candidate")
+
+    monkeypatch.setattr(app_module.random, "choices", linear_pass)
+    picks = [app_module._pick_unseen(art, set()) for _ in range(200)]
+    assert all("art" in e.categories for e in picks)
+
+
+def test_next_post_is_drawn_fairly(app_module, skewed):
+    counts = Counter(
+        _source(
+            app_module._pick_next_entry(skewed, skewed[5].link, set(), [], "", 0)
+        )
+        for _ in range(FILTERED_DRAWS)
+    )
+    # The current post is excluded, which barely moves "mid" (9 of 10 left).
+    shares = {"tiny": 1.0, "mid": 0.9, "huge": 1.0}
+    total = sum(shares.values())
+    expected = {s: FILTERED_DRAWS * share / total for s, share in shares.items()}
+    assert _chi2(counts, expected) < CHI2_CRIT_DF2
+
+
+# --- popularity -----------------------------------------------------------------
+
+
+def test_fenwick_tree_matches_brute_force(app_module):
+    rng = random.Random(7)
+    weights = [rng.uniform(0.5, 3) for _ in range(37)]
+    tree = app_module.FenwickTree(weights)
+    for step in range(300):
+        if step % 3 == 0:
+            weights.append(rng.uniform(0.5, 3))
+            tree.append(weights[-1])
+        else:
+            row = rng.randrange(len(weights))
+            weights[row] = rng.uniform(0.5, 3)
+            tree.set(row, weights[row])
+        target = rng.random() * sum(weights)
+        running, expected = 0.0, None
+        for row, weight in enumerate(weights):
+            running += weight
+            if target < running:
+                expected = row
+                break
+        assert tree.find(target) == expected
+        assert tree.total == pytest.approx(sum(weights))
+
+
+@pytest.fixture
+def popular(app_module, data_dir, monkeypatch):
+    """Ten blog posts, one with 99 reactions, sampled by popularity."""
+    posts = [entry(f"https://p{i}.example/") for i in range(10)]
+    monkeypatch.setattr(app_module, "SAMPLING_MODE", "popular")
+    monkeypatch.setattr(app_module, "POPULARITY_EXPONENT", 0.5)
+    monkeypatch.setattr(app_module, "urls_cache", posts)
+    monkeypatch.setattr(app_module, "_likeable_entries", {e.link: e for e in posts})
+    with app_module._likes_lock:
+        app_module._rebuild_liked_cache()
+    random.seed(99)
+    return posts
+
+
+def test_reactions_boost_a_post(app_module, popular):
+    app_module._apply_like(popular[0].link, count=99)
+    # Weights: sqrt(100) = 10 for the liked post, 1 for the nine others.
+    counts = Counter(app_module._pick_unseen(popular, set()).link for _ in range(DRAWS))
+    liked = counts.pop(popular[0].link)
+    expected = {"liked": DRAWS * 10 / 19, "rest": DRAWS * 9 / 19}
+    assert _chi2({"liked": liked, "rest": sum(counts.values())}, expected) < 10.83
+
+
+def test_likes_reweight_in_place(app_module, popular):
+    pool, tree, rows = app_module._popularity_trees[id(popular)]
+    before = tree.total
+    app_module._apply_like(popular[3].link, count=3)
+    assert app_module._popularity_trees[id(popular)][1] is tree
+    assert tree.weights[rows[popular[3].link]] == pytest.approx(2.0)
+    assert tree.total == pytest.approx(before + 1.0)
+    # The first like also grew the liked pool, and its tree with it.
+    liked_pool, liked_tree, _ = app_module._popularity_trees[id(app_module.urls_liked_cache)]
+    assert [e.link for e in liked_pool] == [popular[3].link]
+    assert liked_tree.weights == [pytest.approx(2.0)]
+    assert app_module._pick_unseen(app_module.urls_liked_cache, set()) is popular[3]
+
+
+def test_a_merge_reweights_the_blog_tree_in_place(app_module, popular, data_dir):
+    pool, tree, rows = app_module._popularity_trees[id(popular)]
+    shard = data_dir / "likes.d" / "two.json"
+    payload = {"instance": "two", "seq": 1, "likes": {popular[4].link: {"👍": [3, 1.0]}}}
+    shard.write_text(json.dumps(payload), encoding="utf-8")
+    assert app_module.merge_likes() is True
+    assert app_module._popularity_trees[id(popular)][1] is tree
+    assert tree.weights[rows[popular[4].link]] == pytest.approx(2.0)
+    assert tree.total == pytest.approx(2.0 + 9)
+    liked_pool, _, _ = app_module._popularity_trees[id(app_module.urls_liked_cache)]
+    assert [e.link for e in liked_pool] == [popular[4].link]
+
+    # Rewritten but unchanged: nothing to rebuild.
+    version = app_module._liked_version
+    shard.write_text(json.dumps(payload) + " ", encoding="utf-8")
+    assert app_module.merge_likes() is True
+    assert app_module._liked_version == version
+
+
+def test_filtered_pools_draw_from_the_base_tree(app_module, popular, monkeypatch):
+    app_module._apply_like(popular[0].link, count=99)
+    pool = app_module._apply_cat_filters(popular, "", set())
+    assert pool.base is popular
+    seen = {app_module._hash_url(popular[1].link)}
+
+    def linear_pass(*args, **kwargs):
+        raise AssertionError("weighted every candidate")
+
+    monkeypatch.setattr(app_module.random, "choices", linear_pass)
+    picks = {app_module._pick_unseen(pool, seen).link for _ in range(200)}
+    assert popular[0].link in picks
+    assert popular[1].link not in picks
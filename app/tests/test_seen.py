@@ -0,0 +1,68 @@
+"""Seen cookie: compact versioned encoding, legacy reads, vectorized checks."""
+import hashlib
+import re
+
+import pytest
+
+
+def _legacy(url):
+    return hashlib.md5(url.encode()).hexdigest()[:8]
+
+
+def _cookie(res):
+    match = re.search(r"seen=([^;]*)", res.headers["Set-Cookie"])
+    return match.group(1)
+
+
+def test_legacy_hashes_map_to_the_same_tokens(app_module):
+    urls = [f"https://p{i}.example/" for i in range(50)]
+    raw = ",".join(_legacy(u) for u in urls)
+    assert app_module._parse_seen(raw) == [app_module._hash_url(u) for u in urls]
+
+
+@pytest.mark.parametrize("raw", ["", "1.", "1.ab", "zzzzzzzz,xyz!,12", "1.a;b"])
+def test_malformed_values_are_ignored(app_module, raw):
+    assert app_module._parse_seen(raw) == []
+
+
+def test_three_times_the_history_in_the_old_size(app_module):
+    tokens = [app_module._hash_url(f"https://p{i}.example/") for i in range(300)]
+    packed = app_module.SEEN_COOKIE_VERSION + "".join(tokens)
+    legacy = ",".join(_legacy(f"https://p{i}.example/") for i in range(100))
+    assert app_module.SEEN_MAX == 300
+    assert len(packed) <= len(legacy) + 5
+    assert app_module._parse_seen(packed) == tokens
+
+
+def test_index_rewrites_a_legacy_cookie_in_order(client, app_module):
+    old = ["https://b.example/2", "https://c.example/3"]
+    client.set_cookie("seen", ",".join(_legacy(u) for u in old), domain="localhost")
+    res = client.get("/?url=https://a.example/1")
+    value = _cookie(res)
+    assert value.startswith("1.")
+    assert app_module._parse_seen(value) == [
+        app_module._hash_url(u) for u in old + ["https://a.example/1"]
+    ]
+
+
+def test_oldest_entries_are_dropped(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "SEEN_MAX", 3)
+    urls = [f"https://p{i}.example/" for i in range(3)]
+    client.set_cookie(
+        "seen", "1." + "".join(app_module._hash_url(u) for u in urls), domain="localhost"
+    )
+    value = _cookie(client.get("/?url=https://a.example/1"))
+    assert app_module._parse_seen(value) == [
+        app_module._hash_url(u) for u in urls[1:] + ["https://a.example/1"]
+    ]
+
+
+def test_seen_mask_matches_per_post_checks(app_module):
+    pool = app_module.urls_cache
+    seen = {app_module._hash_url(e.link) for e in pool[1::2]}
+    expected = [app_module._hash_url(e.link) in seen for e in pool]
+    # The indexed pool uses its precomputed array, a copy hashes on the fly.
+    assert app_module._pool_seen_codes[id(pool)][0] is pool
+    assert list(app_module._seen_mask(pool, seen)) == expected
+    assert list(app_module._seen_mask(list(pool), seen)) == expected
+    assert not app_module._seen_mask(pool, set()).any()
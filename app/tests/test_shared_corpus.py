@@ -0,0 +1,236 @@
+"""SW_SHARED_DIR: one elected fetcher writes snapshots, the other workers load them."""
+import fcntl
+import os
+import runpy
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from conftest import BLOGS, entry
+
+
+@pytest.fixture
+def shared(app_module, tmp_path, monkeypatch):
+    """Shared mode in `tmp_path`, with no lock held and nothing loaded yet."""
+    for name, value in [
+        ("SHARED_DIR", str(tmp_path)),
+        ("_fetcher_lock_fd", None),
+        ("_snapshot_stat", None),
+        ("_snapshot_version", 0),
+        ("_snapshot_emb", (None, None)),
+        ("_snapshot_corpus", ""),
+        ("_next_fetch", 0.0),
+        ("_emb_matrix", None),
+        ("_emb_digest", ""),
+    ]:
+        monkeypatch.setattr(app_module, name, value)
+    yield tmp_path
+    if app_module._fetcher_lock_fd is not None:
+        os.close(app_module._fetcher_lock_fd)
+
+
+def _embed(app_module, scale=1.0):
+    app_module._build_embedding_matrix(
+        {e.link: [scale * (i + 1), 1.0] for i, e in enumerate(BLOGS)}
+    )
+
+
+def _become_follower(app_module, monkeypatch):
+    """Forget everything, as a freshly started worker would."""
+    for name in ("urls_cache", "urls_yt_cache", "urls_gh_cache", "urls_comic_cache"):
+        monkeypatch.setattr(app_module, name, [])
+    monkeypatch.setattr(app_module, "embeddings_cache", {})
+    monkeypatch.setattr(app_module, "_emb_matrix", None)
+    monkeypatch.setattr(app_module, "_snapshot_stat", None)
+    monkeypatch.setattr(app_module, "_snapshot_emb", (None, None))
+
+
+def _hold_lock(path):
+    """The lock as a peer worker holds it: a separate open file description."""
+    fd = os.open(path / "fetcher.lock", os.O_RDWR | os.O_CREAT)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+def test_snapshot_round_trip(app_module, shared, monkeypatch):
+    app_module.urls_gh_cache = [entry("https://github.com/k/r", "Repo")]
+    _embed(app_module)
+    expected = np.array(app_module._emb_matrix)
+    app_module.write_snapshot()
+
+    _become_follower(app_module, monkeypatch)
+    assert app_module.load_snapshot() is True
+    assert app_module.urls_cache == BLOGS
+    assert [e.link for e in app_module.urls_gh_cache] == ["https://github.com/k/r"]
+    assert isinstance(app_module._emb_matrix, np.memmap)
+    np.testing.assert_array_equal(app_module._emb_matrix, expected)
+    assert BLOGS[0].link in app_module.embeddings_cache
+    assert app_module._snapshot_version == 1
+    # Unchanged since: nothing to do.
+    assert app_module.load_snapshot() is False
+
+
+def test_loading_rebuilds_the_derived_state(app_module, client, shared, monkeypatch):
+    app_module.write_snapshot()
+    _become_follower(app_module, monkeypatch)
+    monkeypatch.setattr(app_module, "flagged_content_dict", {BLOGS[2].link: 1})
+    app_module.load_snapshot()
+    assert [e.link for e in app_module.urls_flagged_cache] == [BLOGS[2].link]
+    assert id(app_module.urls_cache) in app_module._group_indexes
+    assert BLOGS[2].title in client.get("/api/river").get_data(as_text=True)
+
+
+def _fetch_new_post(app_module, fetches):
+    """An update_all that finds one more post."""
+
+    def update_all():
+        fetches.append("feeds")
+        app_module.urls_cache = app_module.urls_cache + [entry("https://new.example/1", "New")]
+        app_module._install_corpus()
+
+    return update_all
+
+
+def test_only_the_lock_holder_fetches(app_module, shared, monkeypatch):
+    fetches = []
+    monkeypatch.setattr(app_module, "update_all", _fetch_new_post(app_module, fetches))
+    monkeypatch.setattr(app_module, "update_embeddings", lambda: fetches.append("emb"))
+    app_module.write_snapshot()
+    _become_follower(app_module, monkeypatch)
+
+    peer = _hold_lock(shared)
+    app_module.sync_shared_corpus()
+    assert fetches == []
+    assert app_module.urls_cache == BLOGS
+
+    # The fetcher died: the next poll takes over, fetches and publishes.
+    os.close(peer)
+    app_module.sync_shared_corpus()
+    assert fetches == ["feeds", "emb"]
+    assert app_module._snapshot_version == 2
+    app_module.sync_shared_corpus()
+    assert fetches == ["feeds", "emb"]
+    with pytest.raises(OSError):
+        _hold_lock(shared)
+
+
+def test_a_fetch_that_changes_nothing_writes_no_snapshot(app_module, shared, monkeypatch):
+    fetches = []
+    monkeypatch.setattr(app_module, "update_all", lambda: fetches.append("feeds"))
+    monkeypatch.setattr(app_module, "update_embeddings", lambda: fetches.append("emb"))
+    app_module.sync_shared_corpus()
+    assert app_module._snapshot_version == 1
+
+    monkeypatch.setattr(app_module, "_next_fetch", 0.0)
+    app_module.sync_shared_corpus()
+    assert fetches == ["feeds", "emb"] * 2
+    assert app_module._snapshot_version == 1
+
+    monkeypatch.setattr(app_module, "_next_fetch", 0.0)
+    monkeypatch.setattr(app_module, "update_all", _fetch_new_post(app_module, fetches))
+    app_module.sync_shared_corpus()
+    assert app_module._snapshot_version == 2
+
+    monkeypatch.setattr(app_module, "_next_fetch", 0.0)
+    monkeypatch.setattr(app_module, "update_all", lambda: None)
+    monkeypatch.setattr(app_module, "update_embeddings", lambda: _embed(app_module))
+    app_module.sync_shared_corpus()
+    assert app_module._snapshot_version == 3
+
+
+def test_unchanged_embeddings_keep_the_matrix(app_module, monkeypatch):
+    class Embeddings:
+        content = b'{"embeddings": {"https://a.example/": [1.0, 0.0]}}'
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"embeddings": {"https://a.example/": [1.0, 0.0]}}
+
+    monkeypatch.setattr(app_module, "_emb_digest", "")
+    monkeypatch.setattr(app_module, "_start_clustering", lambda: None)
+    monkeypatch.setattr(app_module.requests, "get", lambda url, **k: Embeddings())
+    app_module.update_embeddings()
+    matrix = app_module._emb_matrix
+    app_module.update_embeddings()
+    assert app_module._emb_matrix is matrix
+
+
+def test_matrix_is_rewritten_only_when_it_changes(app_module, shared):
+    _embed(app_module)
+    app_module.write_snapshot()
+    app_module.write_snapshot()
+    assert sorted(p.name for p in shared.glob("*.npy")) == ["embeddings.1.npy"]
+    _embed(app_module, scale=2.0)
+    app_module.write_snapshot()
+    assert sorted(p.name for p in shared.glob("*.npy")) == ["embeddings.3.npy"]
+
+
+def test_metricz_reports_the_snapshot_version(app_module, client, shared):
+    app_module.write_snapshot()
+    body = client.get("/metricz").get_data(as_text=True)
+    assert "smallweb_corpus_snapshot_version 1" in body
+
+
+def test_preloaded_master_starts_nothing(tmp_path):
+    """Under SW_PRELOAD the import loads the corpus and leaves the rest to workers."""
+    script = (
+        "import gc, threading, requests\n"
+        "class Embeddings:\n"
+        "    content = b'{}'\n"
+        "    def raise_for_status(self): pass\n"
+        "    def json(self): return {'embeddings': {'https://a.example/': [1.0, 0.0]}}\n"
+        "def _offline(url, **k):\n"
+        "    if url.endswith('/embeddings'): return Embeddings()\n"
+        "    raise requests.RequestException('offline')\n"
+        "requests.get = _offline\n"
+        "import sw\n"
+        "print(threading.active_count(), sw._store, sw.scheduler.running,"
+        " gc.get_freeze_count() > 0, sw._fetcher_lock_fd, len(sw._emb_urls))\n"
+    )
+    # Clustering would start a thread as soon as the embeddings load.
+    env = dict(
+        os.environ,
+        SW_PRELOAD="1",
+        SW_SHARED_DIR=str(tmp_path),
+        SAME_TOPIC_MODE="cluster",
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    assert out.split() == ["1", "None", "False", "True", "None", "1"]
+    assert (tmp_path / "corpus.pickle").exists()
+
+
+def test_preloaded_workers_never_share_a_shard(app_module, monkeypatch):
+    monkeypatch.delenv("SW_INSTANCE_ID", raising=False)
+    assert app_module._worker_instance_id(1) != app_module._worker_instance_id(1)
+    monkeypatch.setenv("SW_INSTANCE_ID", "web")
+    assert [app_module._worker_instance_id(n) for n in (1, 2)] == ["web-1", "web-2"]
+
+
+def test_a_respawned_worker_takes_its_predecessors_slot():
+    conf = runpy.run_path(
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gunicorn.conf.py")
+    )
+    server = SimpleNamespace(WORKERS={})
+    for pid in (101, 102, 103):
+        worker = SimpleNamespace()
+        conf["pre_fork"](server, worker)
+        server.WORKERS[pid] = worker
+    assert [w.sw_slot for w in server.WORKERS.values()] == [1, 2, 3]
+    # Worker 2 died and was reaped; its replacement is the fourth spawn.
+    del server.WORKERS[102]
+    worker = SimpleNamespace()
+    conf["pre_fork"](server, worker)
+    assert worker.sw_slot == 2
@@ -0,0 +1,176 @@
+"""Embedding neighbours: /api/like-target and the batched /api/similar-batch."""
+import numpy as np
+
+from conftest import entry
+
+# Two topics, laid out so each post's nearest neighbour is unambiguous.
+VECTORS = {
+    "https://a.example/1": [1.0, 0.0, 0.0],
+    "https://b.example/2": [0.9, 0.1, 0.0],
+    "https://c.example/3": [0.0, 1.0, 0.0],
+    "https://d.example/4": [0.1, 0.9, 0.0],
+    "https://e.example/5": [0.5, 0.5, 0.7],
+}
+
+
+def _embed(app_module, vectors=VECTORS):
+    app_module.embeddings_cache = dict(vectors)
+    app_module._build_embedding_matrix(vectors)
+
+
+def _like_target(client, url, extra=""):
+    post = client.get(f"/api/like-target?url={url}{extra}").get_json()["post"]
+    return post and post["source_url"]
+
+
+def test_batch_matches_like_target_for_every_input(client, app_module):
+    _embed(app_module)
+    urls = list(VECTORS)
+    res = client.get("/api/similar-batch", query_string=[("url", u) for u in urls])
+    assert res.status_code == 200
+    results = res.get_json()["results"]
+    assert [r["url"] for r in results] == urls
+    for result in results:
+        expected = _like_target(client, result["url"])
+        assert result["post"]["source_url"] == expected
+
+
+def test_batch_ranks_neighbours_best_first(client, app_module):
+    _embed(app_module)
+    res = client.get("/api/similar-batch?url=https://a.example/1&limit=3")
+    neighbors = res.get_json()["results"][0]["neighbors"]
+    assert [n["source_url"] for n in neighbors][:2] == [
+        "https://b.example/2",
+        "https://e.example/5",
+    ]
+    scores = [n["score"] for n in neighbors]
+    assert scores == sorted(scores, reverse=True)
+    assert "https://a.example/1" not in [n["source_url"] for n in neighbors]
+
+
+def test_batch_respects_seen_cookie_like_like_target(client, app_module):
+    _embed(app_module)
+    client.set_cookie(
+        "seen", app_module._hash_url("https://b.example/2"), domain="localhost"
+    )
+    res = client.get("/api/similar-batch?url=https://a.example/1")
+    post = res.get_json()["results"][0]["post"]
+    assert post["source_url"] != "https://b.example/2"
+    assert post["source_url"] == _like_target(client, "https://a.example/1")
+
+
+def test_batch_respects_category_filter(client, app_module):
+    _embed(app_module)
+    res = client.get("/api/similar-batch?cat=art&url=https://a.example/1")
+    post = res.get_json()["results"][0]["post"]
+    assert post["source_url"] in {"https://c.example/3", "https://d.example/4"}
+    assert post["source_url"] == _like_target(
+        client, "https://a.example/1", "&cat=art"
+    )
+
+
+def test_batch_returns_empty_result_for_unknown_url(client, app_module):
+    _embed(app_module)
+    res = client.get(
+        "/api/similar-batch",
+        query_string=[("url", "https://gone.example/9"), ("url", "https://c.example/3")],
+    )
+    unknown, known = res.get_json()["results"]
+    assert unknown == {"url": "https://gone.example/9", "post": None, "neighbors": []}
+    assert known["post"]["source_url"] == "https://d.example/4"
+
+
+def test_batch_without_embeddings_is_empty(client):
+    res = client.get("/api/similar-batch?url=https://a.example/1")
+    assert res.get_json()["results"][0]["post"] is None
+
+
+def test_batch_rejects_non_iframe_modes(client, app_module):
+    app_module.urls_gh_cache = [entry("https://github.com/a/b")]
+    res = client.get("/api/similar-batch?gh&url=https://github.com/a/b")
+    assert res.status_code == 400
+
+
+def test_batch_is_never_stored(client, app_module):
+    _embed(app_module)
+    res = client.get("/api/similar-batch?url=https://a.example/1")
+    assert res.headers.get("Cache-Control") == "no-store"
+    assert "limit=" not in res.get_json()["results"][0]["post"]["page_url"]
+
+
+# --- embedding clusters ---------------------------------------------------------
+
+def _two_topics(app_module, per_topic=40):
+    """Posts around two orthogonal directions; both topics share one category."""
+    rng = np.random.default_rng(3)
+    posts, vectors = [], {}
+    for topic, axis in (("x", 0), ("y", 1)):
+        for i in range(per_topic):
+            link = f"https://{topic}.example/{i}"
+            vec = rng.normal(0, 0.05, 8)
+            vec[axis] += 1.0
+            vectors[link] = vec.tolist()
+            posts.append(entry(link, f"{topic}{i}", ["tech"]))
+    app_module.urls_cache = posts
+    app_module._rebuild_group_indexes()
+    _embed(app_module, vectors)
+    app_module._cluster_embeddings()
+    return posts
+
+
+def test_kmeans_separates_topics(app_module):
+    _two_topics(app_module)
+    url_to_idx, urls, labels, members = app_module._emb_clusters
+    assert labels[url_to_idx["https://x.example/0"]] != labels[
+        url_to_idx["https://y.example/0"]
+    ]
+    for rows in members:
+        assert len({urls[r].split("//")[1][0] for r in rows}) <= 1
+    assert sum(len(rows) for rows in members) == len(urls)
+
+
+def test_cluster_mode_keeps_next_post_on_topic(app_module, monkeypatch):
+    posts = _two_topics(app_module)
+    monkeypatch.setattr(app_module, "SAME_TOPIC_MODE", "cluster")
+    monkeypatch.setattr(app_module.random, "random", lambda: 0.5)
+    for _ in range(50):
+        nxt = app_module._pick_next_entry(
+            posts, "https://x.example/0", set(), ["tech"], "", 0
+        )
+        assert nxt.link.startswith("https://x.example/")
+        assert nxt.link != "https://x.example/0"
+
+
+def test_cluster_mode_falls_back_without_clusters(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "SAME_TOPIC_MODE", "cluster")
+    monkeypatch.setattr(app_module.random, "random", lambda: 0.5)
+    cache = app_module.urls_cache
+    for _ in range(20):
+        nxt = app_module._pick_next_entry(
+            cache, "https://c.example/3", set(), ["art"], "", 0
+        )
+        # Category heuristic: the only other art post.
+        assert nxt.link == "https://d.example/4"
+
+
+def test_cluster_pick_skips_seen_posts(app_module, monkeypatch):
+    posts = _two_topics(app_module, per_topic=10)
+    monkeypatch.setattr(app_module, "SAME_TOPIC_MODE", "cluster")
+    seen = {app_module._hash_url(e.link) for e in posts if e.link != "https://x.example/5"}
+    for _ in range(20):
+        nxt = app_module._pick_next_entry(
+            posts, "https://x.example/0", seen, ["tech"], "", 0
+        )
+        assert nxt.link == "https://x.example/5"
+
+
+def test_cluster_pick_checks_only_the_drawn_posts(app_module, monkeypatch):
+    posts = _two_topics(app_module, per_topic=10)
+    monkeypatch.setattr(app_module, "SAME_TOPIC_MODE", "cluster")
+    monkeypatch.setattr(app_module.random, "random", lambda: 0.5)
+    tested = []
+    pool = app_module._narrow(posts, lambda e: tested.append(e) or True)
+    tested.clear()
+    nxt = app_module._pick_next_entry(pool, "https://x.example/0", set(), ["tech"], "", 0)
+    assert nxt.link.startswith("https://x.example/")
+    assert len(tested) <= app_module.EMB_CLUSTER_DRAWS
@@ -0,0 +1,177 @@
+"""?source= and ?domain=: one blog's posts, from the group-by indexes."""
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from conftest import entry
+
+FEED_A = "https://a.example/feed.xml"
+FEED_B = "https://blog.b.example/rss"
+
+
+@pytest.fixture
+def blogs(app_module, monkeypatch):
+    """Two multi-post feeds, one on two subdomains, plus a feedless post."""
+    posts = [
+        entry("https://a.example/1", "A1", ["tech"], 9, feed_url=FEED_A),
+        entry("https://a.example/2", "A2", ["art"], 8, feed_url=FEED_A),
+        entry("https://blog.b.example/1", "B1", ["tech"], 7, feed_url=FEED_B),
+        entry("https://www.b.example/2", "B2", ["tech"], 6, feed_url=FEED_B),
+        entry("https://c.example/1", "C1", ["tech"], 5),
+        entry("https://a.example/3", "A3", ["spam"], 4, feed_url=FEED_A),
+    ]
+    monkeypatch.setattr(app_module, "urls_cache", posts)
+    app_module._rebuild_group_indexes()
+    app_module._update_corpus_version()
+    return posts
+
+
+def _links(posts):
+    return [e.link for e in posts]
+
+
+def test_index_rows_point_into_the_pool(app_module, blogs):
+    pool, by_source, by_domain = app_module._group_indexes[id(blogs)]
+    assert pool is blogs
+    assert by_source["a.example/feed.xml"] == [0, 1, 5]
+    assert by_domain["b.example"] == [2, 3]
+
+
+def test_source_filter_normalizes_the_feed_url(app_module, blogs):
+    for source in (FEED_A, "http://www.a.example/feed.xml/"):
+        assert _links(app_module._apply_source_filter(blogs, source, "")) == [
+            "https://a.example/1",
+            "https://a.example/2",
+            "https://a.example/3",
+        ]
+
+
+def test_domain_filter_groups_subdomains(app_module, blogs):
+    for domain in ("b.example", "www.b.example", "https://blog.b.example/x"):
+        assert _links(app_module._apply_source_filter(blogs, "", domain)) == [
+            "https://blog.b.example/1",
+            "https://www.b.example/2",
+        ]
+
+
+def test_a_public_suffix_domain_matches_only_its_own_host(app_module, blogs):
+    hosted = entry("https://github.io/about", "GH")
+    pages = entry("https://me.github.io/1", "Me")
+    pool = blogs + [hosted, pages]
+    app_module.urls_cache = pool
+    app_module._rebuild_group_indexes()
+    for cache in (pool, list(reversed(pool))):
+        assert _links(app_module._apply_source_filter(cache, "", "github.io")) == [
+            "https://github.io/about"
+        ]
+        assert _links(app_module._apply_source_filter(cache, "", "https://:80/")) == []
+
+
+def test_unindexed_pools_give_the_same_answer(app_module, blogs):
+    derived = list(reversed(blogs))
+    for source, domain in ((FEED_A, ""), ("", "b.example"), (FEED_B, "b.example")):
+        indexed = app_module._apply_source_filter(blogs, source, domain)
+        scanned = app_module._apply_source_filter(derived, source, domain)
+        assert sorted(_links(indexed)) == sorted(_links(scanned))
+
+
+def test_index_serves_only_the_source(client, blogs):
+    res = client.get(f"/?source={FEED_A}")
+    assert res.status_code == 302
+    url = parse_qs(urlparse(res.headers["Location"]).query)["url"][0]
+    assert url in ("https://a.example/1", "https://a.example/2")
+
+    body = client.get(f"/?source={FEED_A}&url={url}").get_data(as_text=True)
+    # The next link stays inside the source, and so does the feed.
+    assert "source=https%3A%2F%2Fa.example%2Ffeed.xml" in body
+    assert "/feed?source=https%3A%2F%2Fa.example%2Ffeed.xml" in body
+
+
+def test_category_still_narrows_a_source(client, blogs):
+    res = client.get(f"/?source={FEED_A}&cat=art")
+    url = parse_qs(urlparse(res.headers["Location"]).query)["url"][0]
+    assert url == "https://a.example/2"
+
+
+def test_unknown_source_renders_no_results(client, blogs):
+    body = client.get("/?source=https://nope.example/feed").get_data(as_text=True)
+    assert 'No posts from "https://nope.example/feed"' in body
+
+
+def test_deck_draws_only_from_the_source(client, blogs):
+    res = client.get("/api/deck?domain=b.example&count=5&url=https://blog.b.example/1")
+    assert [p["source_url"] for p in res.get_json()["posts"]] == [
+        "https://www.b.example/2"
+    ]
+
+
+def test_liked_surprise_stays_inside_the_source(app_module, blogs, monkeypatch):
+    monkeypatch.setattr(app_module, "urls_liked_cache", [blogs[0], blogs[4]])
+    assert _links(app_module._liked_pool("", "", set(), FEED_A)) == ["https://a.example/1"]
+
+
+def test_feed_lists_the_source(client, blogs):
+    body = client.get(f"/feed?source={FEED_B}").get_data(as_text=True)
+    assert "Kagi Small Web - https://blog.b.example/rss" in body
+    assert "https://www.b.example/2" in body
+    assert "https://a.example/1" not in body
+    assert (
+        client.get(f"/feed?source={FEED_B}").headers["ETag"]
+        != client.get("/feed").headers["ETag"]
+    )
+
+
+def test_river_and_api_filter_and_link_to_the_source(client, blogs):
+    cards = client.get(f"/api/river?source={FEED_A}").get_json()["cards"]
+    # Newest first, spam left out as in the unfiltered river.
+    assert [c["link"] for c in cards] == ["https://a.example/2", "https://a.example/1"]
+    assert cards[0]["more_url"] == "/river?source=https%3A%2F%2Fa.example%2Ffeed.xml"
+
+    body = client.get("/river?domain=c.example").get_data(as_text=True)
+    assert ">C1</h2>" in body
+    assert ">A1</h2>" not in body
+    unfiltered = client.get("/api/river").get_json()["cards"]
+    assert next(c for c in unfiltered if c["link"] == "https://c.example/1")[
+        "more_url"
+    ] == "/river?domain=c.example"
+
+
+def test_feedless_platform_posts_link_to_their_listed_feed(
+    app_module, client, blogs, monkeypatch
+):
+    jim = app_module.FeedSource(
+        "https://jim.substack.com/feed",
+        "blogs",
+        "",
+        "https://jim.substack.com/",
+        "jim.substack.com",
+    )
+    monkeypatch.setattr(app_module, "feed_hosts", {jim.host: jim})
+    posts = [entry(f"https://{name}.substack.com/p/1", name) for name in ("jim", "ann")]
+    monkeypatch.setattr(app_module, "urls_cache", blogs + posts)
+    cards = {c["link"]: c for c in client.get("/api/river").get_json()["cards"]}
+    assert cards["https://jim.substack.com/p/1"]["more_url"] == (
+        "/river?source=https%3A%2F%2Fjim.substack.com%2Ffeed"
+    )
+    # ?domain= would be all of substack.com, so there is no link at all.
+    assert cards["https://ann.substack.com/p/1"]["more_url"] is None
+    assert "ann.substack.com</span>" in client.get("/river").get_data(as_text=True)
+
+
+@pytest.mark.parametrize(
+    "route",
+    [
+        "/?url=https://a.example/1&",
+        "/river?",
+        "/api/river?",
+        "/feed?",
+        "/api/deck?url=https://a.example/1&",
+        "/api/similar-batch?url=https://a.example/1&",
+        "/api/like-target?",
+    ],
+)
+@pytest.mark.parametrize("arg", ["source", "domain"])
+def test_unparseable_filters_match_nothing(client, blogs, route, arg):
+    res = client.get(f"{route}{arg}=http://[bad")
+    assert res.status_code < 500
+    assert "https://a.example/2" not in res.get_data(as_text=True)
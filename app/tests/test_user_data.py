@@ -0,0 +1,264 @@
+"""Notes and flags: background writer, bounded loss, shutdown flush, peers."""
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+import pytest
+
+
+class RecordingStore:
+    """Stands in for the JSON store and records who wrote what."""
+
+    name = "recording"
+    row_level = False
+
+    def __init__(self, fail=False):
+        self.saves, self.threads, self.fail = [], [], fail
+
+    def _save(self, kind, data, urls):
+        self.threads.append(threading.current_thread().name)
+        if self.fail:
+            raise OSError("simulated full disk")
+        self.saves.append((kind, data, sorted(urls)))
+
+    def save_notes(self, notes, urls):
+        self._save("notes", notes, urls)
+
+    def save_flags(self, flags, urls):
+        self._save("flags", flags, urls)
+
+    def checkpoint(self):
+        pass
+
+    def ship_likes(self):
+        pass
+
+
+@pytest.fixture
+def store(app_module, monkeypatch):
+    store = RecordingStore()
+    monkeypatch.setattr(app_module, "_store", store)
+    monkeypatch.setattr(app_module, "notes_dict", {})
+    monkeypatch.setattr(app_module, "flagged_content_dict", {})
+    return store
+
+
+def test_requests_only_mark_dirty(app_module, client, store):
+    client.post("/note", data={"url": "https://a.example/1", "note_content": "one"})
+    client.post("/note", data={"url": "https://a.example/1", "note_content": "two"})
+    client.post("/flag_content", data={"url": "https://b.example/2"})
+    assert store.saves == []
+    assert app_module.unflushed_write_age() > 0
+
+    app_module.flush_user_data()
+    # Coalesced: one write per kind, however many requests piled up.
+    assert [(kind, urls) for kind, _, urls in store.saves] == [
+        ("notes", ["https://a.example/1"]),
+        ("flags", ["https://b.example/2"]),
+    ]
+    assert [n for n, _ in store.saves[0][1]["https://a.example/1"]] == ["one", "two"]
+    assert app_module.unflushed_write_age() == 0.0
+
+
+def test_row_level_store_gets_only_dirty_rows(app_module, client, store):
+    store.row_level = True
+    app_module.flagged_content_dict["https://c.example/3"] = 4
+    client.post("/flag_content", data={"url": "https://b.example/2"})
+    app_module.flush_user_data()
+    assert store.saves == [("flags", {"https://b.example/2": 1}, ["https://b.example/2"])]
+
+
+def test_failed_flush_keeps_writes_dirty_and_aged(app_module, client, store):
+    store.fail = True
+    client.post("/flag_content", data={"url": "https://b.example/2"})
+    age = app_module.unflushed_write_age()
+    app_module.flush_user_data()
+    assert app_module._flags_dirty == {"https://b.example/2"}
+    assert app_module.unflushed_write_age() >= age
+
+    store.fail = False
+    app_module.flush_user_data()
+    assert store.saves[-1][0] == "flags"
+    assert app_module.unflushed_write_age() == 0.0
+
+
+def test_metricz_reports_unflushed_age(app_module, client, store, monkeypatch):
+    body = client.get("/metricz").get_data(as_text=True)
+    assert "smallweb_unflushed_write_age_seconds 0.000" in body
+    client.post("/note", data={"url": "https://a.example/1", "note_content": "x"})
+    monkeypatch.setattr(app_module, "_oldest_unflushed", app_module._oldest_unflushed - 2)
+    body = client.get("/metricz").get_data(as_text=True)
+    assert "smallweb_unflushed_write_age_seconds 2.0" in body
+
+
+def test_sigterm_flushes_then_chains_to_previous_handler(
+    app_module, client, store, monkeypatch
+):
+    chained = []
+    monkeypatch.setattr(app_module, "_previous_sigterm", lambda *a: chained.append(a))
+    monkeypatch.setattr(app_module, "compact_likes", lambda: None)
+    client.post("/note", data={"url": "https://a.example/1", "note_content": "bye"})
+    app_module._flush_on_sigterm(15, None)
+    assert [kind for kind, _, _ in store.saves] == ["notes"]
+    assert store.threads == ["sigterm-flush"]
+    assert chained == [(15, None)]
+
+
+def test_sigterm_gives_up_after_the_budget(app_module, store, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(app_module, "SHUTDOWN_FLUSH_BUDGET", 0.05)
+    monkeypatch.setattr(app_module, "save_all_data", lambda: release.wait(5))
+    chained = []
+    monkeypatch.setattr(app_module, "_previous_sigterm", lambda *a: chained.append(a))
+    app_module._flush_on_sigterm(15, None)
+    assert chained == [(15, None)]
+    release.set()
+
+
+def test_concurrent_notes_and_flags_are_all_kept(app_module, store):
+    threads, per_thread = 8, 300
+    done = threading.Event()
+
+    def writer(n):
+        for i in range(per_thread):
+            app_module._add_note(f"https://a.example/{i % 10}", f"{n}-{i}")
+            app_module._add_flag(f"https://b.example/{i % 10}")
+
+    def flusher():
+        while not done.is_set():
+            app_module.flush_user_data()
+
+    background = threading.Thread(target=flusher)
+    background.start()
+    workers = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    done.set()
+    background.join()
+    app_module.flush_user_data()
+
+    total = threads * per_thread
+    assert sum(len(v) for v in app_module.notes_dict.values()) == total
+    assert sum(app_module.flagged_content_dict.values()) == total
+    # The last flush of each kind saw the final state.
+    last = {kind: data for kind, data, _ in store.saves}
+    assert last["notes"] == app_module.notes_dict
+    assert last["flags"] == app_module.flagged_content_dict
+
+
+# --- peers ----------------------------------------------------------------------
+
+
+@pytest.fixture
+def shared(app_module, store, tmp_path, monkeypatch):
+    """Shared notes/flags files and likes.d in `tmp_path`, nothing merged yet."""
+    monkeypatch.setattr(app_module, "PATH_NOTES", str(tmp_path / "notes.json"))
+    monkeypatch.setattr(app_module, "PATH_FLAGGED", str(tmp_path / "flagged_content.json"))
+    monkeypatch.setattr(app_module, "DIR_LIKES", str(tmp_path / "likes.d"))
+    monkeypatch.setattr(app_module, "DIR_FLAGS", str(tmp_path / "flags.d"))
+    monkeypatch.setattr(app_module, "_user_data_stats", None)
+    (tmp_path / "likes.d").mkdir()
+    (tmp_path / "flags.d").mkdir()
+    return tmp_path
+
+
+def test_peer_notes_and_flags_are_merged(app_module, shared):
+    app_module._add_note("https://a.example/1", "mine")
+    app_module._add_flag("https://c.example/3")
+    (shared / "notes.json").write_text(
+        json.dumps({"https://a.example/1": [["theirs", "2024-01-01T00:00:00"]]}),
+        encoding="utf-8",
+    )
+    (shared / "flagged_content.json").write_text(
+        json.dumps({"https://b.example/2": 2}), encoding="utf-8"
+    )
+    (shared / "flags.d" / "two.json").write_text(
+        json.dumps({"https://c.example/3": 1}), encoding="utf-8"
+    )
+    assert app_module.merge_user_data() is True
+    notes = app_module.notes_dict["https://a.example/1"]
+    assert [content for content, _ in notes] == ["theirs", "mine"]
+    # The legacy file is a base; every instance's own counts add to it.
+    assert app_module.flagged_content_dict == {
+        "https://b.example/2": 2,
+        "https://c.example/3": 2,
+    }
+    assert [e.link for e in app_module.urls_flagged_cache] == [
+        "https://b.example/2",
+        "https://c.example/3",
+    ]
+
+
+def test_flags_from_each_instance_add_up(app_module, shared):
+    app_module._add_flag("https://b.example/2")
+    (shared / "flags.d" / "two.json").write_text(
+        json.dumps({"https://b.example/2": 1}), encoding="utf-8"
+    )
+    assert app_module.merge_user_data() is True
+    assert app_module.flagged_content_dict == {"https://b.example/2": 2}
+    # A later flag here, and the peer's own count moving on, still add up.
+    app_module._add_flag("https://b.example/2")
+    (shared / "flags.d" / "two.json").write_text(
+        json.dumps({"https://b.example/2": 3}), encoding="utf-8"
+    )
+    assert app_module.merge_user_data() is True
+    assert app_module.flagged_content_dict == {"https://b.example/2": 5}
+    assert app_module._own_flags == {"https://b.example/2": 2}
+
+
+def test_own_files_are_not_counted_as_a_peer(app_module, shared, monkeypatch):
+    monkeypatch.setattr(app_module, "INSTANCE_ID", "one")
+    app_module._add_flag("https://b.example/2")
+    for name in ("one.json", "three.json"):
+        (shared / "flags.d" / name).write_text(
+            json.dumps({"https://b.example/2": 1}), encoding="utf-8"
+        )
+    # "three" moved to the SQLite store; its checkpoint holds the same flag.
+    for instance in ("one", "three"):
+        db = sqlite3.connect(shared / "likes.d" / f"{instance}.sqlite")
+        db.executescript(app_module.SqliteStore.SCHEMA)
+        db.execute("INSERT INTO flags VALUES (?, ?)", ("https://b.example/2", 1))
+        db.commit()
+        db.close()
+    assert app_module.merge_user_data() is True
+    assert app_module.flagged_content_dict == {"https://b.example/2": 2}
+
+
+def test_unchanged_files_are_not_read_again(app_module, shared, monkeypatch):
+    (shared / "flagged_content.json").write_text(
+        json.dumps({"https://b.example/2": 2}), encoding="utf-8"
+    )
+    assert app_module.merge_user_data() is True
+    reads = []
+    monkeypatch.setattr(app_module, "_load_json", lambda *a: reads.append(a))
+    assert app_module.merge_user_data() is False
+    assert reads == []
+
+
+def test_peer_sqlite_checkpoint_is_merged(app_module, shared):
+    db = sqlite3.connect(shared / "likes.d" / "peer.sqlite")
+    db.executescript(app_module.SqliteStore.SCHEMA)
+    db.execute(
+        "INSERT INTO notes VALUES (?, ?, ?)",
+        ("https://a.example/1", "from peer", datetime(2024, 1, 1).isoformat()),
+    )
+    db.execute("INSERT INTO flags VALUES (?, ?)", ("https://d.example/4", 3))
+    db.commit()
+    db.close()
+    assert app_module.merge_user_data() is True
+    assert app_module.notes_dict["https://a.example/1"] == [
+        ("from peer", datetime(2024, 1, 1))
+    ]
+    assert app_module.flagged_content_dict == {"https://d.example/4": 3}
+
+
+def test_refresh_lag_is_reported(app_module, client, shared, monkeypatch):
+    monkeypatch.setattr(app_module, "_last_refresh", app_module.time.monotonic() - 90)
+    assert "smallweb_user_data_refresh_lag_seconds 90." in client.get("/metricz").get_data(
+        as_text=True
+    )
+    app_module.refresh_user_data()
+    assert app_module.refresh_lag() < 5
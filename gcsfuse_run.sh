@@ -24,9 +24,9 @@ gcsfuse --debug_gcs --debug_fuse $BUCKET $MNT_DIR
 echo "Mounting completed."
 
 # Run the web service on container startup. Here we use the gunicorn
-# webserver, with one worker process and 8 threads.
-# For environments with multiple CPU cores, increase the number of workers
-# to be equal to the cores available.
+# webserver, with one worker process and 2 threads by default.
+# For environments with multiple CPU cores, set WEB_CONCURRENCY to the cores
+# available and SW_PRELOAD=1 so the workers share one corpus (see app/README.md).
 # Timeout is set to 0 to disable the timeouts of the workers to allow Cloud Run to handle instance scaling.
-exec gunicorn --bind 0.0.0.0:$PORT --workers 1 --threads 2 -t 100 sw:app
+exec gunicorn --bind 0.0.0.0:$PORT --workers "${WEB_CONCURRENCY:-1}" --threads 2 -t 100 sw:app
 # [END cloudrun_fuse_script]